@@ -0,0 +1,250 @@
+"""
+Encounter Mapper Freeform is a node-based encounter map creator for tabletop
+RPGs. Copyright 2020 Eric Symmank
+
+This file is part of Encounter Mapper Freeform.
+
+Encounter Mapper Freeform is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper Freeform is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper Freeform.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+
+from PyQt5.QtCore import QStandardPaths
+from PyQt5.QtGui import QPixmap, QImage
+
+"""
+EMFAssets keeps track of the image files used by DisplayItems by the hash of
+their contents. Images with the same contents are only decoded once, no
+matter how many DIs use them or which paths they were picked from.
+
+Decoded images are kept in a cache of at most CACHE_BYTES, dropping the
+least recently used images first. decodeInBackground() reads and decodes an
+image on a worker thread, so it is often ready by the time it is drawn.
+
+Assets taken out of a bundled map are written once to the asset directory,
+named after their hash, so opening the same bundle again, or another bundle
+with the same images, reuses them.
+"""
+
+
+class EMFAssets:
+    ASSET_FOLDER = "assets"
+    # Where assets from bundles are written. The app cache when None
+    assetDirectory = None
+
+    CACHE_BYTES = 512 << 20
+
+    # path -> (modified time, size, hash), to avoid hashing files again
+    fileHashes = {}
+    # path -> (modified time, size) of files that couldn't be read, or None
+    # if there was no file, so they aren't tried again on every draw
+    failedLoads = {}
+    # hash -> decoded QPixmap, least recently used first
+    pixmaps = OrderedDict()
+    pixmapBytes = 0
+    # path -> Future of the (hash, QImage) decoded by a worker thread
+    decoding = {}
+    executor = None
+
+    # The (modified time, size) of the file at path, or None if there is no
+    # file
+    @classmethod
+    def fileStamp(cls, path):
+        try:
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        return stat.st_mtime, stat.st_size
+
+    # The sha256 of the file at path, or None if it can't be read
+    @classmethod
+    def fileHash(cls, path):
+        try:
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        known = cls.fileHashes.get(path)
+        if known is not None and known[:2] == (stat.st_mtime, stat.st_size):
+            return known[2]
+        digest = hashlib.sha256()
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+        except OSError:
+            return None
+        fileHash = digest.hexdigest()
+        cls.fileHashes[path] = (stat.st_mtime, stat.st_size, fileHash)
+        return fileHash
+
+    # A handle that decodes the image at path when it is first drawn
+    @classmethod
+    def imageHandle(cls, path):
+        return ImageHandle(path)
+
+    # The hash of the image at path and its QPixmap, shared with every other
+    # file of the same contents. Waits for any background decode of path
+    @classmethod
+    def loadPixmap(cls, path):
+        future = cls.decoding.pop(path, None)
+        image = None
+        if future is not None:
+            fileHash, image = future.result()
+        elif (path in cls.failedLoads and
+                cls.failedLoads[path] == cls.fileStamp(path)):
+            # still missing or unchanged since it couldn't be read
+            return None, QPixmap()
+        else:
+            fileHash = cls.fileHash(path)
+        if fileHash is None:
+            cls.failedLoads[path] = cls.fileStamp(path)
+            return None, QPixmap()
+        cls.failedLoads.pop(path, None)
+        pixmap = cls.cachedPixmap(fileHash)
+        if pixmap is None:
+            # QPixmaps can only be made on the GUI thread
+            pixmap = (QPixmap(path) if image is None
+                      else QPixmap.fromImage(image))
+            cls.storePixmap(fileHash, pixmap)
+        return fileHash, pixmap
+
+    # The decoded image for fileHash, or None if it isn't in the cache
+    @classmethod
+    def cachedPixmap(cls, fileHash):
+        pixmap = cls.pixmaps.get(fileHash)
+        if pixmap is not None:
+            cls.pixmaps.move_to_end(fileHash)
+        return pixmap
+
+    @classmethod
+    def storePixmap(cls, fileHash, pixmap):
+        cls.pixmaps[fileHash] = pixmap
+        cls.pixmapBytes += cls.pixmapSize(pixmap)
+        while cls.pixmapBytes > cls.CACHE_BYTES and len(cls.pixmaps) > 1:
+            dropped = cls.pixmaps.popitem(last=False)[1]
+            cls.pixmapBytes -= cls.pixmapSize(dropped)
+
+    # Drop a decoded image. It is decoded again the next time it is drawn
+    @classmethod
+    def dropPixmap(cls, fileHash):
+        pixmap = cls.pixmaps.pop(fileHash, None)
+        if pixmap is not None:
+            cls.pixmapBytes -= cls.pixmapSize(pixmap)
+
+    # Drop every decoded image, for when memory is running low or the window
+    # is minimized
+    @classmethod
+    def dropPixmaps(cls):
+        cls.pixmaps.clear()
+        cls.pixmapBytes = 0
+
+    @classmethod
+    def pixmapSize(cls, pixmap):
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+    # Start decoding the image at path on a worker thread
+    @classmethod
+    def decodeInBackground(cls, path):
+        if path not in cls.decoding:
+            if cls.executor is None:
+                cls.executor = ThreadPoolExecutor()
+            cls.decoding[path] = cls.executor.submit(cls.decodeImage, path)
+
+    # Runs on a worker thread. Only decodes images not already in the cache
+    @classmethod
+    def decodeImage(cls, path):
+        fileHash = cls.fileHash(path)
+        image = None
+        if fileHash is not None and fileHash not in cls.pixmaps:
+            image = QImage(path)
+        return fileHash, image
+
+    # The name used for the file at path inside a bundle, or None if there is
+    # no file at path
+    @classmethod
+    def assetName(cls, path):
+        fileHash = cls.fileHash(path)
+        if fileHash is None:
+            return None
+        return "{}/{}{}".format(cls.ASSET_FOLDER, fileHash,
+                                os.path.splitext(path)[1].lower())
+
+    @classmethod
+    def getAssetDirectory(cls):
+        if cls.assetDirectory is None:
+            return os.path.join(QStandardPaths.writableLocation(
+                QStandardPaths.CacheLocation), cls.ASSET_FOLDER)
+        return cls.assetDirectory
+
+    # Write the asset called name in the bundle to the asset directory, if it
+    # isn't there already. Returns the path of the file
+    @classmethod
+    def extractAsset(cls, bundle, name):
+        data = bundle.read(name)
+        # name the file after the hash of what is actually in the bundle
+        fileHash = hashlib.sha256(data).hexdigest()
+        directory = cls.getAssetDirectory()
+        path = os.path.join(directory, fileHash +
+                            os.path.splitext(name)[1].lower())
+        if not os.path.exists(path):
+            os.makedirs(directory, exist_ok=True)
+            tempPath = path + ".tmp"
+            with open(tempPath, "wb") as f:
+                f.write(data)
+            os.replace(tempPath, path)
+        stat = os.stat(path)
+        cls.fileHashes[path] = (stat.st_mtime, stat.st_size, fileHash)
+        return path
+
+
+"""
+ImageHandle is the value of an image attribute. It only holds the path of the
+image, and gets the decoded QPixmap from EMFAssets when it is drawn, so images
+of DIs that are never drawn are never decoded. The handle doesn't keep the
+QPixmap itself, so EMFAssets can drop it when the cache is full.
+"""
+
+
+class ImageHandle:
+    def __init__(self, path):
+        self.path = path
+        self.fileHash = None
+
+    def getPath(self):
+        return self.path
+
+    # The decoded image, decoding it now if it isn't in the cache
+    def pixmap(self):
+        pixmap = None
+        if self.fileHash is not None:
+            pixmap = EMFAssets.cachedPixmap(self.fileHash)
+        if pixmap is None:
+            self.fileHash, pixmap = EMFAssets.loadPixmap(self.path)
+        return pixmap
+
+    def isDecoded(self):
+        return (self.fileHash is not None and
+                self.fileHash in EMFAssets.pixmaps)
+
+    # Start decoding on a worker thread, ahead of the image being drawn
+    def prefetch(self):
+        if not self.isDecoded():
+            EMFAssets.decodeInBackground(self.path)
+
+    def drop(self):
+        if self.fileHash is not None:
+            EMFAssets.dropPixmap(self.fileHash)
@@ -22,8 +22,9 @@ If not, see <https://www.gnu.org/licenses/>.
 from PyQt5.QtCore import pyqtSignal, Qt
 from PyQt5.QtWidgets import (QWidget, QSlider, QLabel, QHBoxLayout, QCheckBox,
                              QSpinBox, QFileDialog, QPushButton, QDialog)
-from PyQt5.QtGui import QPalette, QPixmap
+from PyQt5.QtGui import QPalette
 
+from EMFAssets import EMFAssets
 from EMFColorPicker import ColorPicker
 
 """
@@ -56,9 +57,15 @@ class EMFAttribute:
         return self.jsonValue
 
     def setValues(self, value, jsonValue):
+        previous = (self.value, self.jsonValue)
+        self.value = value
+        self.jsonValue = jsonValue
+        self.parentDI.valueUpdated(self.name, previous)
+
+    # Set the values without updating the DI, for undoing an edit
+    def restoreValues(self, value, jsonValue):
         self.value = value
         self.jsonValue = jsonValue
-        self.parentDI.valueUpdated(self.name)
 
     def widgetClass(self):
         return self.widgetclass
@@ -66,6 +73,10 @@ class EMFAttribute:
     def widgetParams(self):
         return self.widgetParams
 
+    # True if the json value is the path of an image file
+    def isImagePath(self):
+        return self.widgetclass is FilePickerAttributeWidget
+
 
 """
 The EMFAttributeWidget base class contains the base capabilities needed to
@@ -183,7 +194,7 @@ class FilePickerAttributeWidget(EMFAttributeWidget):
             if "/" in pathName:
                 pathName = pathName.split("/")[-1]
             self.fileLabel.setText(pathName)
-            img = QPixmap(pathToOpen[0])
+            img = EMFAssets.imageHandle(pathToOpen[0])
             self.updateValues(img, pathToOpen[0])
 
 
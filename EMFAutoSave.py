@@ -0,0 +1,652 @@
+"""
+Encounter Mapper Freeform is a node-based encounter map creator for tabletop
+RPGs. Copyright 2020 Eric Symmank
+
+This file is part of Encounter Mapper Freeform.
+
+Encounter Mapper Freeform is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper Freeform is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper Freeform.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+
+from PyQt5.QtCore import QLockFile, QObject, QTimer
+
+from EMFDIValueStore import DIValueStore
+from EMFHistory import AttributeCommand, LayerItemsCommand, MoveNodesCommand
+from EMFNodes import NodeLayer, EMFNode, EMFLine, EMFShape
+
+"""
+AutoSaveJournal keeps an append-only journal of changes to a map in a
+directory, written on a background thread. Each line of the journal is a JSON
+record holding one of:
+
+    Header: the map header (dimensions, DisplayItems, and the ids of the
+        layers in order)
+    Layer, Contents: the full contents of one layer
+    Move: offsets of nodes of a layer, by their index
+    Remove: indexes of nodes, lines, and shapes taken out of a layer
+    Append: JSON of nodes, lines, and shapes added to the end of a layer
+    Attribute: an individual attribute of a DI changing from Previous to
+        Default, and the value it was set to for some items
+
+Replaying the journal from the start with applyRecord() gives the latest
+state of the map. The background thread replays every record as it is
+written, so once the journal holds enough records it can write the latest
+state to a snapshot file and start the journal over, without asking the map
+for anything. recover() reads the snapshot and replays the journal after it,
+returning the JSON of the map.
+
+Items leave out values equal to their DI's individual values, so the state
+also keeps the individual values each layer was written with. A DI's new
+value is only recorded in the header, leaving the layers as they are. Values
+left out are resolved against the header's once, as the map is recovered,
+and only for the layers written with other values.
+
+Every session has files of its own in the directory, named after a random
+session id, and holds a lock file for as long as it runs. Several instances
+can then share the directory. orphanedJournals() only gives the journals of
+sessions that are no longer running, taking their locks so no other instance
+recovers them as well.
+"""
+
+
+class AutoSaveJournal:
+    SNAPSHOT_FILE = "autosave-{}.json"
+    JOURNAL_FILE = "autosave-{}.journal"
+    LOCK_FILE = "autosave-{}.lock"
+    SESSION_FILE = re.compile(r"autosave-([0-9a-f]+)\.(json|journal)")
+    # Compact after this many records, or once the journal is this large
+    COMPACT_RECORDS = 200
+    COMPACT_BYTES = 32 << 20
+    ITEM_LISTS = ("Nodes", "Lines", "Shapes")
+
+    # sessionID picks the files of an earlier session. A new session is
+    # given an id of its own
+    def __init__(self, directory, sessionID=None):
+        self.directory = directory
+        self.sessionID = uuid.uuid4().hex if sessionID is None else sessionID
+        self.snapshotPath = os.path.join(
+            directory, self.SNAPSHOT_FILE.format(self.sessionID))
+        self.journalPath = os.path.join(
+            directory, self.JOURNAL_FILE.format(self.sessionID))
+        self.lockFile = None
+        self.state = AutoSaveJournal.emptyState()
+        self.recordCount = 0
+        self.records = queue.Queue()
+        self.thread = None
+
+    # Take the lock of the session. Returns False if the session is still
+    # running somewhere else
+    def lock(self):
+        if self.lockFile is None:
+            os.makedirs(self.directory, exist_ok=True)
+            lockFile = QLockFile(os.path.join(
+                self.directory, self.LOCK_FILE.format(self.sessionID)))
+            # the lock is held for the whole session, so it is only stale
+            # once the process holding it is gone
+            lockFile.setStaleLockTime(0)
+            if not lockFile.tryLock(0):
+                return False
+            self.lockFile = lockFile
+        return True
+
+    def unlock(self):
+        if self.lockFile is not None:
+            self.lockFile.unlock()
+            self.lockFile = None
+
+    def start(self):
+        if not self.lock():
+            raise RuntimeError(
+                "Autosave session {} is in use".format(self.sessionID))
+        # the journal of the previous map isn't needed anymore
+        self.removeFiles()
+        self.state = AutoSaveJournal.emptyState()
+        self.recordCount = 0
+        self.thread = threading.Thread(target=self.writeRecords, daemon=True)
+        self.thread.start()
+
+    # Queue records to be written by the background thread
+    def submit(self, records):
+        if len(records) > 0:
+            self.records.put(records)
+
+    # Write every queued record, then stop the background thread
+    def stop(self):
+        if self.thread is not None:
+            self.records.put(None)
+            self.thread.join()
+            self.thread = None
+
+    # Stop and remove the journal, after the map was closed normally, or
+    # once the journal of an earlier session was recovered or turned down
+    def discard(self):
+        self.stop()
+        self.removeFiles()
+        self.unlock()
+
+    def removeFiles(self):
+        for path in (self.snapshotPath, self.journalPath):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def writeRecords(self):
+        journal = open(self.journalPath, "a")
+        try:
+            while True:
+                records = self.records.get()
+                if records is None:
+                    break
+                for record in records:
+                    journal.write(self.recordLine(record))
+                    journal.write("\n")
+                journal.flush()
+                os.fsync(journal.fileno())
+                self.recordCount += len(records)
+                if (self.recordCount >= self.COMPACT_RECORDS or
+                        journal.tell() >= self.COMPACT_BYTES):
+                    journal.close()
+                    self.compact()
+                    journal = open(self.journalPath, "w")
+        finally:
+            journal.close()
+
+    # The journal line of record, after applying it to the latest state. A
+    # layer's contents may be given as Text, the JSON text of a layer that
+    # was never loaded, which is only decoded if a later record changes it
+    def recordLine(self, record):
+        if "Text" in record or "Contents" in record:
+            text = record.get("Text")
+            if text is None:
+                text = json.dumps(record["Contents"])
+            self.state["Layers"][str(record["Layer"])] = text
+            self.state["Defaults"][str(record["Layer"])] = (
+                AutoSaveJournal.headerDefaults(self.state))
+            return '{{"Layer": {}, "Contents": {}}}'.format(
+                record["Layer"], text)
+        line = json.dumps(record)
+        # keys become strings once written, so apply what will be read back
+        AutoSaveJournal.applyRecord(json.loads(line), self.state)
+        return line
+
+    # Write the latest state to the snapshot. The journal can then be
+    # emptied, as it only holds changes already in the snapshot
+    def compact(self):
+        header = self.state["Header"]
+        layers = self.state["Layers"]
+        if header is not None:
+            layerIDs = set(str(layerID) for layerID in header["LayerIDs"])
+            for layerID in list(layers):
+                if layerID not in layerIDs:
+                    del layers[layerID]
+                    del self.state["Defaults"][layerID]
+        tempPath = self.snapshotPath + ".tmp"
+        with open(tempPath, "w") as f:
+            f.write('{{"Header": {}, "Defaults": {}, "Layers": {{'.format(
+                json.dumps(header), json.dumps(self.state["Defaults"])))
+            first = True
+            for layerID in layers:
+                if not first:
+                    f.write(", ")
+                first = False
+                contents = layers[layerID]
+                f.write("{}: {}".format(
+                    json.dumps(layerID), contents if isinstance(
+                        contents, str) else json.dumps(contents)))
+            f.write("}}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tempPath, self.snapshotPath)
+        self.recordCount = 0
+
+    # Defaults holds the individual values of the DIs each layer was written
+    # with, see headerDefaults()
+    @classmethod
+    def emptyState(cls):
+        return {"Header": None, "Layers": {}, "Defaults": {}}
+
+    # The individual values of each DI in the header of state, which items
+    # written now leave out
+    @classmethod
+    def headerDefaults(cls, state):
+        if state["Header"] is None:
+            return []
+        return [dijs["individualAttributes"]
+                for dijs in state["Header"]["DisplayItems"]]
+
+    # The layer and every item in the layer contents, each with DIProperties
+    @classmethod
+    def layerItems(cls, contents):
+        items = [contents]
+        for listName in cls.ITEM_LISTS:
+            items.extend(contents[listName])
+        return items
+
+    # The contents of a layer of state, decoding them if they are still text
+    @classmethod
+    def layerContents(cls, state, layerID):
+        key = str(layerID)
+        contents = state["Layers"][key]
+        if isinstance(contents, str):
+            contents = json.loads(contents)
+            state["Layers"][key] = contents
+        return contents
+
+    # Change state, the header and layer contents of a map, by a record
+    # read from a journal
+    @classmethod
+    def applyRecord(cls, record, state):
+        if "Header" in record:
+            state["Header"] = record["Header"]
+        elif "Contents" in record:
+            # keys are strings once written to json, so keep them that way
+            state["Layers"][str(record["Layer"])] = record["Contents"]
+            state["Defaults"][str(record["Layer"])] = cls.headerDefaults(
+                state)
+        elif "Move" in record:
+            nodes = cls.layerContents(state, record["Move"])["Nodes"]
+            for index, (dx, dy) in zip(record["Nodes"], record["Deltas"]):
+                nodes[index]["X"] += dx
+                nodes[index]["Y"] += dy
+        elif "Remove" in record:
+            cls.removeItems(cls.layerContents(state, record["Remove"]),
+                            record)
+        elif "Append" in record:
+            contents = cls.layerContents(state, record["Append"])
+            items = []
+            for listName in cls.ITEM_LISTS:
+                items.extend(record[listName])
+                contents[listName].extend(record[listName])
+            # the items were written with the header's values
+            cls.rebaseItems(items, cls.headerDefaults(state),
+                            state["Defaults"][str(record["Append"])])
+        elif "Attribute" in record:
+            cls.applyAttribute(record, state)
+
+    # Take the items at the indexes of record out of the layer contents. Lines
+    # and shapes refer to nodes by index, so they are numbered again
+    @classmethod
+    def removeItems(cls, contents, record):
+        kept = {}
+        for listName in cls.ITEM_LISTS:
+            removed = set(record[listName])
+            items = contents[listName]
+            kept[listName] = [i for i in range(len(items))
+                              if i not in removed]
+            contents[listName] = [items[i] for i in kept[listName]]
+        if len(record["Nodes"]) > 0:
+            newIndexes = {}
+            for i in range(len(kept["Nodes"])):
+                newIndexes[kept["Nodes"][i]] = i
+            for listName in ("Lines", "Shapes"):
+                for item in contents[listName]:
+                    item["nodes"] = [newIndexes[i] for i in item["nodes"]]
+
+    # The items edited take their values. The DI's own value is in the
+    # header that comes with the record, so the other items are left alone,
+    # and each item only leaves out the value its layer was written with
+    @classmethod
+    def applyAttribute(cls, record, state):
+        diIndex = record["Attribute"]
+        name = record["Name"]
+        for layerID, listName, index, value in record["Items"]:
+            contents = cls.layerContents(state, layerID)
+            item = contents if listName is None else contents[listName][index]
+            values = item["DIProperties"].get(str(diIndex))
+            if values is None:
+                continue
+            layerDefaults = state["Defaults"][str(layerID)]
+            if (diIndex < len(layerDefaults) and not DIValueStore.differs(
+                    value, layerDefaults[diIndex].get(name))):
+                values.pop(name, None)
+            else:
+                values[name] = value
+
+    # Change items written leaving out the individual values old to ones
+    # leaving out new instead. Values that differ are written out in full,
+    # and values equal to new are left out
+    @classmethod
+    def rebaseItems(cls, items, old, new):
+        changed = []
+        for diIndex in range(min(len(old), len(new))):
+            for name in old[diIndex]:
+                if DIValueStore.differs(old[diIndex][name],
+                                        new[diIndex].get(name)):
+                    changed.append((str(diIndex), name, old[diIndex][name],
+                                    new[diIndex].get(name)))
+        if len(changed) == 0:
+            return
+        for item in items:
+            properties = item["DIProperties"]
+            for diKey, name, oldValue, newValue in changed:
+                values = properties.get(diKey)
+                if values is not None:
+                    values.setdefault(name, oldValue)
+                    if not DIValueStore.differs(values[name], newValue):
+                        del values[name]
+
+    # The journals left in directory by sessions that are no longer running,
+    # the most recently changed first. The lock of each one is taken, so it
+    # has to be discarded or unlocked once it is no longer needed
+    @classmethod
+    def orphanedJournals(cls, directory):
+        if not os.path.isdir(directory):
+            return []
+        sessions = {}
+        for name in os.listdir(directory):
+            match = cls.SESSION_FILE.fullmatch(name)
+            if match is not None:
+                modified = os.path.getmtime(os.path.join(directory, name))
+                sessions[match.group(1)] = max(
+                    modified, sessions.get(match.group(1), modified))
+        journals = []
+        for sessionID in sorted(sessions, key=sessions.get, reverse=True):
+            journal = cls(directory, sessionID)
+            if journal.lock():
+                journals.append(journal)
+        return journals
+
+    # The JSON of the map autosaved by this session, or None if there isn't
+    # one
+    def recover(self):
+        state = AutoSaveJournal.emptyState()
+        if os.path.exists(self.snapshotPath):
+            with open(self.snapshotPath, "r") as f:
+                snapshot = json.loads(f.read())
+            state["Header"] = snapshot["Header"]
+            state["Layers"].update(snapshot["Layers"])
+            state["Defaults"].update(snapshot["Defaults"])
+        if os.path.exists(self.journalPath):
+            with open(self.journalPath, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last record may have been cut off by the crash
+                        break
+                    AutoSaveJournal.applyRecord(record, state)
+
+        header = state["Header"]
+        if header is None:
+            return None
+        jsContents = dict(header)
+        layerIDs = jsContents.pop("LayerIDs")
+        defaults = AutoSaveJournal.headerDefaults(state)
+        jsContents["Layers"] = []
+        for layerID in layerIDs:
+            contents = AutoSaveJournal.layerContents(state, layerID)
+            layerDefaults = state["Defaults"][str(layerID)]
+            if layerDefaults != defaults:
+                AutoSaveJournal.rebaseItems(
+                    AutoSaveJournal.layerItems(contents), layerDefaults,
+                    defaults)
+            jsContents["Layers"].append(contents)
+        return jsContents
+
+
+"""
+AutoSave watches a map for changes and records them in an AutoSaveJournal.
+Edits made through the map's EditHistory are journaled as they happen, as
+small records of what the command changed, so a large layer is never turned
+into JSON again just because a few of its nodes moved.
+
+Every layer counts its changes (see NodeLayer.version()), and a command only
+moves the saved version of a layer along if the layer was saved just before
+it. Layers changed some other way are saved in full on the ticks of the
+timer. Their JSON is built STEP_ITEMS items at a time, and once a tick runs
+over TICK_BUDGET seconds the rest is left for the following ticks, so
+editing is never held up for long. A layer that changes before its JSON is
+done is left until the next interval, as it is still being edited. Layers
+that were never loaded are journaled as the text they were read from.
+Writing to disk is left to the journal's background thread.
+"""
+
+
+class AutoSave(QObject):
+    INTERVAL = 30000
+    TICK_BUDGET = 0.05
+    STEP_ITEMS = 2000
+    # the class of each kind of item, its type in the layer, and the name of
+    # its list in the layer JSON
+    ITEM_TYPES = ((EMFNode, NodeLayer.TYPE_NODE, "Nodes"),
+                  (EMFLine, NodeLayer.TYPE_LINE, "Lines"),
+                  (EMFShape, NodeLayer.TYPE_SHAPE, "Shapes"))
+
+    def __init__(self, map, directory, interval=INTERVAL):
+        super(AutoSave, self).__init__()
+        self.journal = AutoSaveJournal(directory)
+        self.interval = interval
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.saveChanges)
+        self.map = None
+        self.setMap(map)
+
+    # Start journaling map, replacing the journal of the previous map
+    def setMap(self, map):
+        self.journal.stop()
+        if self.map is not None:
+            self.map.getHistory().removeListener(self.commandApplied)
+        self.map = map
+        self.layerIDs = {}
+        self.nextLayerID = 0
+        self.savedVersions = {}
+        self.savedHeader = None
+        self.savedDIs = None
+        self.savedDefaults = None
+        self.diIndexes = {}
+        # layer -> (version, steps) of the JSON of a layer being built over
+        # several ticks. See layerSteps()
+        self.snapshots = {}
+        map.getHistory().addListener(self.commandApplied)
+        self.journal.start()
+        self.timer.start(self.interval)
+
+    def layerID(self, layer):
+        if layer not in self.layerIDs:
+            self.layerIDs[layer] = self.nextLayerID
+            self.nextLayerID += 1
+        return self.layerIDs[layer]
+
+    # Layers refer to DIs by index and leave out values equal to the DIs'
+    # individual values, so if either changed every layer needs saving
+    def checkDisplayItems(self):
+        dis = self.map.getDisplayItems()
+        defaults = [di.individualValues() for di in dis]
+        if self.savedDIs != dis or self.savedDefaults != defaults:
+            self.savedVersions = {}
+            self.snapshots = {}
+            self.savedDIs = list(dis)
+            self.savedDefaults = defaults
+            self.diIndexes = {}
+            for i in range(len(dis)):
+                self.diIndexes[dis[i]] = i
+
+    # The record of the header, if it changed since it was last journaled
+    def headerRecords(self):
+        header = {
+            "Width": self.map.getWidth(),
+            "Height": self.map.getHeight(),
+            "CurrentLayer": self.map.getCurrentLayerIndex(),
+            "DisplayItems": [di.jsonObj() for di in self.savedDIs],
+            "SelectedDI": self.map.getSelectedDIIndex(),
+            "LayerIDs": [self.layerID(layer)
+                         for layer in self.map.getLayers()]
+        }
+        if header == self.savedHeader:
+            return []
+        self.savedHeader = header
+        return [{"Header": header}]
+
+    # Journal the header, if it changed, and the layers changed outside of
+    # the history, as far as the tick budget allows
+    def saveChanges(self):
+        start = time.perf_counter()
+        self.checkDisplayItems()
+        records = self.headerRecords()
+        remaining = False
+        for layer in self.map.getLayers():
+            version = layer.version()
+            if self.savedVersions.get(layer) == version:
+                self.snapshots.pop(layer, None)
+                continue
+            snapshot = self.snapshots.get(layer)
+            if snapshot is not None and snapshot[0] != version:
+                # still being edited, so wait for the next interval
+                del self.snapshots[layer]
+                continue
+            if snapshot is None:
+                snapshot = (version, self.layerSteps(layer))
+                self.snapshots[layer] = snapshot
+            record = None
+            for record in snapshot[1]:
+                if record is not None:
+                    break
+                if time.perf_counter() - start > self.TICK_BUDGET:
+                    remaining = True
+                    break
+            if remaining:
+                break
+            del self.snapshots[layer]
+            self.savedVersions[layer] = version
+            records.append(record)
+        self.journal.submit(records)
+        self.timer.start(0 if remaining else self.interval)
+
+    # Yield None after each step of building the layer's record, then the
+    # record itself
+    def layerSteps(self, layer):
+        layerID = self.layerID(layer)
+        if not layer.isLoaded():
+            # the text the layer was read from, without decoding it
+            yield {"Layer": layerID, "Text": layer.jsonText(self.diIndexes)}
+            return
+        for jsContents in layer.jsonSteps(self.diIndexes, self.STEP_ITEMS):
+            if jsContents is None:
+                yield None
+            else:
+                yield {"Layer": layerID, "Contents": jsContents}
+
+    # Journal a command of the history as soon as it is pushed, undone, or
+    # redone. Only layers saved just before the command are journaled this
+    # way. The rest are left to saveChanges()
+    def commandApplied(self, command, undone):
+        if (isinstance(command, AttributeCommand) and
+                command.itemValues is not None and
+                command.di in self.diIndexes):
+            # the DI's value is journaled with the command, so it doesn't
+            # call for saving every layer again
+            value = (command.before if undone else command.after)[0]
+            defaults = self.savedDefaults[self.diIndexes[command.di]]
+            if DIValueStore.differs(defaults.get(command.attrName), value):
+                # layer JSON being built may have left out the old value
+                self.snapshots = {}
+            defaults[command.attrName] = value
+        self.checkDisplayItems()
+        clean = set()
+        for layer in command.layerVersions:
+            if (layer in self.layerIDs and
+                    self.savedVersions.get(layer) ==
+                    command.layerVersions[layer]):
+                clean.add(layer)
+        records = []
+        if isinstance(command, MoveNodesCommand):
+            records = self.moveRecords(command, undone, clean)
+        elif isinstance(command, LayerItemsCommand):
+            records = self.layerItemsRecords(command, undone, clean)
+        elif isinstance(command, AttributeCommand):
+            records = self.attributeRecords(command, undone, clean)
+        for layer in clean:
+            self.savedVersions[layer] = layer.version()
+        self.journal.submit(self.headerRecords() + records)
+
+    def moveRecords(self, command, undone, clean):
+        deltas = -command.deltas if undone else command.deltas
+        moves = {}
+        for node, delta in zip(command.nodes, deltas.tolist()):
+            layer = node.ParentLayer()
+            if layer in clean:
+                indexes, nodeDeltas = moves.setdefault(layer, ([], []))
+                indexes.append(
+                    layer.itemIndexes(NodeLayer.TYPE_NODE)[node])
+                nodeDeltas.append(delta)
+        return [{"Move": self.layerIDs[layer], "Nodes": moves[layer][0],
+                 "Deltas": moves[layer][1]} for layer in moves]
+
+    def layerItemsRecords(self, command, undone, clean):
+        layer = command.layer
+        if layer not in clean:
+            return []
+        layerID = self.layerIDs[layer]
+        if command.added == undone:
+            nodes, lines, shapes = command.removedIndexes
+            return [{"Remove": layerID, "Nodes": nodes, "Lines": lines,
+                     "Shapes": shapes}]
+        record = {"Append": layerID}
+        nodeIndexes = layer.itemIndexes(NodeLayer.TYPE_NODE)
+        for (itemClass, type, listName), start in zip(
+                self.ITEM_TYPES, command.appendStart):
+            items = layer.getList(type)[start:]
+            if type == NodeLayer.TYPE_NODE:
+                record[listName] = [item.jsonObj(self.diIndexes)
+                                    for item in items]
+            else:
+                record[listName] = [item.jsonObj(nodeIndexes,
+                                                 self.diIndexes)
+                                    for item in items]
+        return [record]
+
+    # Changes to shared attributes are only in the header
+    def attributeRecords(self, command, undone, clean):
+        diIndex = self.diIndexes.get(command.di)
+        if command.itemValues is None or diIndex is None:
+            return []
+        before = command.before[0]
+        after = command.after[0]
+        store = command.di.getValueStore()
+        items = []
+        for item, value in command.itemValues:
+            layer = item.ParentLayer()
+            if layer in clean and item in store:
+                items.append(self.itemAddress(layer, item) +
+                             [value if undone else after])
+        return [{"Attribute": diIndex, "Name": command.attrName,
+                 "Previous": after if undone else before,
+                 "Default": before if undone else after,
+                 "Items": items}]
+
+    # The layer id, list name, and index of item, as used by the journal.
+    # The layer itself has no list
+    def itemAddress(self, layer, item):
+        for itemClass, type, listName in self.ITEM_TYPES:
+            if isinstance(item, itemClass):
+                return [self.layerIDs[layer], listName,
+                        layer.itemIndexes(type)[item]]
+        return [self.layerIDs[layer], None, 0]
+
+    # Write any pending changes and stop, keeping the journal on disk
+    def stop(self):
+        self.timer.stop()
+        self.journal.stop()
+
+    # Stop and remove the journal, once the map is closed normally
+    def discard(self):
+        self.timer.stop()
+        self.journal.discard()
@@ -0,0 +1,307 @@
+"""
+Encounter Mapper Freeform is a node-based encounter map creator for tabletop
+RPGs. Copyright 2020 Eric Symmank
+
+This file is part of Encounter Mapper Freeform.
+
+Encounter Mapper Freeform is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper Freeform is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper Freeform.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+from array import array
+import json
+import os
+import struct
+import sys
+
+from DisplayItemPicker import DisplayItemPicker
+from EMFMap import EMFMap
+from EMFNodes import NodeLayer
+
+"""
+EMFBinaryFormat reads and writes the binary .emf encoding. The map settings
+and DisplayItems are stored as a small JSON header, while everything that
+grows with the size of the map is stored as packed little-endian arrays that
+can be read straight into array.array (or numpy.frombuffer):
+
+    magic "EMFB", uint16 version
+    uint32 length, JSON header (Width, Height, CurrentLayer, SelectedDI,
+        DisplayItems, LayerCount)
+    per layer:
+        uint32 nodeCount, lineCount, shapeCount, shapeIndexCount
+        int32[nodeCount * 2] node x, y pairs
+        int32[lineCount * 2] node indexes of each line
+        uint32[shapeCount] number of nodes in each shape
+        int32[shapeIndexCount] node indexes of every shape
+        uint32 bindingCount, then per binding:
+            uint32 DI index, uint8 item type, uint32 itemCount
+            int32[itemCount] indexes of the items in their layer list
+            uint16 columnCount, then per column:
+                uint16 length, UTF-8 attribute name
+                uint8 type code, uint32 length, column data
+
+Column data is one value per item, stored as int32 ("i"), int64 ("q"),
+double ("d"), bool ("?") or, for anything else (including columns that mix
+ints and floats, so each value keeps its type), a JSON list ("j").
+"""
+
+
+class EMFBinaryFormat:
+    MAGIC = b"EMFB"
+    VERSION = 1
+
+    ITEM_TYPES = (NodeLayer.TYPE_NODE, NodeLayer.TYPE_LINE,
+                  NodeLayer.TYPE_SHAPE, "LAYER")
+
+    # True if header (the first bytes of a file) is the binary encoding
+    @classmethod
+    def isBinary(cls, header):
+        return header[:len(cls.MAGIC)] == cls.MAGIC
+
+    # ////// #
+    # SAVING #
+    # ////// #
+
+    @classmethod
+    def writeMap(cls, map, f):
+        dis = map.getDisplayItems()
+        layers = map.getLayers()
+        header = {
+            "Width": map.getWidth(),
+            "Height": map.getHeight(),
+            "CurrentLayer": map.getCurrentLayerIndex(),
+            "SelectedDI": map.getSelectedDIIndex(),
+            "DisplayItems": [di.jsonObj() for di in dis],
+            "LayerCount": len(layers)
+        }
+        f.write(cls.MAGIC)
+        f.write(struct.pack("<H", cls.VERSION))
+        cls.writeBytes(f, json.dumps(header).encode("utf-8"), "<I")
+        # the values of every layer's items are only in the DIs once loaded
+        for layer in layers:
+            layer.ensureLoaded()
+        diRows = [cls.layerRows(di.getValueStore()) for di in dis]
+        for layer in layers:
+            cls.writeLayer(f, layer, diRows)
+
+    # The items and columns of store, and the positions in them of the items
+    # of each layer, so a save only goes through each store once
+    @classmethod
+    def layerRows(cls, store):
+        storeItems = store.items()
+        layerPositions = {}
+        for pos in range(len(storeItems)):
+            item = storeItems[pos]
+            layer = (item if isinstance(item, NodeLayer)
+                     else item.ParentLayer())
+            if layer is not None:
+                layerPositions.setdefault(layer, []).append(pos)
+        columns = {}
+        for name in store.attributeNames():
+            columns[name] = store.columnValues(name)
+        return storeItems, columns, layerPositions
+
+    # diRows holds the layerRows() of each DI
+    @classmethod
+    def writeLayer(cls, f, layer, diRows):
+        nodes = layer.getList(NodeLayer.TYPE_NODE)
+        lines = layer.getList(NodeLayer.TYPE_LINE)
+        shapes = layer.getList(NodeLayer.TYPE_SHAPE)
+        nodeIndexes = cls.indexMap(nodes)
+
+        coords = array("i")
+        for node in nodes:
+            coords.append(node.x())
+            coords.append(node.y())
+        lineIndexes = array("i")
+        for line in lines:
+            for node in line.nodes():
+                lineIndexes.append(nodeIndexes[node])
+        shapeSizes = array("I")
+        shapeIndexes = array("i")
+        for shape in shapes:
+            shapeSizes.append(len(shape.nodes()))
+            for node in shape.nodes():
+                shapeIndexes.append(nodeIndexes[node])
+
+        f.write(struct.pack("<IIII", len(nodes), len(lines), len(shapes),
+                            len(shapeIndexes)))
+        for data in (coords, lineIndexes, shapeSizes, shapeIndexes):
+            cls.writeArray(f, data)
+
+        itemIndexes = {
+            NodeLayer.TYPE_NODE: nodeIndexes,
+            NodeLayer.TYPE_LINE: cls.indexMap(lines),
+            NodeLayer.TYPE_SHAPE: cls.indexMap(shapes),
+            "LAYER": {layer: 0}
+        }
+        bindings = []
+        for diIndex in range(len(diRows)):
+            storeItems, columns, layerPositions = diRows[diIndex]
+            layerRows = layerPositions.get(layer, [])
+            for typeCode in range(len(cls.ITEM_TYPES)):
+                indexes = itemIndexes[cls.ITEM_TYPES[typeCode]]
+                # positions in storeItems of the items in this layer list
+                positions = [pos for pos in layerRows
+                             if storeItems[pos] in indexes]
+                if len(positions) > 0:
+                    bindings.append((diIndex, typeCode, positions,
+                                     [indexes[storeItems[pos]]
+                                      for pos in positions]))
+
+        f.write(struct.pack("<I", len(bindings)))
+        for diIndex, typeCode, positions, indexes in bindings:
+            columns = diRows[diIndex][1]
+            f.write(struct.pack("<IBI", diIndex, typeCode, len(indexes)))
+            cls.writeArray(f, array("i", indexes))
+            f.write(struct.pack("<H", len(columns)))
+            for name in columns:
+                values = columns[name]
+                cls.writeBytes(f, name.encode("utf-8"), "<H")
+                cls.writeColumn(f, [values[pos] for pos in positions])
+
+    @classmethod
+    def writeColumn(cls, f, values):
+        typeCode = cls.columnType(values)
+        if typeCode == "j":
+            data = json.dumps(values).encode("utf-8")
+        elif typeCode == "?":
+            data = bytes(array("B", values))
+        else:
+            data = cls.arrayBytes(array(typeCode, values))
+        f.write(typeCode.encode("ascii"))
+        cls.writeBytes(f, data, "<I")
+
+    # Choose the smallest type code that holds every value of a column
+    @classmethod
+    def columnType(cls, values):
+        if all(type(v) is bool for v in values):
+            return "?"
+        if all(type(v) is int for v in values):
+            if all(-2**31 <= v < 2**31 for v in values):
+                return "i"
+            if all(-2**63 <= v < 2**63 for v in values):
+                return "q"
+        elif all(type(v) is float for v in values):
+            return "d"
+        return "j"
+
+    @classmethod
+    def writeBytes(cls, f, data, lengthFormat):
+        f.write(struct.pack(lengthFormat, len(data)))
+        f.write(data)
+
+    @classmethod
+    def writeArray(cls, f, data):
+        f.write(cls.arrayBytes(data))
+
+    @classmethod
+    def arrayBytes(cls, data):
+        if sys.byteorder != "little":
+            data = array(data.typecode, data)
+            data.byteswap()
+        return data.tobytes()
+
+    @classmethod
+    def indexMap(cls, items):
+        indexes = {}
+        for i in range(len(items)):
+            indexes[items[i]] = i
+        return indexes
+
+    # /////// #
+    # LOADING #
+    # /////// #
+
+    # size is the size of the file, needed when f is decompressed as it is
+    # read
+    @classmethod
+    def readMap(cls, f, progress=None, size=None):
+        if not cls.isBinary(f.read(len(cls.MAGIC))):
+            raise ValueError("Not a binary Encounter Mapper Freeform file")
+        version = struct.unpack("<H", f.read(2))[0]
+        if version > cls.VERSION:
+            raise ValueError("Unsupported file version {}".format(version))
+        header = json.loads(cls.readBytes(f, "<I").decode("utf-8"))
+        displayItems = []
+        for dijs in header["DisplayItems"]:
+            displayItems.append(DisplayItemPicker.diFromJSON(dijs))
+        width = header["Width"] * NodeLayer.CELL_SIZE
+        height = header["Height"] * NodeLayer.CELL_SIZE
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        layers = []
+        for i in range(header["LayerCount"]):
+            layers.append(cls.readLayer(f, displayItems, width, height))
+            if progress is not None:
+                progress(f.tell(), size)
+        return EMFMap(header["Width"], header["Height"], layers,
+                      displayItems, header["CurrentLayer"],
+                      header["SelectedDI"])
+
+    @classmethod
+    def readLayer(cls, f, displayItems, width, height):
+        nodeCount, lineCount, shapeCount, shapeIndexCount = struct.unpack(
+            "<IIII", f.read(16))
+        coords = cls.readArray(f, "i", nodeCount * 2)
+        lineIndexes = cls.readArray(f, "i", lineCount * 2)
+        shapeSizes = cls.readArray(f, "I", shapeCount)
+        shapeIndexes = cls.readArray(f, "i", shapeIndexCount)
+
+        layer = NodeLayer(width, height)
+        layer.addItemsFromArrays(coords, lineIndexes, shapeSizes,
+                                 shapeIndexes)
+
+        bindings = []
+        bindingCount = struct.unpack("<I", f.read(4))[0]
+        for b in range(bindingCount):
+            diIndex, typeCode, itemCount = struct.unpack("<IBI", f.read(9))
+            indexes = cls.readArray(f, "i", itemCount)
+            columnCount = struct.unpack("<H", f.read(2))[0]
+            columns = {}
+            for c in range(columnCount):
+                name = cls.readBytes(f, "<H").decode("utf-8")
+                columns[name] = cls.readColumn(f, itemCount)
+            bindings.append((diIndex, typeCode, indexes, columns))
+        layer.bindColumns(displayItems, bindings)
+        return layer
+
+    @classmethod
+    def readColumn(cls, f, count):
+        typeCode = f.read(1).decode("ascii")
+        data = cls.readBytes(f, "<I")
+        if typeCode == "j":
+            return json.loads(data.decode("utf-8"))
+        if typeCode == "?":
+            return [v != 0 for v in data]
+        values = array(typeCode)
+        values.frombytes(data)
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values.tolist()
+
+    @classmethod
+    def readBytes(cls, f, lengthFormat):
+        size = struct.calcsize(lengthFormat)
+        length = struct.unpack(lengthFormat, f.read(size))[0]
+        return f.read(length)
+
+    @classmethod
+    def readArray(cls, f, typeCode, count):
+        values = array(typeCode)
+        values.frombytes(f.read(count * values.itemsize))
+        if len(values) != count:
+            raise ValueError("Unexpected end of file")
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values
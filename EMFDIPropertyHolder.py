@@ -26,6 +26,9 @@ DisplayItem. Its children are EMFNode, EMFLine, EMFShape, and NodeLayer. The
 class contains functionality to add DisplayItems to a list, store and update
 values for the individual attributes, and update the parent layer when a
 value has been updated to allow the layer to be redrawn.
+
+The values themselves are kept in each DisplayItem's DIValueStore.
+diProperties maps each DisplayItem of the holder to that store.
 """
 
 
@@ -42,25 +45,26 @@ class DIPropertyHolder(QObject):
     def currentDIs(self):
         return list(self.diProperties.keys())
 
+    # Add the values for di. Any attributes missing from values use the DI's
+    # current individual attribute values
     def addIndividualAttributes(self, di, values=None):
-        # wat
         if di not in self.diProperties:
-            attrValues = values
-            if attrValues is None:
-                attrValues = {}
-                diAttr = di.getIndividualAttributes()
-                for attrStr in diAttr:
-                    attrValues[attrStr] = diAttr[attrStr].getValue()
-            self.diProperties[di] = attrValues
-            if self.parentLayer is not None:
-                self.parentLayer.setNeedRedraw()
+            di.getValueStore().addItem(self, values)
+            self.joinValueStore(di)
+
+    # Join di once its value store already holds the values for this item
+    def joinValueStore(self, di):
+        self.diProperties[di] = di.getValueStore()
+        if self.parentLayer is not None:
+            self.parentLayer.setNeedRedraw()
 
     def sharedAttributeUpdated(self):
         self.parentLayer.setNeedRedraw()
 
     def updateAttribute(self, di, attr):
         if di in self.diProperties:
-            self.diProperties[di][attr.getName()] = attr.getValue()
+            self.diProperties[di].setValue(
+                self, attr.getName(), attr.getValue())
             if self.parentLayer is not None:
                 self.parentLayer.setNeedRedraw()
 
@@ -76,22 +80,21 @@ class DIPropertyHolder(QObject):
             self.diProperties.pop(di)
             self.parentLayer.setNeedRedraw()
 
+    # A read-only mapping of the attribute values for di, or None
     def diValues(self, di):
         values = None
         if di in self.diProperties:
-            values = self.diProperties[di]
+            values = self.diProperties[di].row(self)
         return values
 
     def ParentLayer(self):
         return self.parentLayer
 
+    # Only values differing from the DI's individual attribute values are
+    # saved. Loading fills in the rest from the DI
     def indivAttributesJSON(self, diIndexes):
         properties = {}
         for di in self.diProperties:
-            propertyJS = {}
-            # Fill in PropertyJS
-            for attr in self.diProperties[di]:
-                # print(attr)
-                propertyJS[attr] = self.diProperties[di][attr]
-            properties[diIndexes[di]] = propertyJS
+            properties[diIndexes[di]] = self.diProperties[di].changedValues(
+                self)
         return properties
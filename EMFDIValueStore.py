@@ -0,0 +1,265 @@
+"""
+Encounter Mapper Freeform is a node-based encounter map creator for tabletop
+RPGs. Copyright 2020 Eric Symmank
+
+This file is part of Encounter Mapper Freeform.
+
+Encounter Mapper Freeform is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper Freeform is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper Freeform.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+from collections.abc import Mapping
+
+"""
+The DIValueStore holds the individual attribute values of every item joined to
+a single DisplayItem. Each item is given a slot, and each attribute is a column
+with one value per slot. A column is only created once an item's value differs
+from the value shared by the rest of the items, so a DI where every item
+keeps the default values only stores the defaults once.
+
+Slots of removed items are left empty and reused on the next compaction, which
+keeps the order items were added in. items() and columnValues() read the live
+slots in that order, and setValues()/setColumnValues() write them in bulk.
+"""
+
+
+class DIValueStore:
+    # Compact when at least this many slots, and half of all slots, are empty
+    COMPACT_MIN = 64
+
+    def __init__(self, displayItem):
+        self.displayItem = displayItem
+        self.slotItems = []
+        self.itemSlots = {}
+        # name -> value shared by every slot, for columns not yet created
+        self.defaults = {}
+        # name -> list with a value per slot
+        self.columns = {}
+        self.emptySlots = 0
+
+    def __contains__(self, item):
+        return item in self.itemSlots
+
+    def __len__(self):
+        return len(self.itemSlots)
+
+    # Add an item with the DI's current individual values, updated by values
+    def addItem(self, item, values=None):
+        if item in self.itemSlots:
+            return False
+        row = {}
+        diAttr = self.displayItem.getIndividualAttributes()
+        for attrStr in diAttr:
+            row[attrStr] = diAttr[attrStr].getValue()
+        if values is not None:
+            row.update(values)
+
+        for name in row:
+            value = row[name]
+            if name not in self.defaults:
+                # earlier items never had this attribute. Share this value
+                self.defaults[name] = value
+            column = self.columns.get(name)
+            if column is None and DIValueStore.differs(
+                    value, self.defaults[name]):
+                column = self.createColumn(name)
+            if column is not None:
+                column.append(value)
+        for name in self.columns:
+            if name not in row:
+                self.columns[name].append(self.defaults[name])
+
+        self.itemSlots[item] = len(self.slotItems)
+        self.slotItems.append(item)
+        return True
+
+    # Add many new items at once. columns maps names to a list of values in
+    # the same order as items. Missing attributes use the DI's current values
+    def addItemsFromColumns(self, items, columns):
+        count = len(items)
+        if count == 0:
+            # an empty column has no first value to share
+            return
+        diAttr = self.displayItem.getIndividualAttributes()
+        names = dict.fromkeys(diAttr)
+        names.update(dict.fromkeys(columns))
+        names.update(dict.fromkeys(self.columns))
+        for name in names:
+            values = columns.get(name)
+            if values is None:
+                if name in diAttr:
+                    value = diAttr[name].getValue()
+                else:
+                    value = self.defaults[name]
+                values = [value] * count
+            elif len(values) != count:
+                raise ValueError("Expected {} values for {}, got {}".format(
+                    count, name, len(values)))
+            if name not in self.defaults:
+                self.defaults[name] = values[0]
+            column = self.columns.get(name)
+            if column is None:
+                default = self.defaults[name]
+                if any(DIValueStore.differs(value, default)
+                       for value in values):
+                    column = self.createColumn(name)
+            if column is not None:
+                column.extend(values)
+
+        start = len(self.slotItems)
+        for slot in range(count):
+            self.itemSlots[items[slot]] = start + slot
+        self.slotItems.extend(items)
+
+    def removeItem(self, item):
+        slot = self.itemSlots.pop(item, None)
+        if slot is None:
+            return False
+        self.slotItems[slot] = None
+        self.emptySlots += 1
+        # trailing empty slots can be dropped right away
+        while len(self.slotItems) > 0 and self.slotItems[-1] is None:
+            self.slotItems.pop()
+            for column in self.columns.values():
+                column.pop()
+            self.emptySlots -= 1
+        if (self.emptySlots >= DIValueStore.COMPACT_MIN and
+                self.emptySlots * 2 >= len(self.slotItems)):
+            self.compact()
+        return True
+
+    # Remove the empty slots left by removed items
+    def compact(self):
+        if self.emptySlots > 0:
+            live = [slot for slot in range(len(self.slotItems))
+                    if self.slotItems[slot] is not None]
+            self.slotItems = [self.slotItems[slot] for slot in live]
+            for name in self.columns:
+                column = self.columns[name]
+                self.columns[name] = [column[slot] for slot in live]
+            self.itemSlots = {}
+            for slot in range(len(self.slotItems)):
+                self.itemSlots[self.slotItems[slot]] = slot
+            self.emptySlots = 0
+
+    # All items in the order they were added
+    def items(self):
+        if self.emptySlots == 0:
+            return list(self.slotItems)
+        return [item for item in self.slotItems if item is not None]
+
+    def attributeNames(self):
+        return list(self.defaults)
+
+    def value(self, item, name):
+        column = self.columns.get(name)
+        if column is None:
+            return self.defaults[name]
+        return column[self.itemSlots[item]]
+
+    def setValue(self, item, name, value):
+        self.setValues((item,), name, value)
+
+    # Set a single attribute to the same value for multiple items
+    def setValues(self, items, name, value):
+        if name not in self.defaults:
+            self.defaults[name] = value
+        column = self.columns.get(name)
+        for item in items:
+            slot = self.itemSlots[item]
+            if column is None:
+                if not DIValueStore.differs(value, self.defaults[name]):
+                    continue
+                column = self.createColumn(name)
+            column[slot] = value
+
+    # The values of item that differ from the DI's current individual
+    # attribute values. Items added without a value get the DI's value, so
+    # these are the only values that need saving
+    def changedValues(self, item):
+        slot = self.itemSlots[item]
+        diAttr = self.displayItem.getIndividualAttributes()
+        values = {}
+        for name in self.defaults:
+            column = self.columns.get(name)
+            value = self.defaults[name] if column is None else column[slot]
+            if name not in diAttr or DIValueStore.differs(
+                    value, diAttr[name].getValue()):
+                values[name] = value
+        return values
+
+    # Values of an attribute, in the same order as items()
+    def columnValues(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            return [self.defaults[name]] * len(self.itemSlots)
+        if self.emptySlots == 0:
+            return list(column)
+        return [column[slot] for slot in range(len(column))
+                if self.slotItems[slot] is not None]
+
+    # Set an attribute for every item. values is in the same order as items()
+    def setColumnValues(self, name, values):
+        self.compact()
+        if len(values) != len(self.slotItems):
+            raise ValueError("Expected {} values for {}, got {}".format(
+                len(self.slotItems), name, len(values)))
+        if len(values) > 0:
+            self.defaults.setdefault(name, values[0])
+            self.columns[name] = list(values)
+
+    def row(self, item):
+        return DIValueRow(self, item)
+
+    # A copy of the values of a single item
+    def rowDict(self, item):
+        slot = self.itemSlots[item]
+        values = dict(self.defaults)
+        for name in self.columns:
+            values[name] = self.columns[name][slot]
+        return values
+
+    def createColumn(self, name):
+        column = [self.defaults[name]] * len(self.slotItems)
+        self.columns[name] = column
+        return column
+
+    # bools and ints compare equal, but should not share a default
+    @classmethod
+    def differs(cls, a, b):
+        return type(a) is not type(b) or a != b
+
+
+"""
+DIValueRow is a read-only mapping of one item's values in a DIValueStore. It is
+what DIPropertyHolder.diValues() returns, and reads straight from the columns
+instead of copying them. copy.copy() returns a plain dict.
+"""
+
+
+class DIValueRow(Mapping):
+    def __init__(self, store, item):
+        self.store = store
+        self.item = item
+
+    def __getitem__(self, name):
+        return self.store.value(self.item, name)
+
+    def __iter__(self):
+        return iter(self.store.defaults)
+
+    def __len__(self):
+        return len(self.store.defaults)
+
+    def __copy__(self):
+        return self.store.rowDict(self.item)
@@ -19,8 +19,36 @@ along with Encounter Mapper Freeform.
 If not, see <https://www.gnu.org/licenses/>.
 """
 import unittest
+import copy
+import json
+import math
+import os
+import tempfile
+import zipfile
+from xml.dom import minidom
+
+import numpy
 
 from EMFNodes import EMFNodeHelper, EMFNode, EMFLine, EMFShape, NodeLayer
+from EMFSelection import EMFSelection
+from EMFNodeDisplayItems import ColorCircleDisplay
+from EMFTransform import NodeTransform
+from EMFShapeDisplayItems import ColorShapeDisplay
+from EMFSpecialDisplay import GridDisplay
+from EMFMap import EMFMap
+from EMFMapIO import EMFMapIO
+from EMFJSONStream import JSONStreamReader
+from EMFLayerParser import LayerParser
+from EMFExporter import MapExporter, TexturePainter
+from EMFAutoSave import AutoSave, AutoSaveJournal
+from EMFAssets import EMFAssets
+from EMFRenderCache import RenderCache
+from EMFHistory import EditHistory, LayerItemsCommand, MoveNodesCommand
+from EMFNodeDisplayItems import ImageDisplay
+from EMFSpecialDisplay import ImageBGDisplay
+from EMFShapeDisplayItems import ImageShapeDisplay
+from PyQt5.QtGui import QImage, QColor, QPainter
+from PyQt5.QtWidgets import QApplication
 
 
 """
@@ -459,6 +487,21 @@ class EMFShapeTests(unittest.TestCase):
         shape = EMFShape.createFromJSON(shapeJSON, nodes, [])
         self.assertEqual(shape.jsonObj(nodeList, {}), shapeJSON)
 
+    # test that the shape geometry is cached until one of its nodes moves
+    def test_shapeGeometryCache(self):
+        nodes = [EMFNode(0, 0), EMFNode(10, 0), EMFNode(10, 10),
+                 EMFNode(0, 10)]
+        shape = EMFShape(nodes)
+        poly = shape.poly()
+        self.assertIs(shape.poly(), poly)
+        self.assertEqual(shape.area(), 100)
+        self.assertEqual((shape.centroid().x(), shape.centroid().y()),
+                         (5, 5))
+        nodes[2].moveTo(20, 10)
+        self.assertIsNot(shape.poly(), poly)
+        self.assertEqual(shape.bounds().width(), 21)
+        self.assertEqual(shape.area(), 150)
+
 
 """
 EMFNodeLayerTests tests the builtin functionality of interacting with nodes,
@@ -517,5 +560,1270 @@ class EMFNodeLayerTests(unittest.TestCase):
         self.assertEqual(nl.jsonObj({}), nlJSON)
 
 
+
+"""
+EMFTopologyTests tests the line and shape lookups that nodes keep of the lines
+and shapes connected to them
+"""
+
+
+class EMFTopologyTests(unittest.TestCase):
+    # test finding lines and neighbors as lines are created and deleted
+    def test_lineLookup(self):
+        nodes = [EMFNode(0, 0), EMFNode(10, 0), EMFNode(10, 10)]
+        line = EMFLine(nodes[0], nodes[1])
+        NodeLayer(100, 100, nodes, [line])
+        self.assertEqual(EMFNodeHelper.existingLine(nodes[1], nodes[0]),
+                         {line})
+        self.assertEqual(EMFNodeHelper.existingLine(nodes[0], nodes[2]),
+                         set())
+        self.assertEqual(set(nodes[0].connectedNodes()), {nodes[1]})
+        line.lineDeleted()
+        self.assertIsNone(nodes[0].lineTo(nodes[1]))
+        self.assertEqual(len(nodes[1].connectedNodes()), 0)
+
+    # test that shapes reuse existing lines and can be found by their nodes
+    def test_shapeLookup(self):
+        nodes = [EMFNode(0, 0), EMFNode(10, 0), EMFNode(10, 10)]
+        line = EMFLine(nodes[0], nodes[1])
+        shape = EMFShape(list(nodes))
+        NodeLayer(100, 100, nodes, shape.lines(), [shape])
+        self.assertTrue(line in shape.lines())
+        self.assertEqual(len(nodes[0].getLines()), 2)
+        self.assertIs(EMFNodeHelper.existingShape(
+            [nodes[2], nodes[0], nodes[1]]), shape)
+        self.assertIsNone(EMFNodeHelper.existingShape(
+            [nodes[0], nodes[1], EMFNode(0, 10)]))
+        shape.shapeDeleted()
+        self.assertIsNone(EMFNodeHelper.existingShape(nodes))
+
+
+"""
+EMFTransformTests tests transforming groups of nodes with a NodeTransform, and
+that the results match transforming each node on its own with the rounded
+per-node math of the original EMFNode transforms
+"""
+
+
+class EMFTransformTests(unittest.TestCase):
+    # Helper method to create a spread of nodes around (50, 50)
+    def createNodes(self):
+        nodes = []
+        for x in range(0, 100, 7):
+            for y in range(0, 100, 11):
+                nodes.append(EMFNode(x, y))
+        return nodes
+
+    # Helper giving where a node is moved to by a transform, worked out on
+    # its own from the angle and distance to median
+    def expectedPosition(self, node, median, method, value):
+        if method == "grab":
+            return (node.x() + value[0], node.y() + value[1])
+        if method == "rotate":
+            comparison = EMFNodeHelper.nodeComparison(median, node, True)
+            angle = math.radians(comparison[2] + value)
+            return (int(round(median.x() + comparison[3] * math.cos(angle))),
+                    int(round(median.y() + comparison[3] * math.sin(angle))))
+        return (int(round(median.x() + (node.x() - median.x()) * value)),
+                int(round(median.y() + (node.y() - median.y()) * value)))
+
+    # Helper to compare a NodeTransform, of a group and of single nodes,
+    # with transforming each node on its own
+    def compareTransform(self, method, value):
+        median = EMFNode(50, 50)
+        nodes = self.createNodes()
+        expected = [self.expectedPosition(node, median, method, value)
+                    for node in nodes]
+        transform = NodeTransform(nodes, median)
+        getattr(transform, method)(value)
+        transform.apply()
+        self.assertEqual([(n.x(), n.y()) for n in nodes], expected)
+
+        single = []
+        for node in self.createNodes():
+            node.beginTransform(median)
+            getattr(node, method)(value)
+            node.applyTransform()
+            single.append((node.x(), node.y()))
+        self.assertEqual(single, expected)
+
+    def test_groupGrab(self):
+        self.compareTransform("grab", (13, -7))
+
+    def test_groupRotate(self):
+        for angle in (0, 45, 90, 180, 270, -33):
+            with self.subTest(angle=angle):
+                self.compareTransform("rotate", angle)
+
+    def test_groupScale(self):
+        for size in (0, 0.5, 1, 2, 1.37):
+            with self.subTest(size=size):
+                self.compareTransform("scale", size)
+
+    # test that cancelling returns all nodes to their starting positions
+    def test_groupCancel(self):
+        nodes = self.createNodes()
+        start = [(n.x(), n.y()) for n in nodes]
+        transform = NodeTransform(nodes, EMFNode(50, 50))
+        transform.rotate(90)
+        transform.scale(2)
+        transform.cancel()
+        self.assertEqual([(n.x(), n.y()) for n in nodes], start)
+
+
+"""
+EMFSelectionTests tests the ordered set used to hold the selected items of an
+EMFMap, and that its version changes whenever the selection does.
+"""
+
+
+class EMFSelectionTests(unittest.TestCase):
+    # test that items keep their selection order and are not duplicated
+    def test_selectionOrder(self):
+        nodes = [EMFNode(0, 0), EMFNode(10, 0), EMFNode(10, 10)]
+        selection = EMFSelection()
+        selection.add(nodes[2])
+        selection.addItems([nodes[0], nodes[2], nodes[1]])
+        self.assertEqual(selection.items(), [nodes[2], nodes[0], nodes[1]])
+        self.assertEqual(len(selection), 3)
+        self.assertTrue(nodes[1] in selection)
+
+    # test removing single and multiple items from the selection
+    def test_selectionRemove(self):
+        nodes = [EMFNode(0, 0), EMFNode(10, 0), EMFNode(10, 10)]
+        selection = EMFSelection(nodes)
+        self.assertTrue(selection.remove(nodes[1]))
+        self.assertFalse(selection.remove(nodes[1]))
+        self.assertEqual(selection.items(), [nodes[0], nodes[2]])
+        selection.removeItems([nodes[0], nodes[1]])
+        self.assertEqual(selection.items(), [nodes[2]])
+
+    # test that the version only changes when the selection changes
+    def test_selectionVersion(self):
+        nodes = [EMFNode(0, 0), EMFNode(10, 0)]
+        selection = EMFSelection()
+        version = selection.version()
+        selection.addItems(nodes)
+        self.assertNotEqual(selection.version(), version)
+        version = selection.version()
+        selection.add(nodes[0])
+        selection.removeItems([EMFNode(5, 5)])
+        self.assertEqual(selection.version(), version)
+        selection.setItems(selection)
+        self.assertEqual(selection.items(), nodes)
+        self.assertNotEqual(selection.version(), version)
+        version = selection.version()
+        selection.clear()
+        self.assertEqual(len(selection), 0)
+        self.assertNotEqual(selection.version(), version)
+
+
+
+"""
+EMFDIValueStoreTests tests storing the individual attribute values of a
+DisplayItem's items in columns, and reading them back through diValues()
+"""
+
+
+class EMFDIValueStoreTests(unittest.TestCase):
+    # Helper method to create a layer of nodes joined to a new DI
+    def createDINodes(self, count):
+        di = ColorCircleDisplay("Circles")
+        nodes = []
+        for i in range(count):
+            nodes.append(EMFNode(i, i))
+        NodeLayer(100, 100, nodes)
+        di.addItems(nodes)
+        return di, nodes
+
+    # test that items sharing the default values don't create any columns
+    def test_sharedDefaults(self):
+        di, nodes = self.createDINodes(3)
+        store = di.getValueStore()
+        self.assertEqual(store.columns, {})
+        self.assertEqual(dict(nodes[1].diValues(di)),
+                         {"Size": 24, "Opacity": 100})
+        self.assertEqual(store.columnValues("Size"), [24, 24, 24])
+
+    # test that overriding a value only affects the given item
+    def test_overrideValue(self):
+        di, nodes = self.createDINodes(3)
+        nodes[1].updateAttribute(di, di.getIndividualAttributes()["Size"])
+        di.getValueStore().setValues(nodes[:2], "Opacity", 50)
+        self.assertEqual(nodes[0].diValues(di)["Opacity"], 50)
+        self.assertEqual(nodes[2].diValues(di)["Opacity"], 100)
+        values = copy.copy(nodes[0].diValues(di))
+        self.assertEqual(values, {"Size": 24, "Opacity": 50})
+        self.assertIsInstance(values, dict)
+
+    # test that removing items keeps the remaining values and their order
+    def test_removeItems(self):
+        di, nodes = self.createDINodes(200)
+        store = di.getValueStore()
+        for i in range(len(nodes)):
+            store.setValue(nodes[i], "Size", i)
+        for node in nodes[:150]:
+            node.removeDI(di)
+        self.assertEqual(di.getPropertyItems(), nodes[150:])
+        self.assertEqual(store.columnValues("Size"), list(range(150, 200)))
+        self.assertEqual(nodes[160].diValues(di)["Size"], 160)
+        self.assertIsNone(nodes[0].diValues(di))
+
+    # test saving and loading values with a layer's json representation
+    def test_layerJSONValues(self):
+        di, nodes = self.createDINodes(2)
+        di.getValueStore().setValue(nodes[1], "Size", 48)
+        layerJSON = nodes[0].ParentLayer().jsonObj({di: 0})
+        loadDI = ColorCircleDisplay("Circles")
+        layer = NodeLayer.createFromJSON(layerJSON, [loadDI], 100, 100)
+        loaded = layer.getList(NodeLayer.TYPE_NODE)
+        self.assertEqual(loadDI.getPropertyItems(), loaded)
+        self.assertEqual(loadDI.getValueStore().columnValues("Size"),
+                         [24, 48])
+
+    # test that adding no items, with columns the DI doesn't have, is ignored
+    def test_addNoItems(self):
+        di, nodes = self.createDINodes(0)
+        store = di.getValueStore()
+        store.addItemsFromColumns([], {"Size": [], "Unknown": []})
+        self.assertEqual(len(store), 0)
+        self.assertNotIn("Unknown", store.attributeNames())
+
+
+# Helper function to grab a single node by offset
+def moveNode(node, offset):
+    node.beginTransform(node)
+    node.grab(offset)
+    node.applyTransform()
+
+
+# Helper function to create a map with nodes, lines, shapes and DIs
+def createTestMap():
+    nodes = [EMFNode(0, 0), EMFNode(72, 0), EMFNode(72, 72),
+             EMFNode(-30, 2**20)]
+    lines = [EMFLine(nodes[0], nodes[1]), EMFLine(nodes[1], nodes[2])]
+    shape = EMFShape(nodes[:3])
+    layer = NodeLayer(720, 720, nodes, lines, [shape])
+    circles = ColorCircleDisplay("Circles")
+    shapes = ColorShapeDisplay("Shapes")
+    grid = GridDisplay("Grid")
+    circles.addItems(nodes)
+    circles.getValueStore().setValue(nodes[2], "Size", 10.5)
+    circles.getValueStore().setValue(nodes[3], "Opacity", 20)
+    shapes.addItem(shape)
+    grid.addItem(layer)
+    return EMFMap(10, 10, [layer, NodeLayer(720, 720)],
+                  [circles, shapes, grid], 1, 2)
+
+
+"""
+EMFMapIOTests tests saving maps to both .emf formats and opening them again
+"""
+
+
+class EMFMapIOTests(unittest.TestCase):
+    def saveAndLoad(self, map, fileFormat):
+        handle, path = tempfile.mkstemp(suffix=".emf")
+        os.close(handle)
+        try:
+            EMFMapIO.saveMap(map, path, fileFormat)
+            return EMFMapIO.loadMap(path)
+        finally:
+            os.remove(path)
+
+    # test that both formats load back the same map that was saved
+    def test_roundTrip(self):
+        map = createTestMap()
+        expected = json.dumps(map.jsonObj())
+        for fileFormat in (EMFMapIO.FORMAT_JSON, EMFMapIO.FORMAT_BINARY):
+            with self.subTest(fileFormat=fileFormat):
+                loaded = self.saveAndLoad(map, fileFormat)
+                self.assertEqual(json.dumps(loaded.jsonObj()), expected)
+
+    # test that values of the binary columns keep their types
+    def test_binaryColumns(self):
+        loaded = self.saveAndLoad(createTestMap(), EMFMapIO.FORMAT_BINARY)
+        circles = loaded.getDisplayItems()[0]
+        nodes = loaded.getLayers()[0].getList(NodeLayer.TYPE_NODE)
+        self.assertEqual(nodes[3].y(), 2**20)
+        self.assertEqual(circles.getPropertyItems(), nodes)
+        self.assertEqual(nodes[2].diValues(circles)["Size"], 10.5)
+        self.assertEqual(nodes[3].diValues(circles)["Opacity"], 20)
+        self.assertEqual(nodes[0].diValues(circles)["Size"], 24)
+
+    # test opening files saved with Layers before DisplayItems, reading them
+    # in chunks small enough to split numbers and strings
+    def test_streamingLoad(self):
+        map = createTestMap()
+        jsContents = map.jsonObj()
+        legacy = {"Width": jsContents["Width"],
+                  "Height": jsContents["Height"],
+                  "Layers": jsContents["Layers"]}
+        legacy.update(jsContents)
+        handle, path = tempfile.mkstemp(suffix=".emf")
+        os.write(handle, json.dumps(legacy, indent=1).encode("utf-8"))
+        os.close(handle)
+        chunkSize = JSONStreamReader.CHUNK_SIZE
+        progress = []
+        try:
+            JSONStreamReader.CHUNK_SIZE = 7
+            loaded = EMFMapIO.loadMap(
+                path, lambda done, total: progress.append((done, total)))
+        finally:
+            JSONStreamReader.CHUNK_SIZE = chunkSize
+            os.remove(path)
+        self.assertEqual(json.dumps(loaded.jsonObj()),
+                         json.dumps(jsContents))
+        self.assertEqual(progress[-1][0], progress[-1][1])
+
+    # test that lazy layers are only loaded once they are used, and save the
+    # same JSON whether or not they were loaded
+    def test_lazyLoad(self):
+        map = createTestMap()
+        expected = json.dumps(map.jsonObj())
+        handle, path = tempfile.mkstemp(suffix=".emf")
+        os.close(handle)
+        try:
+            EMFMapIO.saveMap(map, path)
+            loaded = EMFMapIO.loadMap(path, lazy=True)
+        finally:
+            os.remove(path)
+        layer = loaded.getLayers()[0]
+        grid = loaded.getDisplayItems()[2]
+        self.assertFalse(layer.isLoaded())
+        self.assertEqual(grid.getPropertyItems(), [layer])
+        self.assertEqual(json.dumps(loaded.jsonObj()), expected)
+        self.assertFalse(layer.isLoaded())
+
+        nodes = layer.getList(NodeLayer.TYPE_NODE)
+        self.assertTrue(layer.isLoaded())
+        self.assertEqual(len(nodes), 4)
+        self.assertEqual(json.dumps(loaded.jsonObj()), expected)
+
+        loaded.removeDisplayItem(loaded.getDisplayItems()[0])
+        self.assertTrue(all(l.isLoaded() for l in loaded.getLayers()))
+
+    # test that lazy layers only decode their DIs, whether they are saved
+    # before the items or, in older files, after them, and that new DIs of
+    # the layer are saved without loading its items
+    def test_lazyHeader(self):
+        map = createTestMap()
+        jsContents = map.jsonObj()
+        for layerJS in jsContents["Layers"]:
+            layerJS["DIProperties"] = layerJS.pop("DIProperties")
+        handle, path = tempfile.mkstemp(suffix=".emf")
+        os.close(handle)
+        try:
+            with open(path, "w") as f:
+                json.dump(jsContents, f)
+            loaded = EMFMapIO.loadMap(path, lazy=True)
+            layer = loaded.getLayers()[0]
+            grid = GridDisplay("Second Grid")
+            loaded.addDisplayItem(grid)
+            grid.addItem(layer)
+            EMFMapIO.saveMap(loaded, path)
+            self.assertFalse(layer.isLoaded())
+            reloaded = EMFMapIO.loadMap(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(loaded.getDisplayItems()[2].getPropertyItems(),
+                         [layer])
+        self.assertEqual(json.loads(json.dumps(reloaded.jsonObj())),
+                         json.loads(json.dumps(loaded.jsonObj())))
+        self.assertEqual(
+            reloaded.getDisplayItems()[3].getPropertyItems(),
+            [reloaded.getLayers()[0]])
+
+    # test that layers parsed in worker processes load the same as the map
+    # that was saved, both when opening the file and loading lazy layers
+    def test_parallelLoad(self):
+        map = createTestMap()
+        map.addNewLayer()
+        map.getLayers()[2].setLayerItems(
+            [EMFNode(i, 2 * i) for i in range(100)])
+        expected = json.dumps(map.jsonObj())
+        minBytes = LayerParser.PARALLEL_MIN_BYTES
+        workers = LayerParser.WORKERS
+        handle, path = tempfile.mkstemp(suffix=".emf")
+        os.close(handle)
+        try:
+            LayerParser.PARALLEL_MIN_BYTES = 0
+            LayerParser.WORKERS = 2
+            EMFMapIO.saveMap(map, path)
+            loaded = EMFMapIO.loadMap(path)
+            lazy = EMFMapIO.loadMap(path, lazy=True)
+            lazy.loadAllLayers()
+        finally:
+            LayerParser.PARALLEL_MIN_BYTES = minBytes
+            LayerParser.WORKERS = workers
+            os.remove(path)
+        self.assertEqual(json.dumps(loaded.jsonObj()), expected)
+        self.assertTrue(all(l.isLoaded() for l in lazy.getLayers()))
+        self.assertEqual(json.dumps(lazy.jsonObj()), expected)
+
+    # test that the streamed JSON matches the map JSON, and layers that were
+    # never loaded are saved again without loading them
+    def test_streamingSave(self):
+        map = createTestMap()
+        expected = json.dumps(map.jsonObj())
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "streamed.emf")
+            EMFMapIO.saveMap(map, path)
+            with open(path) as f:
+                self.assertEqual(f.read(), expected)
+            loaded = EMFMapIO.loadMap(path, lazy=True)
+            EMFMapIO.saveMap(loaded, path)
+            with open(path) as f:
+                self.assertEqual(f.read(), expected)
+            self.assertFalse(loaded.getLayers()[0].isLoaded())
+
+    # test that a save that fails part way leaves the previous file alone
+    def test_failedSave(self):
+        map = createTestMap()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "failed.emf")
+            EMFMapIO.saveMap(map, path)
+            with open(path, "rb") as f:
+                saved = f.read()
+
+            def failingText(diIndexes):
+                raise OSError("disk full")
+            map.getLayers()[1].jsonText = failingText
+            moveNode(map.getLayers()[0].getList(NodeLayer.TYPE_NODE)[0],
+                     (5, 5))
+            with self.assertRaises(OSError):
+                EMFMapIO.saveMap(map, path)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), saved)
+            self.assertEqual(os.listdir(directory), ["failed.emf"])
+
+    # test that compressed JSON and binary files are smaller, and open the
+    # same as uncompressed ones
+    def test_compressed(self):
+        map = createTestMap()
+        expected = json.dumps(map.jsonObj())
+        with tempfile.TemporaryDirectory() as directory:
+            plainPath = os.path.join(directory, "plain.emf")
+            path = os.path.join(directory, "compressed.emf")
+            EMFMapIO.saveMap(map, plainPath)
+            for fileFormat, level in ((EMFMapIO.FORMAT_COMPRESSED, None),
+                                      (EMFMapIO.FORMAT_JSON, 9),
+                                      (EMFMapIO.FORMAT_BINARY, 1)):
+                with self.subTest(fileFormat=fileFormat, level=level):
+                    EMFMapIO.saveMap(map, path, fileFormat, level)
+                    with open(path, "rb") as f:
+                        self.assertEqual(f.read(2), EMFMapIO.GZIP_MAGIC)
+                    self.assertLess(os.path.getsize(path),
+                                    os.path.getsize(plainPath))
+                    progress = []
+                    loaded = EMFMapIO.loadMap(
+                        path, lambda done, total: progress.append(
+                            (done, total)), lazy=True)
+                    self.assertEqual(json.dumps(loaded.jsonObj()), expected)
+                    self.assertEqual(progress[-1][0], progress[-1][1])
+
+    # test that files which are not maps can't be opened
+    def test_invalidFile(self):
+        handle, path = tempfile.mkstemp(suffix=".emf")
+        os.write(handle, b"EMFB not really")
+        os.close(handle)
+        try:
+            self.assertIsNone(EMFMapIO.loadMap(path))
+        finally:
+            os.remove(path)
+
+
+"""
+EMFAutoSaveTests tests journaling changes to a map and recovering the map
+from the journal
+"""
+
+
+class EMFAutoSaveTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.map = createTestMap()
+        self.autoSave = AutoSave(self.map, self.directory.name)
+
+    def tearDown(self):
+        self.autoSave.discard()
+        self.directory.cleanup()
+
+    def recovered(self):
+        self.autoSave.stop()
+        return self.autoSave.journal.recover()
+
+    # test that only changed layers are journaled, and the journal recovers
+    # the latest map
+    def test_recoverChanges(self):
+        self.autoSave.saveChanges()
+        layer = self.map.getLayers()[0]
+        moveNode(layer.getList(NodeLayer.TYPE_NODE)[0], (5, 5))
+        self.map.addNewLayer()
+        self.autoSave.saveChanges()
+        jsContents = self.recovered()
+        self.assertEqual(json.dumps(jsContents), json.dumps(
+            self.map.jsonObj()))
+        with open(self.autoSave.journal.journalPath) as f:
+            records = [json.loads(line) for line in f]
+        # the first save has the header and both layers, the second only the
+        # new header, the moved node's layer and the new layer
+        self.assertEqual(len(records), 6)
+
+    # test that edits made through the history are journaled as they
+    # happen, without saving their layers again
+    def test_journalCommands(self):
+        self.autoSave.saveChanges()
+        self.map.changeLayerDown()
+        layer = self.map.getLayers()[0]
+        nodes = list(layer.getList(NodeLayer.TYPE_NODE))
+        history = self.map.getHistory()
+        transform = NodeTransform(nodes[2:], nodes[2])
+        transform.grab((7, -3))
+        transform.apply()
+        history.push(MoveNodesCommand.createFromTransform(transform))
+        history.push(LayerItemsCommand.removeItems(
+            layer, [nodes[1]], nodes[1].getLines(),
+            list(nodes[1].getShapes())))
+        self.map.setSelectedItems([nodes[3]])
+        opacity = self.map.getDisplayItem(0).getIndividualAttributes()[
+            "Opacity"]
+        opacity.setValues(40, 40)
+        history.undo()
+        history.redo()
+        for i in range(3):
+            history.undo()
+        for i in range(2):
+            history.redo()
+        jsContents = self.recovered()
+        self.assertEqual(json.loads(json.dumps(jsContents)),
+                         json.loads(json.dumps(self.map.jsonObj())))
+        with open(self.autoSave.journal.journalPath) as f:
+            records = [json.loads(line) for line in f]
+        # only the first save has the contents of the layers
+        self.assertEqual(len([record for record in records
+                              if "Contents" in record]), 2)
+        self.assertEqual(len([record for record in records
+                              if "Attribute" in record]), 4)
+        # changing the DI's value left the layer without edited items as the
+        # text it was journaled as
+        otherID = self.autoSave.layerIDs[self.map.getLayers()[1]]
+        self.assertIsInstance(
+            self.autoSave.journal.state["Layers"][str(otherID)], str)
+
+    # test that a second session keeps its own journal, and only journals
+    # of sessions that are no longer running are offered for recovery
+    def test_sessions(self):
+        self.autoSave.saveChanges()
+        self.autoSave.stop()
+        second = AutoSave(createTestMap(), self.directory.name)
+        try:
+            self.assertNotEqual(second.journal.journalPath,
+                                self.autoSave.journal.journalPath)
+            self.assertTrue(os.path.exists(self.autoSave.journal.journalPath))
+            self.assertEqual(
+                AutoSaveJournal.orphanedJournals(self.directory.name), [])
+        finally:
+            second.discard()
+        # the lock is left behind when the session ends without discarding
+        self.autoSave.journal.unlock()
+        journals = AutoSaveJournal.orphanedJournals(self.directory.name)
+        self.assertEqual([journal.sessionID for journal in journals],
+                         [self.autoSave.journal.sessionID])
+        self.assertEqual(json.dumps(journals[0].recover()),
+                         json.dumps(self.map.jsonObj()))
+        journals[0].discard()
+        self.assertEqual(
+            AutoSaveJournal.orphanedJournals(self.directory.name), [])
+
+    # test that a layer's JSON is built over several ticks once a tick runs
+    # over the budget
+    def test_tickBudget(self):
+        layer = self.map.getLayers()[1]
+        layer.setLayerItems([EMFNode(i, i) for i in range(50)])
+        layer.setNeedRedraw()
+        budget = AutoSave.TICK_BUDGET
+        stepItems = AutoSave.STEP_ITEMS
+        try:
+            AutoSave.TICK_BUDGET = 0
+            AutoSave.STEP_ITEMS = 10
+            self.autoSave.saveChanges()
+            ticks = 1
+            while len(self.autoSave.snapshots) > 0:
+                self.autoSave.saveChanges()
+                ticks += 1
+        finally:
+            AutoSave.TICK_BUDGET = budget
+            AutoSave.STEP_ITEMS = stepItems
+        self.assertGreater(ticks, 5)
+        self.assertEqual(json.dumps(self.recovered()),
+                         json.dumps(self.map.jsonObj()))
+
+    # test that compacting into a snapshot keeps the recovered map the same
+    def test_compact(self):
+        compactRecords = AutoSaveJournal.COMPACT_RECORDS
+        AutoSaveJournal.COMPACT_RECORDS = 2
+        try:
+            for i in range(3):
+                node = self.map.getLayers()[0].getList(NodeLayer.TYPE_NODE)[0]
+                moveNode(node, (i, i))
+                self.autoSave.saveChanges()
+            jsContents = self.recovered()
+        finally:
+            AutoSaveJournal.COMPACT_RECORDS = compactRecords
+        self.assertTrue(os.path.exists(self.autoSave.journal.snapshotPath))
+        self.assertEqual(json.dumps(jsContents), json.dumps(
+            self.map.jsonObj()))
+
+
+"""
+EMFBundleTests tests saving maps with their images in a bundle, and sharing
+the images when the bundle is opened
+"""
+
+
+class EMFBundleTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # images can't be decoded without an application
+        cls.app = QApplication.instance() or QApplication([])
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.assetDirectory = EMFAssets.assetDirectory
+        EMFAssets.assetDirectory = os.path.join(self.directory.name, "cache")
+
+    def tearDown(self):
+        EMFAssets.assetDirectory = self.assetDirectory
+        self.directory.cleanup()
+
+    # Helper method to write a small image to name, returning its path
+    def createImage(self, name, color):
+        path = os.path.join(self.directory.name, name)
+        image = QImage(4, 4, QImage.Format_ARGB32)
+        image.fill(color)
+        image.save(path)
+        return path
+
+    # test that identical images are stored and decoded once, and the map
+    # opens without the original files
+    def test_bundleAssets(self):
+        red = self.createImage("red.png", QColor(255, 0, 0))
+        with open(red, "rb") as f:
+            data = f.read()
+        redCopy = os.path.join(self.directory.name, "copy.png")
+        with open(redCopy, "wb") as f:
+            f.write(data)
+        blue = self.createImage("blue.png", QColor(0, 0, 255))
+        dis = [ImageDisplay("Red", {"Image": red}),
+               ImageDisplay("Copy", {"Image": redCopy}),
+               ImageBGDisplay("Blue", {"Image": blue})]
+        map = EMFMap(10, 10, None, dis)
+        path = os.path.join(self.directory.name, "bundle.emf")
+        EMFMapIO.saveMap(map, path, EMFMapIO.FORMAT_BUNDLE)
+        for imagePath in (red, redCopy, blue):
+            os.remove(imagePath)
+
+        with zipfile.ZipFile(path) as bundle:
+            assets = [name for name in bundle.namelist()
+                      if name.startswith("assets/")]
+        self.assertEqual(len(assets), 2)
+
+        loaded = EMFMapIO.loadMap(path).getDisplayItems()
+        images = [di.getSharedAttributes()["Image"] for di in loaded]
+        self.assertEqual(images[0].getJSONValue(), images[1].getJSONValue())
+        self.assertIs(images[0].getValue().pixmap(),
+                      images[1].getValue().pixmap())
+        self.assertFalse(images[2].getValue().pixmap().isNull())
+        self.assertEqual(os.path.dirname(images[2].getJSONValue()),
+                         EMFAssets.assetDirectory)
+
+    # test that images are only decoded once drawn, and decoded again after
+    # being dropped
+    def test_lazyImages(self):
+        path = self.createImage("lazy.png", QColor(0, 255, 0))
+        handle = ImageDisplay("Lazy", {"Image": path}).getSharedAttributes()[
+            "Image"].getValue()
+        self.assertFalse(handle.isDecoded())
+        handle.prefetch()
+        pixmap = handle.pixmap()
+        self.assertTrue(handle.isDecoded())
+        self.assertEqual((pixmap.width(), pixmap.height()), (4, 4))
+        self.assertEqual(EMFAssets.decoding, {})
+        handle.drop()
+        self.assertFalse(handle.isDecoded())
+        self.assertEqual(handle.pixmap().width(), 4)
+
+
+    # test that a missing image isn't tried again until the file changes
+    def test_missingImage(self):
+        path = os.path.join(self.directory.name, "missing.png")
+        handle = EMFAssets.imageHandle(path)
+        self.assertTrue(handle.pixmap().isNull())
+        self.assertIn(path, EMFAssets.failedLoads)
+        self.assertTrue(handle.pixmap().isNull())
+        self.createImage("missing.png", QColor(0, 0, 255))
+        self.assertEqual(handle.pixmap().width(), 4)
+        self.assertNotIn(path, EMFAssets.failedLoads)
+
+"""
+EMFHistoryTests tests undoing and redoing edits, and keeping the history
+within its budget
+"""
+
+
+class EMFHistoryTests(unittest.TestCase):
+    # test that undoing a rotate of many nodes only keeps their offsets
+    def test_undoMove(self):
+        nodes = [EMFNode(i % 100 * 10, i // 100 * 10) for i in range(5000)]
+        map = EMFMap(10, 10, [NodeLayer(720, 720, nodes)])
+        start = [(node.x(), node.y()) for node in nodes]
+        transform = NodeTransform(nodes, EMFNodeHelper.medianNode(nodes))
+        transform.rotate(45)
+        transform.apply()
+        rotated = [(node.x(), node.y()) for node in nodes]
+        command = MoveNodesCommand.createFromTransform(transform)
+        map.getHistory().push(command)
+        self.assertLess(command.byteSize(), 5000 * 20)
+
+        self.assertTrue(map.getHistory().undo())
+        self.assertEqual([(node.x(), node.y()) for node in nodes], start)
+        self.assertTrue(map.getHistory().redo())
+        self.assertEqual([(node.x(), node.y()) for node in nodes], rotated)
+
+    # test that deleted items are restored with their connections and values
+    def test_undoDelete(self):
+        nodes = [EMFNode(0, 0), EMFNode(72, 0), EMFNode(72, 72)]
+        layer = NodeLayer(720, 720)
+        layer.addItemsToLayer(NodeLayer.TYPE_NODE, nodes)
+        shape = EMFShape(nodes)
+        layer.addItemToLayer(NodeLayer.TYPE_SHAPE, shape)
+        line = nodes[1].lineTo(nodes[2])
+        circles = ColorCircleDisplay("Circles")
+        circles.addItems(nodes)
+        circles.getValueStore().setValue(nodes[2], "Size", 10.5)
+        map = EMFMap(10, 10, [layer], [circles])
+        map.getHistory().push(LayerItemsCommand.removeItems(
+            layer, [nodes[2]], nodes[2].getLines(), [shape]))
+        self.assertNotIn(nodes[2], layer.getList(NodeLayer.TYPE_NODE))
+        self.assertIsNone(nodes[1].lineTo(nodes[2]))
+        self.assertNotIn(nodes[2], circles.getValueStore())
+
+        map.getHistory().undo()
+        self.assertIn(nodes[2], layer.getList(NodeLayer.TYPE_NODE))
+        self.assertIs(nodes[1].lineTo(nodes[2]), line)
+        self.assertIn(shape, nodes[0].getShapes())
+        self.assertIn(shape, layer.getList(NodeLayer.TYPE_SHAPE))
+        self.assertEqual(nodes[2].diValues(circles)["Size"], 10.5)
+
+        map.getHistory().redo()
+        self.assertNotIn(shape, layer.getList(NodeLayer.TYPE_SHAPE))
+        self.assertNotIn(shape, nodes[0].getShapes())
+
+    # test that consecutive slider edits are undone in one step
+    def test_mergeSliderEdits(self):
+        map = createTestMap()
+        map.changeLayerDown()
+        node = map.getLayers()[0].getList(NodeLayer.TYPE_NODE)[0]
+        map.setSelectedItems([node])
+        opacity = map.getDisplayItem(0).getIndividualAttributes()["Opacity"]
+        for value in (50, 60, 70):
+            opacity.setValues(value, value)
+        self.assertEqual(len(map.getHistory().undoCommands), 1)
+
+        map.getHistory().undo()
+        self.assertEqual(node.diValues(map.getDisplayItem(0))["Opacity"], 100)
+        self.assertEqual(opacity.getValue(), 100)
+        map.getHistory().redo()
+        self.assertEqual(node.diValues(map.getDisplayItem(0))["Opacity"], 70)
+
+    # test that the oldest commands are dropped once over the budget
+    def test_budget(self):
+        nodes = [EMFNode(i, i) for i in range(100)]
+        history = EditHistory(EMFMap(10, 10), 4000)
+        for i in range(20):
+            deltas = numpy.ones((100, 2), dtype=numpy.int32)
+            history.push(MoveNodesCommand(nodes, deltas))
+        self.assertLessEqual(history.getSize(), 4000)
+        self.assertTrue(0 < len(history.undoCommands) < 20)
+
+
+"""
+EMFRenderCacheTests tests reusing the layer images saved with a map when it
+is opened again
+"""
+
+
+class EMFRenderCacheTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication([])
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cached.emf")
+        self.map = createTestMap()
+        # circles are drawn with whole number sizes
+        circles = self.map.getDisplayItem(0)
+        for node in circles.getPropertyItems():
+            circles.getValueStore().setValue(node, "Size", 10)
+        self.images = self.map.getLayerImages()
+        EMFMapIO.saveMap(self.map, self.path)
+        RenderCache.waitForWrites()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    # test that unchanged layers are shown from the cache without loading
+    def test_reopenFromCache(self):
+        self.assertTrue(os.path.exists(RenderCache.cachePath(self.path)))
+        loaded = EMFMapIO.loadMap(self.path, lazy=True)
+        images = loaded.getLayerImages()
+        self.assertFalse(loaded.getLayers()[0].isLoaded())
+        self.assertEqual(images[0], self.images[0])
+        self.assertEqual(images[1], self.images[1])
+
+    # test that a changed layer is drawn again instead of using the cache
+    def test_changedLayer(self):
+        loaded = EMFMapIO.loadMap(self.path)
+        layers = loaded.getLayers()
+        moveNode(layers[0].getList(NodeLayer.TYPE_NODE)[0], (10, 0))
+        images = loaded.getLayerImages()
+        self.assertIsNone(layers[0].layerImageBuffer)
+        self.assertIsNotNone(layers[1].layerImageBuffer)
+        self.assertNotEqual(images[0], self.images[0])
+
+    # test that saving again keeps the entries of unchanged layers, and that
+    # a map changed since the cache was written doesn't use it
+    def test_saveAgain(self):
+        loaded = EMFMapIO.loadMap(self.path, lazy=True)
+        EMFMapIO.saveMap(loaded, self.path)
+        RenderCache.waitForWrites()
+        reloaded = EMFMapIO.loadMap(self.path, lazy=True)
+        self.assertEqual(reloaded.getLayerImages()[1], self.images[1])
+        self.assertFalse(reloaded.getLayers()[1].isLoaded())
+        with open(self.path, "a") as f:
+            f.write(" ")
+        changed = EMFMapIO.loadMap(self.path, lazy=True)
+        self.assertEqual(len(changed.getRenderCache().entries), 0)
+
+
+"""
+EMFDefaultValueTests tests leaving individual values equal to the DI's values
+out of saved maps, and filling them back in when loading
+"""
+
+
+class EMFDefaultValueTests(unittest.TestCase):
+    # Helper method to save map as JSON and open it again
+    def reopen(self, map, lazy=False):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "defaults.emf")
+            EMFMapIO.saveMap(map, path)
+            return EMFMapIO.loadMap(path, lazy=lazy)
+
+    # test that only values differing from the DI are saved, keeping types
+    def test_leftOutValues(self):
+        map = createTestMap()
+        circles = map.getDisplayItem(0)
+        nodes = map.getLayers()[0].getList(NodeLayer.TYPE_NODE)
+        circles.getValueStore().setValue(nodes[1], "Size", 24.0)
+        nodesJSON = map.jsonObj()["Layers"][0]["Nodes"]
+        self.assertEqual([nodeJS["DIProperties"][0] for nodeJS in nodesJSON],
+                         [{}, {"Size": 24.0}, {"Size": 10.5},
+                          {"Opacity": 20}])
+
+        loaded = self.reopen(map)
+        loadedCircles = loaded.getDisplayItem(0)
+        values = [dict(node.diValues(loadedCircles)) for node in
+                  loaded.getLayers()[0].getList(NodeLayer.TYPE_NODE)]
+        self.assertEqual(values, [dict(node.diValues(circles))
+                                  for node in nodes])
+        self.assertIsInstance(values[1]["Size"], float)
+        self.assertIsInstance(values[0]["Size"], int)
+
+    # test that changing a DI before a lazy layer is loaded keeps the values
+    # the layer was saved with
+    def test_changedBeforeLoad(self):
+        loaded = self.reopen(createTestMap(), lazy=True)
+        circles = loaded.getDisplayItem(0)
+        expected = json.dumps(loaded.jsonObj()["Layers"][0])
+        circles.getIndividualAttributes()["Opacity"].restoreValues(50, 50)
+        layer = loaded.getLayers()[0]
+        self.assertFalse(layer.isLoaded())
+        self.assertNotEqual(json.dumps(loaded.jsonObj()["Layers"][0]),
+                            expected)
+        nodes = layer.getList(NodeLayer.TYPE_NODE)
+        self.assertEqual(nodes[0].diValues(circles)["Opacity"], 100)
+        self.assertEqual(nodes[3].diValues(circles)["Opacity"], 20)
+
+        reloaded = self.reopen(loaded)
+        reloadedNodes = reloaded.getLayers()[0].getList(NodeLayer.TYPE_NODE)
+        self.assertEqual(
+            reloadedNodes[0].diValues(reloaded.getDisplayItem(0))["Opacity"],
+            100)
+
+
+
+"""
+EMFExporterTests tests reading layer groups and exporting maps to images
+without the editor
+"""
+
+
+class EMFExporterTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication([])
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "exported.emf")
+        self.map = createTestMap()
+        circles = self.map.getDisplayItem(0)
+        for node in circles.getPropertyItems():
+            circles.getValueStore().setValue(node, "Size", 10)
+        EMFMapIO.saveMap(self.map, self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_layerGroups(self):
+        self.assertEqual(MapExporter.parseLayerGroups("1,2-3, 5", 5),
+                         [(1, 1), (2, 3), (5, 5)])
+        self.assertEqual(MapExporter.everyGroupText(3), "1,2,3")
+        self.assertEqual(MapExporter.singleGroupText(1), "1")
+        for groupText in ("", "1,", "0", "3-2", "1-6", "a"):
+            with self.subTest(groupText=groupText):
+                with self.assertRaises(ValueError):
+                    MapExporter.parseLayerGroups(groupText, 5)
+
+    # test exporting a file with an image per group, named after the map
+    def test_exportFiles(self):
+        output = os.path.join(self.directory.name, "images")
+        os.mkdir(output)
+        results = MapExporter.exportFiles(
+            [self.path, self.path + ".missing"], MapExporter.EVERY, output,
+            1)
+        self.assertEqual(results[0], (self.path, [
+            os.path.join(output, "exported_0.png"),
+            os.path.join(output, "exported_1.png")], None))
+        self.assertEqual(results[1][1], [])
+        self.assertIsNotNone(results[1][2])
+        image = QImage(results[0][1][0])
+        self.assertEqual((image.width(), image.height()), (720, 720))
+        self.assertEqual(image, self.map.getLayerImages()[0].convertToFormat(
+            image.format()))
+
+    # test that a map whose display items fail to draw is reported, without
+    # stopping the maps after it or leaving files behind
+    def test_exportBrokenMap(self):
+        output = os.path.join(self.directory.name, "broken")
+        os.mkdir(output)
+        brokenPath = os.path.join(self.directory.name, "broken.emf")
+        # the circle of size 10.5 can't be drawn
+        EMFMapIO.saveMap(createTestMap(), brokenPath)
+        for options in ({"banded": True}, {"tiles": True},
+                        {"imageFormat": MapExporter.PDF}):
+            with self.subTest(**options):
+                results = MapExporter.exportFiles(
+                    [brokenPath, self.path], "1", output, 1, **options)
+                self.assertEqual(results[0][1], [])
+                self.assertIsNotNone(results[0][2])
+                self.assertIsNone(results[1][2])
+                self.assertTrue(all(name.startswith("exported")
+                                    for name in os.listdir(output)))
+
+    # test that groups starting at the same layer are built from each other,
+    # and come out the same as compositing each group on its own
+    def test_sharedComposites(self):
+        images = {}
+        for number in range(1, 5):
+            image = QImage(4, 4, QImage.Format_ARGB32_Premultiplied)
+            image.fill(QColor(60 * number, 0, 255 - 60 * number, 100))
+            images[number] = image
+        groups = [(1, 4), (2, 3), (1, 2), (1, 4), (1, 3)]
+        drawn = []
+        compositeImages = MapExporter.compositeImages
+
+        def countingComposite(layerImages, base=None):
+            drawn.extend(layerImages)
+            return compositeImages(layerImages, base)
+        try:
+            MapExporter.compositeImages = countingComposite
+            composites = dict(MapExporter.compositeGroups(groups, images))
+        finally:
+            MapExporter.compositeImages = compositeImages
+        self.assertEqual(len(drawn), 6)
+        for index in range(len(groups)):
+            first, last = groups[index]
+            self.assertEqual(composites[index], compositeImages(
+                [images[number] for number in range(first, last + 1)]))
+
+    # test that images written a band at a time match whole images
+    def test_bandedExport(self):
+        filePath = os.path.join(self.directory.name, "whole")
+        bandPath = os.path.join(self.directory.name, "banded")
+        MapExporter.exportMap(self.map, "1-2,1", filePath, False)
+        # bands of 50 rows, not dividing the 720 rows of the map
+        paths = MapExporter.exportBanded(
+            self.map, [(1, 2), (1, 1)], bandPath, 720 * 4 * 3 * 50)
+        self.assertEqual(paths, [bandPath + "_0.png", bandPath + "_1.png"])
+        for index in range(2):
+            whole = QImage(MapExporter.imagePath(filePath, index, 2))
+            banded = QImage(paths[index])
+            self.assertEqual(
+                banded.convertToFormat(QImage.Format_ARGB32),
+                whole.convertToFormat(QImage.Format_ARGB32))
+
+    # test that banded exports only use the render cache at the editor's
+    # size, and then don't load the layers it has images of
+    def test_bandedCache(self):
+        self.map.getLayerImages()
+        EMFMapIO.saveMap(self.map, self.path)
+        RenderCache.waitForWrites()
+        bandPath = os.path.join(self.directory.name, "cached")
+        loaded = EMFMapIO.loadMap(self.path, lazy=True)
+        MapExporter.exportBanded(loaded, [(1, 2)], bandPath, scale=2.0)
+        self.assertIsNone(loaded.getLayers()[0].getLayerImage())
+        loaded = EMFMapIO.loadMap(self.path, lazy=True)
+        MapExporter.exportBanded(loaded, [(1, 2)], bandPath)
+        self.assertIsNotNone(loaded.getLayers()[0].getLayerImage())
+        self.assertFalse(loaded.getLayers()[0].isLoaded())
+
+    # test drawing at twice the pixels per cell, whole and in bands, without
+    # changing the images the editor draws
+    def test_cellSize(self):
+        layer = self.map.getLayers()[0]
+        editorImage = self.map.getLayerImages(1)[0]
+        filePath = os.path.join(self.directory.name, "large")
+        bandPath = os.path.join(self.directory.name, "largeBanded")
+        cellSize = 2 * NodeLayer.CELL_SIZE
+        MapExporter.exportMap(self.map, "1", filePath, False, cellSize)
+        whole = QImage(filePath + ".png")
+        self.assertEqual((whole.width(), whole.height()), (1440, 1440))
+        self.assertIs(layer.getLayerImage(), editorImage)
+        self.assertEqual(editorImage.width(), 720)
+        # each pixel of the editor's image covers 2x2 pixels of the export
+        node = self.map.getDisplayItem(0).getPropertyItems()[0]
+        self.assertEqual(
+            whole.pixelColor(2 * node.x(), 2 * node.y()).rgb(),
+            editorImage.pixelColor(node.x(), node.y()).rgb())
+        MapExporter.exportBanded(self.map, [(1, 1)], bandPath,
+                                 1440 * 4 * 2 * 100, 2.0)
+        self.assertEqual(
+            QImage(bandPath + ".png").convertToFormat(QImage.Format_ARGB32),
+            whole.convertToFormat(QImage.Format_ARGB32))
+        with self.assertRaises(ValueError):
+            MapExporter.exportMap(self.map, "1", filePath, False, 0)
+        fullBytes = MapExporter.FULL_IMAGE_BYTES
+        try:
+            # a layer and its group at the editor's size fit
+            MapExporter.FULL_IMAGE_BYTES = 2 * 720 * 720 * 4
+            self.assertFalse(MapExporter.needsBands(self.map, [(1, 1)]))
+            self.assertTrue(MapExporter.needsBands(self.map, [(1, 2)]))
+            self.assertTrue(MapExporter.needsBands(self.map, [(1, 1)],
+                                                   cellSize))
+            with self.assertRaises(ValueError):
+                MapExporter.exportMap(self.map, "1", filePath,
+                                      cellSize=cellSize,
+                                      imageFormat=MapExporter.JPEG)
+        finally:
+            MapExporter.FULL_IMAGE_BYTES = fullBytes
+
+    # test encoding the images of several groups at once, at different
+    # compression levels, reporting each one written
+    def test_encodeLevels(self):
+        sizes = []
+        for level in (0, 9):
+            progress = []
+            paths = MapExporter.exportMap(
+                self.map, "1,2,1-2", os.path.join(
+                    self.directory.name, "level{}".format(level)),
+                False, level=level,
+                progress=lambda done, total: progress.append((done, total)))
+            self.assertEqual(progress, [(1, 3), (2, 3), (3, 3)])
+            sizes.append(sum(os.path.getsize(path) for path in paths))
+        self.assertGreater(sizes[0], sizes[1])
+        for index in range(3):
+            self.assertEqual(
+                QImage(os.path.join(self.directory.name,
+                                    "level0_{}.png".format(index))),
+                QImage(os.path.join(self.directory.name,
+                                    "level9_{}.png".format(index))))
+        progress = []
+        MapExporter.exportBanded(
+            self.map, [(1, 2), (2, 2)],
+            os.path.join(self.directory.name, "banded"), 720 * 4 * 4 * 300,
+            level=1,
+            progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(progress, [(300, 720), (600, 720), (720, 720)])
+        with self.assertRaises(ValueError):
+            MapExporter.exportMap(self.map, "1", self.path, level=10)
+
+    # test exporting as palettized PNG, which keeps the few colors of the
+    # test map exactly, and as lossy images
+    def test_imageFormats(self):
+        filePath = os.path.join(self.directory.name, "formats")
+        png = QImage(MapExporter.exportMap(self.map, "1-2", filePath)[0])
+        paths = MapExporter.exportMap(
+            self.map, "1-2", filePath + "8", imageFormat=MapExporter.PNG8)
+        self.assertEqual(paths, [filePath + "8.png"])
+        png8 = QImage(paths[0])
+        self.assertEqual(png8.format(), QImage.Format_Indexed8)
+        node = self.map.getDisplayItem(0).getPropertyItems()[0]
+        for point in ((node.x(), node.y()), (0, 0), (700, 700)):
+            self.assertEqual(png8.pixel(*point), png.pixel(*point))
+        for imageFormat in (MapExporter.JPEG, MapExporter.WEBP):
+            if imageFormat not in MapExporter.availableFormats():
+                continue
+            with self.subTest(imageFormat=imageFormat):
+                path = MapExporter.exportMap(
+                    self.map, "1-2", filePath, imageFormat=imageFormat,
+                    quality=80)[0]
+                self.assertTrue(path.endswith(
+                    MapExporter.FORMATS[imageFormat][1]))
+                image = QImage(path)
+                self.assertEqual((image.width(), image.height()),
+                                 (720, 720))
+        with self.assertRaises(ValueError):
+            MapExporter.exportMap(self.map, "1", filePath, True,
+                                  imageFormat=MapExporter.JPEG)
+
+    # test exporting a Deep Zoom pyramid, drawn a tile at a time
+    def test_exportTiles(self):
+        self.assertEqual(MapExporter.pyramidLevels(5, 3),
+                         [(1, 1), (2, 1), (3, 2), (5, 3)])
+        filePath = os.path.join(self.directory.name, "tiles")
+        whole = QImage(MapExporter.exportMap(self.map, "1-2", filePath)[0])
+        progress = []
+        paths = MapExporter.exportTiles(
+            self.map, "1-2", filePath, blockBytes=256 * 256 * 4 * 3,
+            progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(paths, [filePath + ".dzi"])
+        with open(paths[0]) as f:
+            self.assertIn('<Size Width="720" Height="720"/>', f.read())
+        # 11 levels, from 1 x 1 to 720 x 720, with 9 tiles on the last
+        # and 4 on the one before it
+        tileFolder = filePath + "_files"
+        self.assertEqual(len(os.listdir(tileFolder)), 11)
+        self.assertEqual(sorted(os.listdir(os.path.join(tileFolder, "10"))),
+                         ["{}_{}.png".format(x, y)
+                          for x in range(3) for y in range(3)])
+        self.assertEqual(progress[-1], (9 + 4 + 9, 9 + 4 + 9))
+        corner = QImage(os.path.join(tileFolder, "10", "2_2.png"))
+        self.assertEqual(
+            corner.convertToFormat(QImage.Format_ARGB32),
+            whole.copy(512, 512, 208, 208).convertToFormat(
+                QImage.Format_ARGB32))
+        half = QImage(os.path.join(tileFolder, "9", "1_1.png"))
+        self.assertEqual((half.width(), half.height()), (104, 104))
+        single = QImage(os.path.join(tileFolder, "0", "0_0.png"))
+        self.assertEqual((single.width(), single.height()), (1, 1))
+
+    # test that tiles only draw the items that reach into them, and that the
+    # DIs that could draw anywhere draw everything
+    def test_cullTiles(self):
+        self.assertEqual(MapExporter.pyramidLevel(5, 3, 1), (3, 2, 0.5))
+        layer = self.map.getLayers()[0]
+        circles, shapes, grid = self.map.getDisplayItems()
+        nodes = layer.getList(NodeLayer.TYPE_NODE)
+        bounds = MapExporter.itemBounds(layer, self.map.getDisplayItems())
+        self.assertNotIn(grid, bounds)
+        itemLists = MapExporter.cullItems(bounds, (60, 60, 200, 200))
+        self.assertEqual(itemLists[circles], [nodes[2]])
+        self.assertEqual(itemLists[shapes],
+                         layer.getList(NodeLayer.TYPE_SHAPE))
+        itemLists = MapExporter.cullItems(bounds, (300, 300, 400, 400))
+        self.assertEqual(itemLists, {circles: [], shapes: []})
+
+    # test exporting as vector files, which draw the same as the images
+    def test_vectorExport(self):
+        filePath = os.path.join(self.directory.name, "vector")
+        png = QImage(MapExporter.exportMap(self.map, "1-2", filePath)[0])
+        pdfPath = MapExporter.exportMap(self.map, "1-2", filePath,
+                                        imageFormat=MapExporter.PDF)[0]
+        with open(pdfPath, "rb") as f:
+            self.assertEqual(f.read(5), b"%PDF-")
+        if MapExporter.SVG not in MapExporter.availableFormats():
+            self.skipTest("QtSvg isn't installed")
+        from PyQt5.QtSvg import QSvgRenderer
+        svgPath = MapExporter.exportMap(self.map, "1-2", filePath,
+                                        imageFormat=MapExporter.SVG)[0]
+        renderer = QSvgRenderer(svgPath)
+        self.assertTrue(renderer.isValid())
+        svg = QImage(720, 720, QImage.Format_ARGB32_Premultiplied)
+        svg.fill(0)
+        painter = QPainter(svg)
+        renderer.render(painter)
+        painter.end()
+        node = self.map.getDisplayItem(0).getPropertyItems()[0]
+        self.assertEqual(svg.pixel(node.x(), node.y()),
+                         png.pixel(node.x(), node.y()))
+        with self.assertRaises(ValueError):
+            MapExporter.exportTiles(self.map, "1", filePath,
+                                    imageFormat=MapExporter.SVG)
+
+    # test that a texture drawn by two display items is written to the SVG
+    # once, and used as a pattern
+    def test_svgTextures(self):
+        if MapExporter.SVG not in MapExporter.availableFormats():
+            self.skipTest("QtSvg isn't installed")
+        imagePath = os.path.join(self.directory.name, "texture.png")
+        texture = QImage(8, 8, QImage.Format_ARGB32)
+        texture.fill(QColor(0, 0, 255))
+        texture.save(imagePath)
+        nodes = [EMFNode(100, 100), EMFNode(300, 100), EMFNode(300, 300)]
+        shape = EMFShape(nodes)
+        layer = NodeLayer(720, 720, nodes, [], [shape])
+        dis = [ImageShapeDisplay("Floor", {"Image": imagePath}),
+               ImageBGDisplay("Background", {"Image": imagePath})]
+        dis[0].addItem(shape)
+        dis[1].addItem(layer)
+        map = EMFMap(10, 10, [layer], dis)
+        path = MapExporter.exportMap(
+            map, "1", os.path.join(self.directory.name, "textured"),
+            imageFormat=MapExporter.SVG)[0]
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        self.assertEqual(text.count("base64,"), 1)
+        self.assertIn('fill="url(#texture0)"', text)
+        self.assertNotIn(QColor(TexturePainter.FIRST_PLACEHOLDER).name(),
+                         text)
+        minidom.parseString(text)
+
+    # test that a map filling with the color of a placeholder keeps it, and
+    # its texture is given another placeholder
+    def test_svgPlaceholderColor(self):
+        if MapExporter.SVG not in MapExporter.availableFormats():
+            self.skipTest("QtSvg isn't installed")
+        imagePath = os.path.join(self.directory.name, "texture.png")
+        texture = QImage(8, 8, QImage.Format_ARGB32)
+        texture.fill(QColor(0, 0, 255))
+        texture.save(imagePath)
+        placeholder = QColor(TexturePainter.FIRST_PLACEHOLDER)
+        nodes = [EMFNode(100, 100), EMFNode(300, 100), EMFNode(300, 300),
+                 EMFNode(400, 400), EMFNode(500, 400), EMFNode(500, 500)]
+        shapes = [EMFShape(nodes[:3]), EMFShape(nodes[3:])]
+        layer = NodeLayer(720, 720, nodes, [], shapes)
+        # the solid shape is drawn after the textured one
+        dis = [ColorShapeDisplay("Solid", {
+                   "FillColor": placeholder.getRgb()[:3],
+                   "LineColor": (0, 0, 0)}),
+               ImageShapeDisplay("Floor", {"Image": imagePath})]
+        dis[0].addItem(shapes[1])
+        dis[1].addItem(shapes[0])
+        map = EMFMap(10, 10, [layer], dis)
+        path = MapExporter.exportMap(
+            map, "1", os.path.join(self.directory.name, "placeholder"),
+            imageFormat=MapExporter.SVG)[0]
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        self.assertEqual(text.count('fill="url(#texture0)"'), 1)
+        self.assertEqual(
+            text.count('fill="{}"'.format(placeholder.name())), 1)
+        minidom.parseString(text)
+
+
 if __name__ == '__main__':
     unittest.main()
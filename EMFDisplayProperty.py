@@ -21,8 +21,11 @@ If not, see <https://www.gnu.org/licenses/>.
 
 from PyQt5.QtWidgets import QFrame, QGridLayout, QLabel
 from PyQt5.QtGui import QPalette
+from PyQt5.QtCore import QRectF
 
 from EMFNodes import NodeLayer
+from EMFDIValueStore import DIValueStore
+from EMFHistory import AttributeCommand
 
 
 """
@@ -82,7 +85,7 @@ class EMFDisplayItem:
         self.name = name
         self.parentMap = None
         self.allowedClassItems = allowedClass
-        self.propertyItems = []
+        self.valueStore = DIValueStore(self)
         self.sharedAttributes = {}
         self.individualAttributes = {}
 
@@ -95,23 +98,45 @@ class EMFDisplayItem:
 
     def addItem(self, item, values=None):
         if (isinstance(item, self.allowedClassItems) and
-                item not in self.propertyItems):
-            self.propertyItems.append(item)
+                item not in self.valueStore):
             item.addIndividualAttributes(self, values)
 
+    # Add many items at once. columns maps attribute names to a list with a
+    # value for each item, as read from a binary save file
+    def addItemsFromColumns(self, items, columns):
+        seen = set()
+        keep = []
+        for pos in range(len(items)):
+            item = items[pos]
+            if (isinstance(item, self.allowedClassItems) and
+                    item not in self.valueStore and item not in seen):
+                seen.add(item)
+                keep.append(pos)
+        if len(keep) < len(items):
+            items = [items[pos] for pos in keep]
+            columns = {name: [columns[name][pos] for pos in keep]
+                       for name in columns}
+        if len(items) > 0:
+            self.valueStore.addItemsFromColumns(items, columns)
+            for item in items:
+                item.joinValueStore(self)
+
     def removeAllItems(self):
-        for item in self.propertyItems:
+        for item in self.valueStore.items():
             item.removeDI(self)
 
     def removeItem(self, item):
-        if item in self.propertyItems:
-            self.propertyItems.remove(item)
+        self.valueStore.removeItem(item)
 
     def getAllowedClass(self):
         return self.allowedClassItems
 
     def getPropertyItems(self):
-        return self.propertyItems
+        return self.valueStore.items()
+
+    # The individual attribute values of every item joined to this DI
+    def getValueStore(self):
+        return self.valueStore
 
     def getSharedAttributes(self):
         return self.sharedAttributes
@@ -122,30 +147,91 @@ class EMFDisplayItem:
     def getName(self):
         return self.name
 
-    def valueUpdated(self, attrName):
+    # The current value of each individual attribute. Items added without
+    # values of their own are given these
+    def individualValues(self):
+        values = {}
+        for name in self.individualAttributes:
+            values[name] = self.individualAttributes[name].getValue()
+        return values
+
+    # previous is the (value, jsonValue) of the attribute before it changed,
+    # used to record the edit so it can be undone
+    def valueUpdated(self, attrName, previous=None):
+        itemValues = None
+        layerVersions = {}
         if attrName in self.individualAttributes:
+            attr = self.individualAttributes[attrName]
             if self.allowedClassItems == NodeLayer:
                 curLayer = self.parentMap.getCurrentLayer()
-                if curLayer in self.propertyItems:
-                    curLayer.updateAttribute(
-                        self, self.individualAttributes[attrName])
+                itemSet = [curLayer] if curLayer in self.valueStore else []
             else:
                 selectedItems = self.parentMap.getSelectedItems()
-                itemSet = set(selectedItems).intersection(self.propertyItems)
-                for item in itemSet:
-                    item.updateAttribute(self,
-                                         self.individualAttributes[attrName])
+                itemSet = [item for item in selectedItems
+                           if item in self.valueStore]
+            itemValues = [(item, self.valueStore.value(item, attrName))
+                          for item in itemSet]
+            layerVersions = self.layerVersions(itemSet)
+            for item in itemSet:
+                item.updateAttribute(self, attr)
         else:
-            for item in self.propertyItems:
+            attr = self.sharedAttributes[attrName]
+            items = self.valueStore.items()
+            layerVersions = self.layerVersions(items)
+            for item in items:
                 item.sharedAttributeUpdated()
+        if previous is not None:
+            command = AttributeCommand(
+                self, attrName, previous,
+                (attr.getValue(), attr.getJSONValue()), itemValues)
+            command.layerVersions = layerVersions
+            self.parentMap.getHistory().push(command)
         self.parentMap.diUpdated()
 
+    # The version of the layer of each of items, before they are updated
+    @classmethod
+    def layerVersions(cls, items):
+        versions = {}
+        for item in items:
+            layer = item.ParentLayer()
+            if layer is not None and layer not in versions:
+                versions[layer] = layer.version()
+        return versions
+
+    # Start decoding any images of the DI on worker threads, ahead of drawing
+    def prefetchImages(self):
+        if len(self.valueStore) > 0:
+            for attr in self.sharedAttributes.values():
+                if attr.isImagePath() and attr.getValue() is not None:
+                    attr.getValue().prefetch()
+
     def drawDisplay(self, painter, layer, simple=True):
         drawMethod = self.drawSimple if simple else self.drawComplex
-        for item in self.propertyItems:
+        for item in self.valueStore.items():
             if layer.containsItem(item):
                 drawMethod(painter, item)
 
+    # draw only the given items, which must be joined to the DI
+    def drawItems(self, painter, items, simple=True):
+        drawMethod = self.drawSimple if simple else self.drawComplex
+        for item in items:
+            drawMethod(painter, item)
+
+    # The area the drawing of item covers, as a QRectF in layer pixels, or
+    # None if it may cover anything. Exports use it to skip the items
+    # outside the area they draw
+    def itemBounds(self, item):
+        return None
+
+    # The bounding QRectF of points, grown by margin on every side
+    @classmethod
+    def pointBounds(cls, points, margin):
+        xs = [point.x() for point in points]
+        ys = [point.y() for point in points]
+        return QRectF(min(xs) - margin, min(ys) - margin,
+                      max(xs) - min(xs) + 2 * margin,
+                      max(ys) - min(ys) + 2 * margin)
+
     # draw the simple representation, which is easier to process
     def drawSimple(self, painter, item):
         print("Need to implement!")
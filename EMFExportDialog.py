@@ -19,18 +19,24 @@ along with Encounter Mapper Freeform.
 If not, see <https://www.gnu.org/licenses/>.
 """
 
-from PyQt5.QtGui import QPixmap, QPainter, QColor, QRegExpValidator
-from PyQt5.QtCore import QRegExp
+from PyQt5.QtGui import QRegExpValidator
+from PyQt5.QtCore import QRegExp, Qt
 
 from PyQt5.QtWidgets import (QLabel, QLineEdit, QPushButton, QRadioButton,
-                             QGridLayout, QFileDialog)
+                             QGridLayout, QFileDialog, QSpinBox,
+                             QProgressDialog, QApplication, QComboBox,
+                             QCheckBox, QMessageBox)
 from EMFEditAction import EditAction
+from EMFExporter import MapExporter
+from EMFNodes import NodeLayer
 
 """
 The ExportDialog is used whenever one is exporting images from an EMFMap. It
 contains the options to specify which layers are put on which image, similar
 to a file printer dialog. It also contains the helper abilities to specify
-all layers on a single image, or all independently
+all layers on a single image, or all independently, the pixels per map cell
+of the images, and their format. Images can also be exported as Deep Zoom
+tiles for web viewers
 """
 
 
@@ -38,6 +44,14 @@ class ExportDialog(EditAction):
     SINGLE = "Single Image from Layers"
     EVERY = "Every Layer as Image"
     CUSTOM = "Custom Layers"
+    FORMAT_NAMES = {
+        MapExporter.PNG: "PNG",
+        MapExporter.PNG8: "PNG, 256 Colors",
+        MapExporter.JPEG: "JPEG",
+        MapExporter.WEBP: "WebP",
+        MapExporter.SVG: "SVG (Vector)",
+        MapExporter.PDF: "PDF (Vector)"
+    }
 
     def __init__(self, map):
         super(ExportDialog, self).__init__()
@@ -64,6 +78,24 @@ class ExportDialog(EditAction):
         self.imageLayerLineEdit.setValidator(
             QRegExpValidator(regex))
         lineEditExLabel = QLabel("ex. 1,2-3,5")
+        self.cellSizeEdit = QSpinBox()
+        self.cellSizeEdit.setMinimum(8)
+        self.cellSizeEdit.setMaximum(600)
+        self.cellSizeEdit.setValue(NodeLayer.CELL_SIZE)
+        self.cellSizeEdit.setSuffix(" px")
+        self.cellSizeEdit.valueChanged.connect(self.updateUI)
+        self.imageSizeLabel = QLabel()
+        self.formatBox = QComboBox()
+        for imageFormat in MapExporter.availableFormats():
+            self.formatBox.addItem(ExportDialog.FORMAT_NAMES[imageFormat],
+                                   imageFormat)
+        self.formatBox.currentIndexChanged.connect(self.updateUI)
+        self.qualityEdit = QSpinBox()
+        self.qualityEdit.setMinimum(0)
+        self.qualityEdit.setMaximum(100)
+        self.qualityEdit.setValue(MapExporter.DEFAULT_QUALITY)
+        self.tilesCheck = QCheckBox("Deep Zoom Tiles (.dzi)")
+        self.tilesCheck.toggled.connect(self.updateUI)
 
         self.acceptBtn.setEnabled(False)
 
@@ -75,18 +107,32 @@ class ExportDialog(EditAction):
         layout.addWidget(self.customLayerRadio, 3, 0, 1, 2)
         layout.addWidget(self.imageLayerLineEdit, 4, 0, 1, 2)
         layout.addWidget(lineEditExLabel, 5, 0, 1, 2)
-
-        layout.addWidget(self.cancelBtn, 6, 0)
-        layout.addWidget(self.acceptBtn, 6, 1)
+        layout.addWidget(QLabel("Pixels per Cell"), 6, 0)
+        layout.addWidget(self.cellSizeEdit, 6, 1)
+        layout.addWidget(self.imageSizeLabel, 7, 0, 1, 2)
+        layout.addWidget(QLabel("Format"), 8, 0)
+        layout.addWidget(self.formatBox, 8, 1)
+        layout.addWidget(QLabel("Quality"), 9, 0)
+        layout.addWidget(self.qualityEdit, 9, 1)
+        layout.addWidget(self.tilesCheck, 10, 0, 1, 2)
+
+        layout.addWidget(self.cancelBtn, 11, 0)
+        layout.addWidget(self.acceptBtn, 11, 1)
         self.setLayout(layout)
+        self.updateImageSize()
+        self.updateQuality()
 
     def setFilePath(self):
-        filePath = QFileDialog.getSaveFileName(self, "Export Encounter",
-                                               "", "Image (*.png)")
+        filePath = QFileDialog.getSaveFileName(
+            self, "Export Encounter", "",
+            "Image (*.png *.jpg *.webp *.svg *.pdf)")
         if filePath is not None:
             fp = filePath[0]
-            if fp.endswith(".png"):
-                fp = fp[:-4]
+            # the extension is added for the chosen format
+            for imageFormat in MapExporter.FORMATS:
+                extension = MapExporter.FORMATS[imageFormat][1]
+                if fp.endswith(extension):
+                    fp = fp[:-len(extension)]
             self.filePath = fp
             self.filepathLabel.setText(self.filePath)
             self.updateUI()
@@ -94,49 +140,96 @@ class ExportDialog(EditAction):
     def radioBtnChanged(self, btn):
         if btn.text() == ExportDialog.SINGLE:
             self.imageLayerLineEdit.setEnabled(False)
-            str = ("1-{}".format(self.map.getNumLayers()) if
-                   self.map.getNumLayers() > 1 else "1")
-            self.imageLayerLineEdit.setText(str)
+            self.imageLayerLineEdit.setText(
+                MapExporter.singleGroupText(self.map.getNumLayers()))
         elif btn.text() == ExportDialog.EVERY:
             self.imageLayerLineEdit.setEnabled(False)
-            str = ""
-            for i in range(1, self.map.getNumLayers()+1):
-                str += "{},".format(i)
-            str = str[:-1]
-            self.imageLayerLineEdit.setText(str)
+            self.imageLayerLineEdit.setText(
+                MapExporter.everyGroupText(self.map.getNumLayers()))
         elif btn.text() == ExportDialog.CUSTOM:
             self.imageLayerLineEdit.setEnabled(True)
 
+    # Export the images, returning False if they couldn't be written. The
+    # error is shown to the user, and the dialog can be changed and accepted
+    # again
     def performExport(self):
-        # TODO: "prettify" up code in the future
-        images = self.map.getLayerImages()
-        width = images[0].width()
-        height = images[0].height()
-        strGroup = self.imageLayerLineEdit.text().split(",")
-        addPrefix = len(strGroup) > 1
-        for index in range(len(strGroup)):
-            str = strGroup[index]
-            exportImg = QPixmap(width, height)
-            exportImg.fill(QColor(0, 0, 0, 0))
-            beginRange = -1
-            endRange = -1
-            if str.find("-") > 0:
-                group = str.split("-")
-                beginRange = int(group[0])
-                endRange = int(group[1])
-            else:
-                beginRange = int(str)
-                endRange = int(str)
-            painter = QPainter(exportImg)
-            for i in range(beginRange-1, endRange):
-                painter.drawImage(0, 0, images[i])
-            painter.end()
-            filepath = self.filePath
-            if addPrefix:
-                filepath += "_{}".format(index)
-            exportImg.save(filepath+".png", "PNG")
+        progressDialog = QProgressDialog(
+            "Exporting Encounter...", None, 0, 1000, self)
+        progressDialog.setWindowModality(Qt.WindowModal)
+        progressDialog.setMinimumDuration(500)
+
+        def updateProgress(done, total):
+            if total > 0:
+                progressDialog.setValue(int(1000 * done / total))
+            QApplication.processEvents()
+
+        export = (MapExporter.exportTiles if self.tilesCheck.isChecked()
+                  else MapExporter.exportMap)
+        try:
+            export(self.map, self.imageLayerLineEdit.text(), self.filePath,
+                   cellSize=self.cellSizeEdit.value(),
+                   progress=updateProgress,
+                   imageFormat=self.formatBox.currentData(),
+                   quality=self.qualityEdit.value())
+        except (OSError, ValueError) as error:
+            # raised by the encoding threads as well as the export itself
+            progressDialog.close()
+            QMessageBox.warning(self, "Export Encounter",
+                                "The encounter could not be exported.\n\n"
+                                "{}".format(error))
+            return False
+        progressDialog.close()
+        return True
 
     def updateUI(self):
+        self.updateImageSize()
+        self.updateQuality()
         self.acceptBtn.setEnabled(self.filePath is not None and
-                                  self.imageLayerLineEdit.hasAcceptableInput())
+                                  self.imageLayerLineEdit.hasAcceptableInput()
+                                  and self.groupsInRange())
         self.repaint()
+
+    # True if the layer groups only name layers the map has
+    def groupsInRange(self):
+        try:
+            MapExporter.parseLayerGroups(self.imageLayerLineEdit.text(),
+                                         self.map.getNumLayers())
+        except ValueError:
+            return False
+        return True
+
+    # Only the lossy formats have a quality, and vector files can't be tiled
+    def updateQuality(self):
+        imageFormat = self.formatBox.currentData()
+        self.qualityEdit.setEnabled(imageFormat in (
+            MapExporter.JPEG, MapExporter.WEBP))
+        vector = imageFormat in MapExporter.VECTOR_FORMATS
+        if vector:
+            self.tilesCheck.setChecked(False)
+        self.tilesCheck.setEnabled(not vector)
+
+    # Show the size of the images at the chosen cell size. Exports of groups
+    # too large to draw whole are written in bands, which only PNG can be, so
+    # the other image formats are disabled and PNG chosen instead
+    def updateImageSize(self):
+        cellSize = self.cellSizeEdit.value()
+        try:
+            groups = MapExporter.parseLayerGroups(
+                self.imageLayerLineEdit.text(), self.map.getNumLayers())
+        except ValueError:
+            # the formats are left alone until there are groups to export
+            groups = None
+        banded = (groups is not None and not self.tilesCheck.isChecked() and
+                  MapExporter.needsBands(self.map, groups, cellSize))
+        self.imageSizeLabel.setText("{} x {} px{}".format(
+            self.map.getWidth() * cellSize, self.map.getHeight() * cellSize,
+            ", PNG only" if banded else ""))
+        model = self.formatBox.model()
+        for index in range(self.formatBox.count()):
+            imageFormat = self.formatBox.itemData(index)
+            model.item(index).setEnabled(
+                not banded or imageFormat == MapExporter.PNG or
+                imageFormat in MapExporter.VECTOR_FORMATS)
+        if not model.item(self.formatBox.currentIndex()).isEnabled():
+            self.formatBox.setCurrentIndex(
+                self.formatBox.findData(MapExporter.PNG))
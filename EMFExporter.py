@@ -0,0 +1,1023 @@
+"""
+Encounter Mapper Freeform is a node-based encounter map creator for tabletop
+RPGs. Copyright 2020 Eric Symmank
+
+This file is part of Encounter Mapper Freeform.
+
+Encounter Mapper Freeform is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper Freeform is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper Freeform.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+from concurrent.futures.process import BrokenProcessPool
+import argparse
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+from xml.etree import ElementTree
+
+import numpy
+from PyQt5.QtCore import QBuffer, QMarginsF, QRect, QSize, QSizeF, Qt
+from PyQt5.QtGui import (QBrush, QColor, QImage, QImageWriter, QPageSize,
+                         QPainter, QPdfWriter, qRgba)
+from PyQt5.QtWidgets import QApplication
+try:
+    from PyQt5.QtSvg import QSvgGenerator
+except ImportError:
+    # QtSvg is packaged separately on some systems
+    QSvgGenerator = None
+
+from EMFLayerParser import LayerParser
+from EMFMapIO import EMFMapIO
+from EMFNodes import NodeLayer
+from EMFPNGWriter import PNGWriter
+
+"""
+MapExporter exports the layers of a map as images. Which layers go on
+which image is given as layer groups, the same text used by the ExportDialog:
+"1,2-3,5" exports layer 1, layers 2 and 3 drawn together, and layer 5 as three
+images. With more than one group, the index of the group is added to the name
+of each image. Only the layers in some group are drawn, and groups starting
+at the same layer reuse each other's composites, so exporting every floor of
+a building stacked on the ones below (1,1-2,1-3...) draws each layer once.
+
+Images are drawn at NodeLayer.CELL_SIZE pixels per cell, like the editor, or
+at any other cell size: the layers are drawn through a scaled painter, so
+lines, shapes and text stay sharp at print resolutions instead of being
+resampled from the editor's images.
+
+Images are encoded on a pool of threads while the next group is composited,
+so an export of many groups takes about as long as its slowest image rather
+than the sum of them. level is the zlib compression level of the PNG files,
+from 0 (fastest, largest) to 9, or None for the default. progress, if given,
+is called with (done, total) as images or bands are written.
+
+Besides PNG, images can be written as 8 bit palettized PNG, quantized to 256
+colors, which suits maps of flat colors, or as lossy JPEG or WebP at a
+quality from 0 to 100, which suits painted maps. JPEG has no transparency, so
+its images are drawn over white. Conversion and encoding both happen on the
+encoding threads.
+
+For web viewers, a group can instead be exported as a Deep Zoom pyramid: a
+.dzi file describing the image and a _files folder with a folder of
+TILE_SIZE pixel tiles for each level, the last level at full size and each
+one before it half the size, down to a single pixel. Every level is drawn
+from the layers at its own scale, rather than shrunk from the full image, so
+a viewer only loads the tiles it shows and even small levels stay sharp.
+
+Maps can also be exported as SVG or PDF, where the display items draw
+through the same code onto a vector device instead of an image. Nothing is
+rasterized except the images the items draw, which are embedded once however
+many times they are used, and the files scale to any size. One map cell is an
+inch at the default cell size.
+
+Maps too large to keep whole images of are exported in bands instead: each
+layer is drawn a band of rows at a time, the bands are composited, and the
+rows are streamed into a PNGWriter for each image. Memory is then bounded by
+BAND_BYTES rather than the size of the map.
+
+Run as a script, it exports any number of .emf files without the editor,
+drawing with the offscreen Qt platform. Each file is exported in a separate
+process, so a batch of maps uses every core:
+
+    python EMFExporter.py campaign/*.emf --layers 1-3 --output exports
+"""
+
+
+class MapExporter:
+    # group text for every layer on one image, or an image for every layer
+    SINGLE = "single"
+    EVERY = "every"
+
+    GROUP_PATTERN = re.compile(r"^\d+(-\d+)?(,\d+(-\d+)?)*$")
+    # bytes of band images drawn at once by a banded export
+    BAND_BYTES = 32 << 20
+    # exports keeping more bytes of whole images at once are written in bands
+    # instead. Qt can't allocate images of 2GB either
+    FULL_IMAGE_BYTES = 1 << 30
+    # threads encoding images, or None for one per CPU
+    ENCODE_WORKERS = None
+    DEFAULT_LEVEL = 6
+
+    # image formats, with the Qt format and extension of each
+    PNG = "png"
+    PNG8 = "png8"
+    JPEG = "jpeg"
+    WEBP = "webp"
+    SVG = "svg"
+    PDF = "pdf"
+    # the vector formats aren't written by a Qt image plugin
+    FORMATS = {
+        PNG: ("PNG", ".png"),
+        PNG8: ("PNG", ".png"),
+        JPEG: ("JPEG", ".jpg"),
+        WEBP: ("WEBP", ".webp"),
+        SVG: (None, ".svg"),
+        PDF: (None, ".pdf")
+    }
+    VECTOR_FORMATS = (SVG, PDF)
+    DEFAULT_QUALITY = 90
+    # colors of a palettized image, and the bits of each channel used to
+    # group similar colors while choosing them
+    PALETTE_SIZE = 256
+    PALETTE_BITS = 4
+
+    # tiles of a Deep Zoom pyramid are TILE_SIZE pixels square
+    TILE_SIZE = 256
+    DZI_NAMESPACE = "http://schemas.microsoft.com/deepzoom/2008"
+
+    # namespaces of the SVG files QSvgGenerator writes
+    SVG_NAMESPACE = "http://www.w3.org/2000/svg"
+    XLINK_NAMESPACE = "http://www.w3.org/1999/xlink"
+
+    # The (first, last) layer numbers of each group in groupText, counting
+    # from 1. Raises ValueError if the text isn't valid for layerCount layers
+    @classmethod
+    def parseLayerGroups(cls, groupText, layerCount):
+        groupText = groupText.replace(" ", "")
+        if cls.GROUP_PATTERN.match(groupText) is None:
+            raise ValueError("Invalid layer groups '{}'".format(groupText))
+        groups = []
+        for groupStr in groupText.split(","):
+            bounds = [int(bound) for bound in groupStr.split("-")]
+            first = bounds[0]
+            last = bounds[-1]
+            if not 1 <= first <= last <= layerCount:
+                raise ValueError("Layers {} not in 1-{}".format(
+                    groupStr, layerCount))
+            groups.append((first, last))
+        return groups
+
+    # Layer groups drawing every layer onto a single image
+    @classmethod
+    def singleGroupText(cls, layerCount):
+        return "1-{}".format(layerCount) if layerCount > 1 else "1"
+
+    # Layer groups with an image for every layer
+    @classmethod
+    def everyGroupText(cls, layerCount):
+        return ",".join(str(i) for i in range(1, layerCount + 1))
+
+    # The numbers of the layers used by groups, in order
+    @classmethod
+    def groupLayerNumbers(cls, groups):
+        return sorted(set(number for first, last in groups
+                          for number in range(first, last + 1)))
+
+    # Composite the layers of each group, yielding (index, image) for each
+    # group. images maps layer numbers to their images. Groups starting at
+    # the same layer are built on top of each other, in order of their last
+    # layer, so 1-3,1-4,1-5 only draws each layer once
+    @classmethod
+    def compositeGroups(cls, groups, images):
+        prefix = None
+        for index in sorted(range(len(groups)), key=lambda i: groups[i]):
+            first, last = groups[index]
+            if prefix is not None and prefix[0] == first:
+                start = prefix[1] + 1
+                composite = prefix[2]
+            else:
+                start = first
+                composite = None
+            if start <= last:
+                composite = cls.compositeImages(
+                    [images[number] for number in range(start, last + 1)],
+                    composite)
+            prefix = (first, last, composite)
+            yield index, composite
+
+    # The path of the image of group index, out of groupCount groups
+    @classmethod
+    def imagePath(cls, filePath, index, groupCount, imageFormat=PNG):
+        return (cls.groupPath(filePath, index, groupCount) +
+                cls.FORMATS[imageFormat][1])
+
+    # The path of the files of group index, without an extension
+    @classmethod
+    def groupPath(cls, filePath, index, groupCount):
+        if groupCount > 1:
+            filePath += "_{}".format(index)
+        return filePath
+
+    # The formats the Qt image plugins installed can write, as WebP needs
+    # the separate qtimageformats plugins
+    @classmethod
+    def availableFormats(cls):
+        written = set(bytes(name).decode().upper()
+                      for name in QImageWriter.supportedImageFormats())
+        if QSvgGenerator is not None:
+            written.add(cls.SVG)
+        written.add(cls.PDF)
+        return [imageFormat for imageFormat in cls.FORMATS
+                if (cls.FORMATS[imageFormat][0] or imageFormat) in written]
+
+    # The scale drawing cellSize pixels per cell, or 1 for the editor's size
+    @classmethod
+    def cellScale(cls, cellSize=None):
+        if cellSize is None:
+            return 1.0
+        if cellSize <= 0:
+            raise ValueError("Invalid cell size {}".format(cellSize))
+        return cellSize / NodeLayer.CELL_SIZE
+
+    # Export the layer groups of map to images named after filePath, which
+    # has no extension. Returns the paths of the images. banded picks between
+    # whole images and bands, and by default bands are only used for images
+    # larger than FULL_IMAGE_BYTES. cellSize is the pixels per map cell, by
+    # default NodeLayer.CELL_SIZE. Only PNG images can be written in bands
+    @classmethod
+    def exportMap(cls, map, groupText, filePath, banded=None, cellSize=None,
+                  level=None, progress=None, imageFormat=PNG, quality=None):
+        groups = cls.parseLayerGroups(groupText, map.getNumLayers())
+        scale = cls.cellScale(cellSize)
+        cls.checkEncoding(level, imageFormat, quality)
+        if imageFormat in cls.VECTOR_FORMATS:
+            return cls.exportVector(map, groups, filePath, imageFormat, scale,
+                                    progress)
+        if banded is None:
+            banded = cls.needsBands(map, groups, cellSize)
+        if banded:
+            if imageFormat != cls.PNG:
+                raise ValueError("Only PNG images can be exported in bands")
+            return cls.exportBanded(map, groups, filePath, scale=scale,
+                                    level=level, progress=progress)
+        # only the layers in a group are drawn
+        layerNumbers = cls.groupLayerNumbers(groups)
+        images = dict(zip(layerNumbers, map.drawLayerImages(
+            [map.getLayers()[number - 1] for number in layerNumbers], scale)))
+        paths = [cls.imagePath(filePath, index, len(groups), imageFormat)
+                 for index in range(len(groups))]
+        with ThreadPoolExecutor(cls.encodeWorkers(len(groups))) as pool:
+            saves = []
+            for index, image in cls.compositeGroups(groups, images):
+                saves.append(pool.submit(
+                    cls.saveImage, image, paths[index], level, imageFormat,
+                    quality))
+            cls.waitForAll(saves, progress)
+        return paths
+
+    # True if exportMap() writes the groups of map in bands by default, which
+    # only PNG images can be. Whole images are kept of every layer in a group
+    # and of each group's composite, as they wait to be encoded
+    @classmethod
+    def needsBands(cls, map, groups, cellSize=None):
+        width, height = map.getLayers()[0].scaledDimensions(
+            cls.cellScale(cellSize))
+        imageCount = len(cls.groupLayerNumbers(groups)) + len(groups)
+        return imageCount * width * height * 4 > cls.FULL_IMAGE_BYTES
+
+    # Raises ValueError if images can't be written with these options
+    @classmethod
+    def checkEncoding(cls, level, imageFormat, quality):
+        if level is not None and not 0 <= level <= 9:
+            raise ValueError("Invalid compression level {}".format(level))
+        if quality is not None and not 0 <= quality <= 100:
+            raise ValueError("Invalid quality {}".format(quality))
+        if imageFormat not in cls.availableFormats():
+            raise ValueError("Can't write {} images".format(imageFormat))
+
+    # Export the layer groups of map as Deep Zoom pyramids named after
+    # filePath. Returns the paths of the .dzi files. Tiles are drawn a block
+    # of a row of tiles at a time, the block being at most blockBytes for
+    # all the layers and groups
+    @classmethod
+    def exportTiles(cls, map, groupText, filePath, cellSize=None, level=None,
+                    progress=None, imageFormat=PNG, quality=None,
+                    blockBytes=None):
+        groups = cls.parseLayerGroups(groupText, map.getNumLayers())
+        scale = cls.cellScale(cellSize)
+        cls.checkEncoding(level, imageFormat, quality)
+        if imageFormat in cls.VECTOR_FORMATS:
+            raise ValueError("Tiles can't be {} files".format(imageFormat))
+        layerNumbers = cls.groupLayerNumbers(groups)
+        layers = [map.getLayers()[number - 1] for number in layerNumbers]
+        dis = map.getDisplayItems()
+        NodeLayer.loadLayers(layers)
+        for di in dis:
+            di.prefetchImages()
+        width, height = layers[0].scaledDimensions(scale)
+        levels = cls.pyramidLevels(width, height)
+        bounds = [cls.itemBounds(layer, dis) for layer in layers]
+        tileSize = cls.TILE_SIZE
+        blockWidth = tileSize * cls.bandHeight(
+            tileSize * tileSize, len(layers) + len(groups),
+            cls.BAND_BYTES if blockBytes is None else blockBytes)
+        extension = cls.FORMATS[imageFormat][1]
+        paths = [cls.groupPath(filePath, index, len(groups))
+                 for index in range(len(groups))]
+        total = len(groups) * sum(
+            cls.tileCount(levelWidth) * cls.tileCount(levelHeight)
+            for levelWidth, levelHeight in levels)
+        done = 0
+        try:
+            for path in paths:
+                for number in range(len(levels)):
+                    os.makedirs(os.path.join(path + "_files", str(number)),
+                                exist_ok=True)
+            with ThreadPoolExecutor(cls.encodeWorkers(total)) as pool:
+                saves = []
+                for number, top, rows, left, columns in cls.tileBlocks(
+                        levels, blockWidth):
+                    levelScale = scale * cls.pyramidLevel(
+                        width, height, len(levels) - 1 - number)[2]
+                    blocks = {}
+                    for index in range(len(layers)):
+                        blocks[layerNumbers[index]] = layers[index].drawBand(
+                            dis, top, rows, levelScale, left, columns,
+                            cls.cullItems(bounds[index], [
+                                left / levelScale, top / levelScale,
+                                (left + columns) / levelScale,
+                                (top + rows) / levelScale]))
+                    # the tiles of one block are kept at a time
+                    done = cls.waitForAll(saves, progress, done, total)
+                    saves = []
+                    for index, block in cls.compositeGroups(groups, blocks):
+                        for x in range(0, columns, tileSize):
+                            tilePath = os.path.join(
+                                paths[index] + "_files", str(number),
+                                "{}_{}{}".format((left + x) // tileSize,
+                                                 top // tileSize, extension))
+                            tile = block.copy(
+                                x, 0, min(tileSize, columns - x), rows)
+                            saves.append(pool.submit(
+                                cls.saveImage, tile, tilePath, level,
+                                imageFormat, quality))
+                cls.waitForAll(saves, progress, done, total)
+        except BaseException:
+            for path in paths:
+                shutil.rmtree(path + "_files", ignore_errors=True)
+            raise
+        for path in paths:
+            cls.writeDZI(path + ".dzi", width, height, extension[1:])
+        return [path + ".dzi" for path in paths]
+
+    # Export the layer groups of map as SVG or PDF files, drawing the display
+    # items straight onto the file. Returns the paths of the files
+    @classmethod
+    def exportVector(cls, map, groups, filePath, imageFormat, scale=1.0,
+                     progress=None):
+        NodeLayer.loadLayers([map.getLayers()[number - 1] for number
+                              in cls.groupLayerNumbers(groups)])
+        paths = [cls.imagePath(filePath, index, len(groups), imageFormat)
+                 for index in range(len(groups))]
+        for index in range(len(groups)):
+            if imageFormat == cls.SVG:
+                cls.writeSVG(map, groups[index], paths[index], scale)
+            else:
+                cls.writePDF(map, groups[index], paths[index], scale)
+            if progress is not None:
+                progress(index + 1, len(groups))
+        return paths
+
+    # Draw the layers of group onto painter, and end it, even if drawing
+    # fails. Each layer starts with the painter as it was, as when drawing
+    # the layer's own image
+    @classmethod
+    def drawVector(cls, map, group, painter, scale):
+        if not painter.isActive():
+            raise OSError("Could not start drawing the file")
+        try:
+            dis = map.getDisplayItems()
+            painter.scale(scale, scale)
+            for number in range(group[0], group[1] + 1):
+                layer = map.getLayers()[number - 1]
+                painter.save()
+                for di in reversed(dis):
+                    di.drawDisplay(painter, layer)
+                painter.restore()
+        finally:
+            painter.end()
+
+    # The PDF is a single page with a point for each pixel of the layers at
+    # scale, so a map cell is an inch at the default cell size
+    @classmethod
+    def writePDF(cls, map, group, path, scale=1.0):
+        width, height = map.getLayers()[0].scaledDimensions(scale)
+        writer = QPdfWriter(path)
+        writer.setCreator("Encounter Mapper Freeform")
+        writer.setResolution(72)
+        writer.setPageSize(QPageSize(QSizeF(width, height), QPageSize.Point))
+        writer.setPageMargins(QMarginsF(0, 0, 0, 0))
+        try:
+            cls.drawVector(map, group, QPainter(writer), scale)
+        except BaseException:
+            # the writer starts the file as soon as it is painted on
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+    # QSvgGenerator leaves out texture brushes and writes every image where
+    # it is drawn, so the document it generates is fixed up before it is
+    # saved. The placeholder colors of the textures are chosen to differ from
+    # every solid color the map fills with, drawing it again in the rare case
+    # the first choice was later used by the map
+    @classmethod
+    def writeSVG(cls, map, group, path, scale=1.0):
+        painter = None
+        while painter is None or painter.collided():
+            reserved = () if painter is None else painter.getSolidColors()
+            text, painter = cls.generateSVG(map, group, path, scale,
+                                            reserved)
+        root = cls.linkSVGImages(text, painter.getTextures())
+        with open(path, "wb") as f:
+            ElementTree.ElementTree(root).write(f, "utf-8", True)
+
+    # The text QSvgGenerator writes for group, and the TexturePainter that
+    # drew it, its placeholder colors avoiding reserved
+    @classmethod
+    def generateSVG(cls, map, group, path, scale, reserved=()):
+        width, height = map.getLayers()[0].scaledDimensions(scale)
+        buffer = QBuffer()
+        generator = QSvgGenerator()
+        generator.setOutputDevice(buffer)
+        generator.setResolution(72)
+        generator.setSize(QSize(width, height))
+        generator.setViewBox(QRect(0, 0, width, height))
+        generator.setTitle(os.path.basename(path))
+        generator.setDescription("Exported from Encounter Mapper Freeform")
+        painter = TexturePainter(generator, reserved)
+        cls.drawVector(map, group, painter, scale)
+        return bytes(buffer.data()).decode("utf-8"), painter
+
+    # Parse the SVG text, move its images into its definitions, each image
+    # once, and fill the elements filled with a placeholder for a texture
+    # with a pattern of the texture. textures is a list of (placeholder,
+    # pixmap). Returns the root element
+    @classmethod
+    def linkSVGImages(cls, text, textures):
+        ElementTree.register_namespace("", cls.SVG_NAMESPACE)
+        ElementTree.register_namespace("xlink", cls.XLINK_NAMESPACE)
+        svg = "{%s}" % cls.SVG_NAMESPACE
+        href = "{%s}href" % cls.XLINK_NAMESPACE
+        root = ElementTree.fromstring(text)
+        defs = root.find(svg + "defs")
+        if defs is None:
+            defs = ElementTree.Element(svg + "defs")
+            root.insert(0, defs)
+        definitions = []
+        imageIds = {}
+
+        def imageId(width, height, data):
+            key = (width, height, data)
+            if key not in imageIds:
+                imageIds[key] = "image{}".format(len(imageIds))
+                definitions.append(ElementTree.Element(svg + "image", {
+                    "id": imageIds[key], "width": width, "height": height,
+                    "preserveAspectRatio": "none", href: data}))
+            return imageIds[key]
+
+        patternIds = {}
+        for index in range(len(textures)):
+            placeholder, texture = textures[index]
+            patternIds[placeholder] = "texture{}".format(index)
+            pattern = ElementTree.Element(svg + "pattern", {
+                "id": patternIds[placeholder],
+                "patternUnits": "userSpaceOnUse",
+                "width": str(texture.width()),
+                "height": str(texture.height())})
+            ElementTree.SubElement(pattern, svg + "use", {
+                href: "#" + imageId(str(texture.width()),
+                                    str(texture.height()),
+                                    cls.pngDataURL(texture.toImage()))})
+            definitions.append(pattern)
+
+        for parent in root.iter():
+            for index in range(len(parent)):
+                element = parent[index]
+                if element.get("fill") in patternIds:
+                    element.set("fill", "url(#{})".format(
+                        patternIds[element.get("fill")]))
+                data = element.get(href, "")
+                if element.tag == svg + "image" and data.startswith("data:"):
+                    # the image is drawn where it was, at its own size
+                    attributes = dict(element.attrib)
+                    use = ElementTree.Element(svg + "use", {
+                        href: "#" + imageId(attributes.pop("width"),
+                                            attributes.pop("height"),
+                                            attributes.pop(href))})
+                    attributes.pop("preserveAspectRatio", None)
+                    use.attrib.update(attributes)
+                    use.tail = element.tail
+                    parent[index] = use
+        # imageId() added the images of the textures before their patterns
+        for index in range(len(definitions)):
+            defs.insert(index, definitions[index])
+        # patterns aren't part of SVG Tiny
+        root.set("version", "1.1")
+        root.attrib.pop("baseProfile", None)
+        return root
+
+    # image as a data URL, the way QSvgGenerator embeds images
+    @classmethod
+    def pngDataURL(cls, image):
+        buffer = QBuffer()
+        buffer.open(QBuffer.WriteOnly)
+        image.save(buffer, "PNG")
+        return "data:image/png;base64," + bytes(
+            buffer.data().toBase64()).decode("ascii")
+
+    # The (width, height) of each level of a Deep Zoom pyramid of an image
+    # width by height, from 1 x 1 up to the full size
+    @classmethod
+    def pyramidLevels(cls, width, height):
+        topLevel = (max(width, height) - 1).bit_length()
+        levels = []
+        for number in range(topLevel + 1):
+            levels.append(cls.pyramidLevel(width, height,
+                                           topLevel - number)[:2])
+        return levels
+
+    # The width and height of the level halvings below the full width x
+    # height of a pyramid, and the scale its tiles are drawn at relative to
+    # the full size. The tiles are sized and drawn from the same halvings,
+    # so they always line up
+    @classmethod
+    def pyramidLevel(cls, width, height, halvings):
+        return (-(-width >> halvings), -(-height >> halvings),
+                1 / (1 << halvings))
+
+    # The items each DI draws on layer and their bounds, as rows of left,
+    # top, right, bottom in layer pixels, so the ones outside a block of
+    # tiles can be skipped. DIs that can't tell where some of their items
+    # are drawn are left out, and draw every item
+    @classmethod
+    def itemBounds(cls, layer, dis):
+        bounds = {}
+        for di in dis:
+            items = [item for item in di.getPropertyItems()
+                     if layer.containsItem(item)]
+            rects = [di.itemBounds(item) for item in items]
+            if any(rect is None for rect in rects):
+                continue
+            bounds[di] = (items, numpy.array(
+                [(rect.left(), rect.top(), rect.right(), rect.bottom())
+                 for rect in rects], float).reshape(-1, 4))
+        return bounds
+
+    # The items of each DI in bounds, from itemBounds(), that reach into
+    # area, a left, top, right, bottom in layer pixels
+    @classmethod
+    def cullItems(cls, bounds, area):
+        left, top, right, bottom = area
+        itemLists = {}
+        for di in bounds:
+            items, rects = bounds[di]
+            inside = numpy.flatnonzero(
+                (rects[:, 0] < right) & (rects[:, 2] > left) &
+                (rects[:, 1] < bottom) & (rects[:, 3] > top))
+            itemLists[di] = [items[index] for index in inside]
+        return itemLists
+
+    # (level number, top, rows, left, columns) of each block of tiles drawn
+    # at once, covering every level. Blocks are a row of tiles high and at
+    # most blockWidth wide
+    @classmethod
+    def tileBlocks(cls, levels, blockWidth):
+        for number in range(len(levels)):
+            levelWidth, levelHeight = levels[number]
+            for top in range(0, levelHeight, cls.TILE_SIZE):
+                rows = min(cls.TILE_SIZE, levelHeight - top)
+                for left in range(0, levelWidth, blockWidth):
+                    yield (number, top, rows, left,
+                           min(blockWidth, levelWidth - left))
+
+    # The number of tiles across length pixels
+    @classmethod
+    def tileCount(cls, length):
+        return -(-length // cls.TILE_SIZE)
+
+    @classmethod
+    def writeDZI(cls, path, width, height, tileFormat):
+        with open(path, "w") as f:
+            f.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="{}" Format="{}" Overlap="0" TileSize="{}">\n'
+                '  <Size Width="{}" Height="{}"/>\n'
+                '</Image>\n'.format(cls.DZI_NAMESPACE, tileFormat,
+                                     cls.TILE_SIZE, width, height))
+
+    # Save image to path in imageFormat. PNG images use zlib compression
+    # level, and JPEG and WebP images quality
+    @classmethod
+    def saveImage(cls, image, path, level=None, imageFormat=PNG,
+                  quality=None):
+        if imageFormat in (cls.PNG, cls.PNG8):
+            # Qt takes a quality from 100 (no compression) to 0, which it
+            # turns back into a level as (100 - quality) * 9 // 91
+            quality = -1 if level is None else 100 - (level * 91 + 8) // 9
+            if imageFormat == cls.PNG8:
+                image = cls.palettized(image)
+        else:
+            quality = cls.DEFAULT_QUALITY if quality is None else quality
+            if imageFormat == cls.JPEG:
+                image = cls.flattened(image)
+        if not image.save(path, cls.FORMATS[imageFormat][0], quality):
+            raise OSError("Could not write {}".format(path))
+
+    # image drawn over white, without transparency
+    @classmethod
+    def flattened(cls, image):
+        flat = QImage(image.width(), image.height(), QImage.Format_RGB32)
+        flat.fill(0xFFFFFFFF)
+        painter = QPainter(flat)
+        painter.drawImage(0, 0, image)
+        painter.end()
+        return flat
+
+    # image with a palette of at most PALETTE_SIZE colors. Colors are grouped
+    # by the first PALETTE_BITS of each channel, and the most used groups
+    # become the palette, each the average of its colors. A map with few
+    # colors keeps them exactly, while antialiased edges and gradients go to
+    # the nearest color in the palette
+    @classmethod
+    def palettized(cls, image):
+        width = image.width()
+        height = image.height()
+        rgba = cls.imageRows(image).reshape(height, width, 4)
+        shift = 8 - cls.PALETTE_BITS
+        keys = numpy.zeros((height, width), numpy.int64)
+        for channel in range(4):
+            keys <<= cls.PALETTE_BITS
+            keys |= rgba[:, :, channel] >> shift
+        keys = keys.ravel()
+        groupCount = 1 << (4 * cls.PALETTE_BITS)
+        counts = numpy.bincount(keys, minlength=groupCount)
+        used = numpy.flatnonzero(counts)
+        means = numpy.empty((len(used), 4))
+        for channel in range(4):
+            sums = numpy.bincount(keys, rgba[:, :, channel].ravel(),
+                                  groupCount)
+            means[:, channel] = sums[used] / counts[used]
+
+        order = numpy.argsort(-counts[used], kind="stable")
+        palette = means[order[:cls.PALETTE_SIZE]]
+        lookup = numpy.zeros(groupCount, numpy.uint8)
+        # the group of each palette color is its own, other groups take the
+        # closest color, a few thousand at a time
+        for start in range(0, len(used), 4096):
+            block = means[start:start + 4096]
+            distances = ((block[:, None, :] - palette[None, :, :]) ** 2).sum(2)
+            lookup[used[start:start + 4096]] = distances.argmin(1)
+        lookup[used[order[:cls.PALETTE_SIZE]]] = numpy.arange(len(palette))
+
+        indexed = QImage(width, height, QImage.Format_Indexed8)
+        palette = numpy.rint(palette).astype(int)
+        indexed.setColorTable([qRgba(*color) for color in palette.tolist()])
+        bits = indexed.bits()
+        bits.setsize(indexed.sizeInBytes())
+        pixels = numpy.frombuffer(bits, numpy.uint8).reshape(
+            height, indexed.bytesPerLine())
+        pixels[:, :width] = lookup[keys].reshape(height, width)
+        return indexed
+
+    # Wait for every future, reporting each one done to progress. The first
+    # error is raised once they are all done. Returns the count done so far
+    @classmethod
+    def waitForAll(cls, futures, progress=None, done=0, total=None):
+        total = len(futures) if total is None else total
+        error = None
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                error = error or future.exception()
+            done += 1
+            if progress is not None and error is None:
+                progress(done, total)
+        if error is not None:
+            raise error
+        return done
+
+    @classmethod
+    def encodeWorkers(cls, imageCount):
+        workers = (os.cpu_count() or 1 if cls.ENCODE_WORKERS is None
+                   else cls.ENCODE_WORKERS)
+        return max(1, min(workers, imageCount))
+
+    # Export each group a band of rows at a time. Only the layers in a group
+    # and a band of each image are kept in memory. The bands of the groups
+    # are encoded at the same time, while the next band is drawn
+    @classmethod
+    def exportBanded(cls, map, groups, filePath, bandBytes=None, scale=1.0,
+                     level=None, progress=None):
+        layerNumbers = cls.groupLayerNumbers(groups)
+        layers = [map.getLayers()[number - 1] for number in layerNumbers]
+        dis = map.getDisplayItems()
+        if scale == 1:
+            # bands are copied from the layer images that are up to date,
+            # so only the other layers need loading
+            map.restoreCachedImages(layers)
+            NodeLayer.loadLayers([layer for layer in layers
+                                  if layer.getLayerImage() is None or
+                                  layer.NeedsRedraw()])
+        else:
+            # every layer is drawn again at the scale, so images of the
+            # layers at the editor's size would only take up memory
+            NodeLayer.loadLayers(layers)
+        width, height = layers[0].scaledDimensions(scale)
+        bandHeight = cls.bandHeight(
+            width, len(layers) + len(groups),
+            cls.BAND_BYTES if bandBytes is None else bandBytes)
+
+        paths = [cls.imagePath(filePath, index, len(groups))
+                 for index in range(len(groups))]
+        level = cls.DEFAULT_LEVEL if level is None else level
+        files = []
+        try:
+            writers = []
+            for path in paths:
+                files.append(open(path, "wb"))
+                writers.append(PNGWriter(files[-1], width, height, level))
+            with ThreadPoolExecutor(cls.encodeWorkers(len(groups))) as pool:
+                writes = []
+                for top in range(0, height, bandHeight):
+                    rows = min(bandHeight, height - top)
+                    bands = {}
+                    for number, layer in zip(layerNumbers, layers):
+                        bands[number] = layer.drawBand(dis, top, rows, scale)
+                    # each writer has to get its bands in order
+                    cls.waitForAll(writes)
+                    if progress is not None and top > 0:
+                        progress(top, height)
+                    writes = [pool.submit(cls.writeBand, writers[index], band)
+                              for index, band in
+                              cls.compositeGroups(groups, bands)]
+                cls.waitForAll(writes)
+            for writer in writers:
+                writer.finish()
+            if progress is not None:
+                progress(height, height)
+        except BaseException:
+            for f in files:
+                f.close()
+                os.remove(f.name)
+            raise
+        for f in files:
+            f.close()
+        return paths
+
+    @classmethod
+    def writeBand(cls, writer, band):
+        writer.writeRows(cls.imageRows(band))
+
+    # Rows per band, so that imageCount band images take up bandBytes
+    @classmethod
+    def bandHeight(cls, width, imageCount, bandBytes):
+        return max(1, bandBytes // (width * 4 * imageCount))
+
+    # The images drawn over each other, from the first, on top of a copy of
+    # base if it is given
+    @classmethod
+    def compositeImages(cls, images, base=None):
+        if base is None:
+            composite = QImage(images[0].width(), images[0].height(),
+                               QImage.Format_ARGB32_Premultiplied)
+            composite.fill(0)
+        else:
+            composite = base.copy()
+        painter = QPainter(composite)
+        for image in images:
+            painter.drawImage(0, 0, image)
+        painter.end()
+        return composite
+
+    # The pixels of image as rows of unpremultiplied RGBA bytes
+    @classmethod
+    def imageRows(cls, image):
+        image = image.convertToFormat(QImage.Format_RGBA8888)
+        data = numpy.frombuffer(image.constBits().asstring(
+            image.sizeInBytes()), numpy.uint8)
+        rows = data.reshape(image.height(), image.bytesPerLine())
+        return rows[:, :image.width() * 4]
+
+    # Open the map at mapPath and export it, as images or with tiles set as
+    # Deep Zoom pyramids. groupText may also be MapExporter.SINGLE or
+    # MapExporter.EVERY
+    @classmethod
+    def exportFile(cls, mapPath, groupText, filePath, banded=None,
+                   cellSize=None, level=None, imageFormat=PNG, quality=None,
+                   tiles=False):
+        cls.ensureApplication()
+        map = EMFMapIO.loadMap(mapPath, lazy=True)
+        if map is None:
+            raise ValueError("Could not open {}".format(mapPath))
+        if groupText == cls.SINGLE:
+            groupText = cls.singleGroupText(map.getNumLayers())
+        elif groupText == cls.EVERY:
+            groupText = cls.everyGroupText(map.getNumLayers())
+        if tiles:
+            return cls.exportTiles(map, groupText, filePath, cellSize, level,
+                                   imageFormat=imageFormat, quality=quality)
+        return cls.exportMap(map, groupText, filePath, banded, cellSize,
+                             level, imageFormat=imageFormat, quality=quality)
+
+    # Drawing needs an application, which is created on the offscreen
+    # platform when run without the editor
+    @classmethod
+    def ensureApplication(cls):
+        if QApplication.instance() is None:
+            os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+            cls.application = QApplication([])
+
+    # Export every map in mapPaths, jobs at a time. Images are written next
+    # to each map, or to outputDir. Returns a list of (mapPath, paths, error)
+    @classmethod
+    def exportFiles(cls, mapPaths, groupText, outputDir=None, jobs=None,
+                    banded=None, cellSize=None, level=None,
+                    imageFormat=PNG, quality=None, tiles=False):
+        tasks = []
+        for mapPath in mapPaths:
+            name = os.path.splitext(os.path.basename(mapPath))[0]
+            directory = (os.path.dirname(mapPath) if outputDir is None
+                         else outputDir)
+            tasks.append((mapPath, groupText, os.path.join(directory, name),
+                          banded, cellSize, level, imageFormat, quality,
+                          tiles))
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        results = []
+        if jobs < 2 or len(tasks) < 2:
+            for task in tasks:
+                results.append(cls.runTask(task))
+            return results
+        # Qt can't be used after a fork, so each process starts fresh
+        context = multiprocessing.get_context("spawn")
+        broken = []
+        with ProcessPoolExecutor(min(jobs, len(tasks)), context,
+                                 cls.initProcess) as pool:
+            futures = [pool.submit(cls.runTask, task) for task in tasks]
+            for index in range(len(tasks)):
+                try:
+                    results.append(futures[index].result())
+                except BrokenProcessPool:
+                    results.append(None)
+                    broken.append(index)
+        # a process that dies takes the whole pool down with it, so the maps
+        # it left unfinished are exported again in a process each, which
+        # only fails the map that killed it
+        for index in broken:
+            results[index] = cls.runIsolated(tasks[index], context)
+        return results
+
+    # Export a task in a process of its own, reporting an error if the
+    # process dies
+    @classmethod
+    def runIsolated(cls, task, context):
+        with ProcessPoolExecutor(1, context, cls.initProcess) as pool:
+            try:
+                return pool.submit(cls.runTask, task).result()
+            except BrokenProcessPool:
+                return task[0], [], "The export process stopped unexpectedly"
+
+    # Every core is already busy exporting a map, so layers are parsed and
+    # images encoded in the export process itself
+    @classmethod
+    def initProcess(cls):
+        LayerParser.WORKERS = 1
+        cls.ENCODE_WORKERS = 1
+
+    @classmethod
+    def runTask(cls, task):
+        mapPath = task[0]
+        try:
+            return mapPath, cls.exportFile(*task), None
+        except Exception as error:
+            # using the base exception class, so one broken map doesn't stop
+            # the rest of the batch
+            return mapPath, [], str(error)
+
+
+"""
+TexturePainter draws the same as QPainter, except that brushes with a
+texture, which QSvgGenerator leaves out, are replaced with a solid color
+standing in for each texture. MapExporter.linkSVGImages() then fills the
+elements of the SVG filled with a placeholder color with a pattern of the
+texture. It also keeps the colors of every other brush, so placeholders never
+stand for a color the map really fills with, see collided()
+"""
+
+
+class TexturePainter(QPainter):
+    # placeholder colors count up from here
+    FIRST_PLACEHOLDER = 0x0F0E00
+
+    # reserved are color names the placeholders must not use
+    def __init__(self, device, reserved=()):
+        super(TexturePainter, self).__init__(device)
+        self.textures = {}
+        self.reserved = set(reserved)
+        self.solidColors = set()
+        self.nextPlaceholder = TexturePainter.FIRST_PLACEHOLDER
+
+    def setBrush(self, *args):
+        brush = QBrush(*args)
+        if brush.style() == Qt.TexturePattern:
+            texture = brush.texture()
+            key = texture.cacheKey()
+            if key not in self.textures:
+                self.textures[key] = (self.placeholder(), texture)
+            brush = QBrush(QColor(self.textures[key][0]))
+        elif brush.style() != Qt.NoBrush:
+            self.solidColors.add(brush.color().name())
+        super(TexturePainter, self).setBrush(brush)
+
+    # A color name not yet used for a placeholder or reserved
+    def placeholder(self):
+        name = QColor(self.nextPlaceholder).name()
+        while name in self.reserved or name in self.solidColors:
+            self.nextPlaceholder += 1
+            name = QColor(self.nextPlaceholder).name()
+        self.nextPlaceholder += 1
+        return name
+
+    # (placeholder color, pixmap) of each texture drawn
+    def getTextures(self):
+        return list(self.textures.values())
+
+    # The names of the colors brushes filled with, other than placeholders
+    def getSolidColors(self):
+        return set(self.solidColors)
+
+    # True if the map filled with one of the placeholder colors after it was
+    # chosen, so the drawing has to be done again reserving the colors
+    def collided(self):
+        return any(placeholder in self.solidColors
+                   for placeholder, texture in self.textures.values())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export Encounter Mapper Freeform maps as images.")
+    parser.add_argument("maps", nargs="+", help=".emf files to export")
+    parser.add_argument(
+        "-l", "--layers", default=MapExporter.SINGLE,
+        help="layer groups such as 1,2-3,5, or '{}' for every layer on one "
+             "image (the default), or '{}' for an image per layer".format(
+                 MapExporter.SINGLE, MapExporter.EVERY))
+    parser.add_argument(
+        "-o", "--output", default=None,
+        help="folder for the images, instead of next to each map")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="number of maps exported at once, one per CPU by default")
+    parser.add_argument(
+        "-b", "--banded", action="store_const", const=True, default=None,
+        help="draw and write the images a band of rows at a time, which "
+             "is slower but uses little memory. Used for very large maps "
+             "either way")
+    parser.add_argument(
+        "-c", "--cell-size", type=float, default=None,
+        help="pixels per map cell, {} by default. 300 prints a 1 inch grid "
+             "at 300 DPI".format(NodeLayer.CELL_SIZE))
+    parser.add_argument(
+        "-z", "--compression", type=int, choices=range(10), default=None,
+        metavar="0-9",
+        help="zlib compression level of the images, from 0 (fastest) to 9 "
+             "(smallest)")
+    parser.add_argument(
+        "-f", "--format", default=MapExporter.PNG,
+        choices=list(MapExporter.FORMATS),
+        help="image format: png (the default), png8 for PNG with 256 "
+             "colors, lossy jpeg or webp, or vector svg or pdf")
+    parser.add_argument(
+        "-t", "--tiles", action="store_true",
+        help="export each image as a Deep Zoom pyramid of tiles, a .dzi "
+             "file and a _files folder, for web viewers")
+    parser.add_argument(
+        "-q", "--quality", type=int, choices=range(101), default=None,
+        metavar="0-100",
+        help="quality of jpeg and webp images, {} by default".format(
+            MapExporter.DEFAULT_QUALITY))
+    args = parser.parse_args(argv)
+    if args.cell_size is not None and args.cell_size <= 0:
+        parser.error("the cell size must be positive")
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+
+    failed = 0
+    for mapPath, paths, error in MapExporter.exportFiles(
+            args.maps, args.layers, args.output, args.jobs, args.banded,
+            args.cell_size, args.compression, args.format, args.quality,
+            args.tiles):
+        if error is not None:
+            failed += 1
+            print("{}: {}".format(mapPath, error), file=sys.stderr)
+        else:
+            for path in paths:
+                print(path)
+    return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,447 @@
+"""
+Encounter Mapper Freeform is a node-based encounter map creator for tabletop
+RPGs. Copyright 2020 Eric Symmank
+
+This file is part of Encounter Mapper Freeform.
+
+Encounter Mapper Freeform is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper Freeform is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper Freeform.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+import time
+
+import numpy
+
+from EMFNodes import NodeLayer
+
+"""
+EditHistory holds the undo and redo stacks of a map. Each edit is kept as a
+small command recording only what changed, never a copy of the map, so
+undoing a transform of thousands of nodes only needs their offsets.
+
+Every command estimates its size in bytes. Once the commands together are
+larger than the budget, the oldest ones are forgotten, which keeps the
+history small no matter how long the map is edited for. A command pushed
+right after a similar one (such as each step of dragging a slider) may be
+merged into it, so the whole drag is undone at once.
+
+Listeners added with addListener() are called with each command as it is
+pushed, undone, or redone, along with whether it was undone. The autosave
+uses them to journal every edit as it happens.
+"""
+
+
+class EditHistory:
+    BUDGET = 32 << 20
+
+    def __init__(self, map, budget=BUDGET):
+        self.map = map
+        self.budget = budget
+        self.undoCommands = []
+        self.redoCommands = []
+        self.size = 0
+        self.listeners = []
+
+    # listener is called with each command pushed, undone, or redone, and
+    # True if it was undone
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def notifyListeners(self, command, undone):
+        for listener in self.listeners:
+            listener(command, undone)
+
+    # Record a command that has already been carried out
+    def push(self, command):
+        self.size -= sum(redo.byteSize() for redo in self.redoCommands)
+        self.redoCommands = []
+        last = self.undoCommands[-1] if len(self.undoCommands) > 0 else None
+        lastSize = 0 if last is None else last.byteSize()
+        if last is not None and last.mergeWith(command):
+            self.size += last.byteSize() - lastSize
+        else:
+            self.undoCommands.append(command)
+            self.size += command.byteSize()
+        self.trim()
+        self.notifyListeners(command, False)
+
+    # Undo the latest command. Returns False if there is nothing to undo
+    def undo(self):
+        if len(self.undoCommands) == 0:
+            return False
+        command = self.undoCommands.pop()
+        command.keepLayerVersions()
+        command.undo()
+        self.redoCommands.append(command)
+        self.commandsSwapped()
+        self.notifyListeners(command, True)
+        return True
+
+    # Redo the latest undone command. Returns False if there is none
+    def redo(self):
+        if len(self.redoCommands) == 0:
+            return False
+        command = self.redoCommands.pop()
+        command.keepLayerVersions()
+        command.redo()
+        self.undoCommands.append(command)
+        self.commandsSwapped()
+        self.notifyListeners(command, False)
+        return True
+
+    # Undone or redone items may no longer be in the layer, so the selection
+    # can't be kept
+    def commandsSwapped(self):
+        self.map.clearSelectedItems()
+        self.map.diUpdated()
+
+    def canUndo(self):
+        return len(self.undoCommands) > 0
+
+    def canRedo(self):
+        return len(self.redoCommands) > 0
+
+    def clear(self):
+        self.undoCommands = []
+        self.redoCommands = []
+        self.size = 0
+
+    def getBudget(self):
+        return self.budget
+
+    def setBudget(self, budget):
+        self.budget = budget
+        self.trim()
+
+    def getSize(self):
+        return self.size
+
+    # Forget the oldest commands until the history fits in the budget.
+    # Redo commands go first, as they are the least likely to be used
+    def trim(self):
+        while self.size > self.budget and len(self.redoCommands) > 0:
+            self.size -= self.redoCommands.pop(0).byteSize()
+        while self.size > self.budget and len(self.undoCommands) > 1:
+            self.size -= self.undoCommands.pop(0).byteSize()
+
+
+"""
+EditCommand is the base class of the commands kept by EditHistory. undo()
+and redo() are each called on a map in the state the command left it in, or
+the state it was in before, respectively.
+
+layerVersions holds the version of each layer the command changes, from just
+before it was last carried out, undone, or redone. Whatever creates a command
+after carrying it out sets them, as EditHistory does before undo and redo.
+"""
+
+
+class EditCommand:
+    # rough size of a python object reference and a small object
+    REF_BYTES = 8
+    OBJECT_BYTES = 64
+
+    def __init__(self):
+        self.layerVersions = {}
+
+    # The layers changed by the command
+    def layers(self):
+        return set()
+
+    # Keep the current version of every layer changed by the command, before
+    # it is undone or redone
+    def keepLayerVersions(self):
+        self.layerVersions = {layer: layer.version()
+                              for layer in self.layers()}
+
+    def undo(self):
+        pass
+
+    def redo(self):
+        pass
+
+    # Fold command, pushed right after this one, into this command. Returns
+    # False if the two can't be merged
+    def mergeWith(self, command):
+        return False
+
+    # An estimate of the memory held by the command
+    def byteSize(self):
+        return EditCommand.OBJECT_BYTES
+
+
+"""
+MoveNodesCommand records nodes being moved, by keeping the offset of every
+node in an int32 array. Nodes that didn't move aren't kept at all.
+"""
+
+
+class MoveNodesCommand(EditCommand):
+    def __init__(self, nodes, deltas):
+        super(MoveNodesCommand, self).__init__()
+        self.nodes = nodes
+        self.deltas = deltas
+
+    # The command for a NodeTransform that has been applied, or None if no
+    # nodes moved
+    @classmethod
+    def createFromTransform(cls, transform):
+        deltas = (transform.getCurrentCoordinates() -
+                  transform.getStartCoordinates())
+        moved = numpy.flatnonzero(numpy.any(deltas != 0, axis=1))
+        if len(moved) == 0:
+            return None
+        nodes = transform.getNodes()
+        command = cls([nodes[index] for index in moved.tolist()],
+                      deltas[moved].astype(numpy.int32))
+        command.layerVersions = dict(transform.getLayerVersions())
+        return command
+
+    def undo(self):
+        self.moveNodes(-self.deltas)
+
+    def redo(self):
+        self.moveNodes(self.deltas)
+
+    def layers(self):
+        return {node.ParentLayer() for node in self.nodes
+                if node.ParentLayer() is not None}
+
+    def moveNodes(self, deltas):
+        layers = set()
+        for node, (dx, dy) in zip(self.nodes, deltas.tolist()):
+            node.moveTo(node.x() + dx, node.y() + dy)
+            if node.ParentLayer() is not None:
+                layers.add(node.ParentLayer())
+        for layer in layers:
+            layer.setNeedRedraw()
+
+    def byteSize(self):
+        return (EditCommand.OBJECT_BYTES + self.deltas.nbytes +
+                EditCommand.REF_BYTES * len(self.nodes))
+
+
+"""
+LayerItemsCommand records nodes, lines, and shapes being added to or removed
+from a layer. Removing an item takes it out of the layer and off any items it
+is connected to, the same way the NodeEditor deletes items. The values of its
+DisplayItems are kept with the command, and restoring the item joins it to
+the same DIs with the same values.
+
+Restored items are added to the end of the layer lists. removedIndexes and
+appendStart record where the items were in the lists the last time they were
+removed or added, for the autosave journal.
+"""
+
+
+class LayerItemsCommand(EditCommand):
+    ITEM_BYTES = 256
+    VALUE_BYTES = 64
+
+    TYPES = (NodeLayer.TYPE_NODE, NodeLayer.TYPE_LINE, NodeLayer.TYPE_SHAPE)
+
+    def __init__(self, layer, nodes, lines, shapes, added):
+        super(LayerItemsCommand, self).__init__()
+        self.layer = layer
+        self.nodes = list(nodes)
+        self.lines = list(lines)
+        self.shapes = list(shapes)
+        self.added = added
+        # item -> {di: values} of the removed items joined to any DIs
+        self.diValues = {}
+        # the indexes of the nodes, lines, and shapes in the layer lists
+        # before they were last removed
+        self.removedIndexes = None
+        # the length of each layer list before the items were last added.
+        # Items that were just added are the last ones in the lists
+        self.appendStart = None
+        if added:
+            self.appendStart = [
+                len(layer.getList(self.TYPES[i])) - len(items)
+                for i, items in enumerate((self.nodes, self.lines,
+                                           self.shapes))]
+
+    # Remove the items from layer, recording the command
+    @classmethod
+    def removeItems(cls, layer, nodes, lines, shapes):
+        command = cls(layer, nodes, lines, shapes, False)
+        command.keepLayerVersions()
+        command.removeFromLayer()
+        return command
+
+    def layers(self):
+        return {self.layer}
+
+    def undo(self):
+        if self.added:
+            self.removeFromLayer()
+        else:
+            self.restoreToLayer()
+
+    def redo(self):
+        if self.added:
+            self.restoreToLayer()
+        else:
+            self.removeFromLayer()
+
+    def removeFromLayer(self):
+        self.diValues = {}
+        self.removedIndexes = []
+        for type, items in zip(self.TYPES,
+                               (self.nodes, self.lines, self.shapes)):
+            indexes = self.layer.itemIndexes(type)
+            self.removedIndexes.append(
+                [indexes[item] for item in items if item in indexes])
+        for shape in self.shapes:
+            self.keepDIValues(shape)
+            shape.shapeDeleted()
+            self.layer.removeFromLayer(NodeLayer.TYPE_SHAPE, shape)
+        for line in self.lines:
+            self.keepDIValues(line)
+            line.lineDeleted()
+            self.layer.removeFromLayer(NodeLayer.TYPE_LINE, line)
+        for node in self.nodes:
+            self.keepDIValues(node)
+            node.nodeDeleted()
+            self.layer.removeFromLayer(NodeLayer.TYPE_NODE, node)
+
+    def restoreToLayer(self):
+        self.appendStart = [len(self.layer.getList(type))
+                            for type in self.TYPES]
+        for node in self.nodes:
+            self.layer.addItemToLayer(NodeLayer.TYPE_NODE, node)
+            self.restoreDIValues(node)
+        for line in self.lines:
+            for node in line.nodes():
+                node.addLine(line)
+            self.layer.addItemToLayer(NodeLayer.TYPE_LINE, line)
+            self.restoreDIValues(line)
+        for shape in self.shapes:
+            for node in shape.nodes():
+                node.addShape(shape)
+            for line in shape.lines():
+                line.addShape(shape)
+            shape.setUpdating(True)
+            self.layer.addItemToLayer(NodeLayer.TYPE_SHAPE, shape)
+            self.restoreDIValues(shape)
+        self.diValues = {}
+
+    def keepDIValues(self, item):
+        dis = item.currentDIs()
+        if len(dis) > 0:
+            self.diValues[item] = {di: dict(item.diValues(di)) for di in dis}
+
+    def restoreDIValues(self, item):
+        values = self.diValues.get(item)
+        if values is not None:
+            for di in values:
+                di.addItem(item, values[di])
+
+    def byteSize(self):
+        valueCount = 0
+        for values in self.diValues.values():
+            for row in values.values():
+                valueCount += len(row)
+        itemCount = len(self.nodes) + len(self.lines) + len(self.shapes)
+        return (EditCommand.OBJECT_BYTES +
+                LayerItemsCommand.ITEM_BYTES * itemCount +
+                LayerItemsCommand.VALUE_BYTES * valueCount)
+
+
+"""
+AttributeCommand records an attribute of a DisplayItem being changed. For
+shared attributes only the value before and after is kept. For individual
+attributes the value each item had before is kept as well. Edits to the same
+attribute of the same items within MERGE_SECONDS of each other are merged,
+so dragging a slider is undone in one step.
+"""
+
+
+class AttributeCommand(EditCommand):
+    MERGE_SECONDS = 1.0
+
+    # before and after are (value, jsonValue) pairs of the attribute.
+    # itemValues is a list of (item, value) pairs for individual attributes
+    def __init__(self, di, attrName, before, after, itemValues=None):
+        super(AttributeCommand, self).__init__()
+        self.di = di
+        self.attrName = attrName
+        self.before = before
+        self.after = after
+        self.itemValues = itemValues
+        self.editTime = time.monotonic()
+
+    # Individual attributes change the items they were edited for, while
+    # shared attributes change every item of the DI
+    def layers(self):
+        items = (self.di.getValueStore().items()
+                 if self.itemValues is None
+                 else [item for item, value in self.itemValues])
+        return {item.ParentLayer() for item in items
+                if item.ParentLayer() is not None}
+
+    def undo(self):
+        self.applyValues(self.before, True)
+
+    def redo(self):
+        self.applyValues(self.after, False)
+
+    # Set the attribute back to values, and the items to either the values
+    # they had before or to the value after
+    def applyValues(self, values, restoreItems):
+        attributes = (self.di.getIndividualAttributes()
+                      if self.itemValues is not None
+                      else self.di.getSharedAttributes())
+        attr = attributes.get(self.attrName)
+        if attr is None:
+            return
+        attr.restoreValues(values[0], values[1])
+        store = self.di.getValueStore()
+        if self.itemValues is None:
+            for item in store.items():
+                item.sharedAttributeUpdated()
+            return
+        for item, value in self.itemValues:
+            if item in store:
+                store.setValue(item, self.attrName,
+                               value if restoreItems else values[0])
+                if item.ParentLayer() is not None:
+                    item.ParentLayer().setNeedRedraw()
+
+    def mergeWith(self, command):
+        if (not isinstance(command, AttributeCommand) or
+                command.di is not self.di or
+                command.attrName != self.attrName or
+                command.editTime - self.editTime > self.MERGE_SECONDS):
+            return False
+        if (self.itemValues is None) != (command.itemValues is None):
+            return False
+        if self.itemValues is not None:
+            if len(self.itemValues) != len(command.itemValues):
+                return False
+            for (item, value), (other, otherValue) in zip(
+                    self.itemValues, command.itemValues):
+                if item is not other:
+                    return False
+        self.after = command.after
+        self.editTime = command.editTime
+        return True
+
+    def byteSize(self):
+        itemCount = 0 if self.itemValues is None else len(self.itemValues)
+        return (EditCommand.OBJECT_BYTES +
+                2 * EditCommand.REF_BYTES * itemCount)
@@ -0,0 +1,290 @@
+"""
+Encounter Mapper Freeform is a node-based encounter map creator for tabletop
+RPGs. Copyright 2020 Eric Symmank
+
+This file is part of Encounter Mapper Freeform.
+
+Encounter Mapper Freeform is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper Freeform is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper Freeform.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+import codecs
+import json
+import os
+import re
+
+import numpy
+
+"""
+JSONStreamReader reads JSON values from a binary file a chunk at a time, so a
+large document can be handled one piece at a time instead of being read into
+a single string. Only the text of the value currently being decoded is kept
+in memory.
+
+The structure around the values is walked with expect(), peek(), and
+iterArray(), while decodeValue() decodes the next complete value. progress is
+called with the number of bytes read and the file size whenever a new chunk
+is read. readRawValue() only finds where the next value ends, for text that
+is decoded later or somewhere else, and findKey() decodes a single key of
+such text without decoding the rest of it.
+"""
+
+
+class JSONStreamReader:
+    CHUNK_SIZE = 1 << 16
+    OPEN_CODES = (ord("["), ord("{"))
+    CLOSE_CODES = (ord("]"), ord("}"))
+    WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, f, progress=None, size=None):
+        self.f = f
+        self.progress = progress
+        # size is needed for files without a fileno, like zip members
+        self.size = os.fstat(f.fileno()).st_size if size is None else size
+        self.jsonDecoder = json.JSONDecoder()
+        self.reset()
+
+    # Start reading again from the start of the file
+    def reset(self):
+        self.f.seek(0)
+        self.textDecoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        # number of characters dropped from the front of the buffer
+        self.offset = 0
+        self.bytesRead = 0
+        self.finished = False
+
+    # Read and decode the next chunk, without adding it to the buffer
+    def readChunk(self):
+        chunk = self.f.read(JSONStreamReader.CHUNK_SIZE)
+        self.bytesRead += len(chunk)
+        text = self.textDecoder.decode(chunk, len(chunk) == 0)
+        self.finished = len(chunk) == 0
+        if self.progress is not None:
+            self.progress(self.bytesRead, self.size)
+        return text
+
+    # Read chunks into the buffer until at least wanted characters are after
+    # pos. The chunks are joined once, so reading a large value doesn't copy
+    # the buffer for every chunk. Returns False at the end of file
+    def fill(self, wanted=1):
+        if self.finished:
+            return False
+        pieces = [self.buffer[self.pos:]]
+        available = len(pieces[0])
+        while True:
+            text = self.readChunk()
+            pieces.append(text)
+            available += len(text)
+            if self.finished or available >= wanted:
+                break
+        self.offset += self.pos
+        self.buffer = "".join(pieces)
+        self.pos = 0
+        return not self.finished
+
+    # The position of the next character in the whole document
+    def tell(self):
+        return self.offset + self.pos
+
+    # Go back to position, as returned by tell()
+    def seek(self, position):
+        if position < self.offset:
+            self.reset()
+        while self.offset + len(self.buffer) < position:
+            if not self.fill(position - self.tell()):
+                raise ValueError("Position is past the end of the document")
+        self.pos = position - self.offset
+
+    # The next character that isn't whitespace, or "" at the end of file
+    def peek(self):
+        while True:
+            while (self.pos < len(self.buffer) and
+                   self.buffer[self.pos] in " \t\n\r"):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError("Expected '{}' at {}, found '{}'".format(
+                char, self.tell(), found))
+        self.pos += 1
+
+    def decodeValue(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.jsonDecoder.raw_decode(
+                    self.buffer, self.pos)
+                # a number at the end of the buffer may continue in the
+                # next chunk
+                if end < len(self.buffer) or self.finished:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.finished:
+                    raise
+            # read until the text after pos has doubled, so a large value
+            # is only decoded a few times
+            self.fill(2 * (len(self.buffer) - self.pos))
+
+    # Decode the next value, returning it along with its JSON text
+    def decodeRawValue(self):
+        self.peek()
+        start = self.tell()
+        value = self.decodeValue()
+        return value, self.buffer[start - self.offset:self.pos]
+
+    # The JSON text of the next value, without decoding it. Arrays and objects
+    # are skipped by counting the brackets outside of strings. The chunks of a
+    # value are collected and joined once its end is found
+    def readRawValue(self):
+        if self.peek() not in "[{":
+            return self.decodeRawValue()[1]
+        start = self.tell()
+        text = self.buffer[self.pos:]
+        end, state = JSONStreamReader.scanBrackets(text, (0, False, False))
+        if end is not None:
+            self.pos += end
+            return text[:end]
+        pieces = [text]
+        while True:
+            text = self.readChunk()
+            if self.finished and len(text) == 0:
+                raise ValueError("Unterminated value at {}".format(start))
+            end, state = JSONStreamReader.scanBrackets(text, state)
+            if end is not None:
+                pieces.append(text[:end])
+                raw = "".join(pieces)
+                self.offset = start + len(raw)
+                self.buffer = text[end:]
+                self.pos = 0
+                return raw
+            pieces.append(text)
+
+    # Find where the brackets of text close. state is (depth, inString,
+    # escaped) at the start of text. Returns the position just after the
+    # closing bracket, or None and the state at the end of text
+    @classmethod
+    def scanBrackets(cls, text, state):
+        depth, inString, escaped = state
+        if len(text) == 0:
+            return None, state
+        # one code per character, so positions match the string
+        codes = numpy.frombuffer(text.encode("utf-32-le"), numpy.uint32)
+        quotes = codes == ord('"')
+        if escaped or "\\" in text:
+            # the character after an escaping backslash is never a quote
+            skip = numpy.zeros(len(codes) + 1, bool)
+            skip[0] = escaped
+            for i in numpy.flatnonzero(codes == ord("\\")).tolist():
+                if not skip[i]:
+                    skip[i + 1] = True
+            quotes &= ~skip[:-1]
+            escaped = bool(skip[-1])
+        # odd counts of quotes so far are inside a string. A quote itself
+        # isn't a bracket, so it doesn't matter which side it counts on
+        quoteCount = numpy.cumsum(quotes)
+        outside = (quoteCount & 1) == (1 if inString else 0)
+        steps = (numpy.isin(codes, cls.OPEN_CODES).astype(numpy.int32) -
+                 numpy.isin(codes, cls.CLOSE_CODES))
+        depths = depth + numpy.cumsum(steps * outside)
+        closed = numpy.flatnonzero((depths == 0) & (steps != 0) & outside)
+        if len(closed) > 0:
+            return int(closed[0]) + 1, (0, False, False)
+        return None, (int(depths[-1]),
+                      inString != bool(quoteCount[-1] & 1), escaped)
+
+    # Find key in the JSON text of an object. The values of the other keys are
+    # skipped by counting brackets rather than decoded. Returns the decoded
+    # value along with where its text starts and ends
+    @classmethod
+    def findKey(cls, text, key):
+        decoder = json.JSONDecoder()
+
+        def skipSpace(pos):
+            return cls.WHITESPACE.match(text, pos).end()
+
+        def expect(pos, char):
+            pos = skipSpace(pos)
+            if text[pos:pos + 1] != char:
+                raise ValueError("Expected '{}' at {}".format(char, pos))
+            return skipSpace(pos + 1)
+
+        pos = expect(0, "{")
+        while text[pos:pos + 1] == '"':
+            name, pos = decoder.raw_decode(text, pos)
+            pos = expect(pos, ":")
+            if name == key:
+                value, end = decoder.raw_decode(text, pos)
+                return value, pos, end
+            if text[pos] in "[{":
+                end = cls.scanBrackets(text[pos:], (0, False, False))[0]
+                if end is None:
+                    raise ValueError("Unterminated value at {}".format(pos))
+                pos += end
+            else:
+                pos = decoder.raw_decode(text, pos)[1]
+            pos = skipSpace(pos)
+            if text[pos:pos + 1] == ",":
+                pos = skipSpace(pos + 1)
+        raise KeyError(key)
+
+    # Yield each value of the array that starts at the current position. With
+    # raw set, each value is yielded along with its JSON text
+    def iterArray(self, raw=False):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.decodeRawValue() if raw else self.decodeValue()
+            if self.peek() == "]":
+                self.pos += 1
+                return
+            self.expect(",")
+
+    # Yield the JSON text of each value of the array that starts at the
+    # current position, without decoding them
+    def iterRawArray(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.readRawValue()
+            if self.peek() == "]":
+                self.pos += 1
+                return
+            self.expect(",")
+
+    # Yield each key of the object that starts at the current position. The
+    # value of each key has to be read before asking for the next one
+    def iterObjectKeys(self):
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.decodeValue()
+            self.expect(":")
+            yield key
+            if self.peek() == "}":
+                self.pos += 1
+                return
+            self.expect(",")
@@ -0,0 +1,153 @@
+"""
+Encounter Mapper Freeform is a node-based encounter map creator for tabletop
+RPGs. Copyright 2020 Eric Symmank
+
+This file is part of Encounter Mapper Freeform.
+
+Encounter Mapper Freeform is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper Freeform is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper Freeform.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+
+"""
+LayerParser turns the JSON text of a layer into compact arrays, the same ones
+EMFBinaryFormat stores: the node coordinates, the node indexes of each line
+and shape, and a column of values for each DisplayItem attribute of the items
+joined to it. NodeLayer.addParsedItems() then only has to create the items
+and hand the columns to each DI's value store.
+
+Parsing doesn't touch Qt or the map, so when there are several layers to read
+they are parsed in worker processes, while the main process builds the layers
+parsed before them. A small map is parsed in process, as starting the workers
+would take longer than reading it.
+
+defaults holds the individual values of each DisplayItem, which are used for
+values left out of the text.
+"""
+
+
+class LayerParser:
+    # item types, in the order of the typeCodes of a binding
+    ITEM_LISTS = ("Nodes", "Lines", "Shapes")
+    # layers smaller than this together are parsed without workers
+    PARALLEL_MIN_BYTES = 1 << 18
+    # number of worker processes, or None for one per CPU
+    WORKERS = None
+
+    # Parse the JSON text of a layer. Returns (coords, lineIndexes,
+    # shapeSizes, shapeIndexes, bindings), where each binding is
+    # (diIndex, typeCode, indexes, columns) as read by
+    # NodeLayer.bindColumns(). The DIs of the layer itself are only included
+    # with layerProperties set
+    @classmethod
+    def parseLayer(cls, jsText, defaults, layerProperties=True):
+        jsContents = json.loads(jsText)
+        coords = array("i")
+        for nodeJS in jsContents["Nodes"]:
+            coords.append(nodeJS["X"])
+            coords.append(nodeJS["Y"])
+        lineIndexes = array("i")
+        for lineJS in jsContents["Lines"]:
+            lineIndexes.extend(lineJS["nodes"][:2])
+        shapeSizes = array("I")
+        shapeIndexes = array("i")
+        for shapeJS in jsContents["Shapes"]:
+            shapeSizes.append(len(shapeJS["nodes"]))
+            shapeIndexes.extend(shapeJS["nodes"])
+
+        # (diIndex, typeCode) -> indexes of the items, and their values
+        groups = {}
+        itemLists = [jsContents[name] for name in cls.ITEM_LISTS]
+        if layerProperties:
+            itemLists.append([jsContents])
+        for typeCode in range(len(itemLists)):
+            itemJSs = itemLists[typeCode]
+            for index in range(len(itemJSs)):
+                properties = itemJSs[index]["DIProperties"]
+                for dIndex in properties:
+                    group = groups.get((int(dIndex), typeCode))
+                    if group is None:
+                        group = ([], [])
+                        groups[(int(dIndex), typeCode)] = group
+                    group[0].append(index)
+                    group[1].append(properties[dIndex])
+
+        bindings = []
+        for key in sorted(groups):
+            indexes, rows = groups[key]
+            bindings.append((key[0], key[1], array("i", indexes),
+                             cls.columnsFromRows(rows, defaults[key[0]])))
+        return coords, lineIndexes, shapeSizes, shapeIndexes, bindings
+
+    # A list of values for each attribute in rows. Values missing from a row
+    # are the DI's default, or for attributes the DI doesn't have, the first
+    # value given, as DIValueStore does
+    @classmethod
+    def columnsFromRows(cls, rows, defaults):
+        fill = dict(defaults)
+        for row in rows:
+            for name in row:
+                if name not in fill:
+                    fill[name] = row[name]
+        columns = {}
+        for name in fill:
+            value = fill[name]
+            columns[name] = [row.get(name, value) for row in rows]
+        return columns
+
+    # Parse each job, a (jsText, defaults, layerProperties) tuple, yielding
+    # the results in order. jobs may be a generator reading the layers from a
+    # file, in which case only a few layers are read ahead of the results
+    @classmethod
+    def parseLayers(cls, jobs, workers=None):
+        workers = cls.workerCount() if workers is None else workers
+        jobs = iter(jobs)
+        firstJobs = list(itertools.islice(jobs, 2))
+        jobs = itertools.chain(firstJobs, jobs)
+        pool = None
+        if (workers > 1 and len(firstJobs) > 1 and
+                sum(len(job[0]) for job in firstJobs) >=
+                cls.PARALLEL_MIN_BYTES):
+            try:
+                # forking would copy the app's threads and Qt state into
+                # the workers, so each one starts fresh
+                pool = ProcessPoolExecutor(
+                    workers, multiprocessing.get_context("spawn"))
+            except (OSError, NotImplementedError):
+                # processes can't be started here
+                pool = None
+        if pool is None:
+            for job in jobs:
+                yield cls.parseLayer(*job)
+            return
+        with pool:
+            pending = collections.deque()
+            for job in jobs:
+                pending.append(pool.submit(cls.parseLayer, *job))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+
+    @classmethod
+    def workerCount(cls):
+        if cls.WORKERS is not None:
+            return cls.WORKERS
+        return os.cpu_count() or 1
@@ -28,6 +28,7 @@ from EMFNodes import EMFLine, EMFNodeHelper
 from EMFAttribute import (EMFAttribute, ScrollbarAttributeWidget,
                           ColorAttributeWidget, SpinboxAttributeWidget,
                           FilePickerAttributeWidget, CheckBoxAttributeWidget)
+from EMFAssets import EMFAssets
 import math
 
 
@@ -77,7 +78,8 @@ class ImageLineDisplay(EMFDisplayItem):
         if shared is None:
             shared = {"Image": (None, "Choose a file...")}
         else:
-            shared["Image"] = (QPixmap(shared["Image"]), shared["Image"])
+            shared["Image"] = (EMFAssets.imageHandle(shared["Image"]),
+                               shared["Image"])
         if indiv is None:
             indiv = {"Opacity": 100,
                      "ShowEndCaps": True,
@@ -110,6 +112,15 @@ class ImageLineDisplay(EMFDisplayItem):
     def classStr(self):
         return "ImageLineDisplay"
 
+    def itemBounds(self, item):
+        handle = self.sharedAttributes["Image"].getValue()
+        if handle is None:
+            return None
+        # the image is as thick as it is high, and the end caps are at most
+        # half that past each end
+        return self.pointBounds([node.point() for node in item.nodes()],
+                                handle.pixmap().height() + 1)
+
     def drawSimple(self, painter, item):
         # draw the shape's polygon
         points = item.nodes()
@@ -117,8 +128,8 @@ class ImageLineDisplay(EMFDisplayItem):
         median = EMFNodeHelper.medianNode(points)
         values = item.diValues(self)
 
-        pm = self.sharedAttributes["Image"].getValue()
-        pm = QPixmap("error_image.png") if pm is None else pm
+        handle = self.sharedAttributes["Image"].getValue()
+        pm = QPixmap("error_image.png") if handle is None else handle.pixmap()
         thickness = pm.height()
         wallpm = None
         if values["ShowEndCaps"]:
@@ -213,7 +224,8 @@ class ImageDoorDisplay(EMFDisplayItem):
         if shared is None:
             shared = {"Image": (None, "Choose a file...")}
         else:
-            shared["Image"] = (QPixmap(shared["Image"]), shared["Image"])
+            shared["Image"] = (EMFAssets.imageHandle(shared["Image"]),
+                               shared["Image"])
         if indiv is None:
             indiv = {"Position": 100,
                      "ReverseImage": False,
@@ -246,6 +258,18 @@ class ImageDoorDisplay(EMFDisplayItem):
     def classStr(self):
         return "ImageDoorDisplay"
 
+    def itemBounds(self, item):
+        handle = self.sharedAttributes["Image"].getValue()
+        if handle is None:
+            return None
+        pm = handle.pixmap()
+        values = item.diValues(self)
+        num = max(1, values["Number"])
+        width = pm.width() * num + values["Spacing"] * (num - 1)
+        # the images are drawn around a point on the line, at any angle
+        return self.pointBounds([node.point() for node in item.nodes()],
+                                (width + pm.height()) / 2 + 1)
+
     def drawSimple(self, painter, item):
         points = item.nodes()
         comparison = EMFNodeHelper.nodeComparison(points[0], points[1], True)
@@ -253,8 +277,8 @@ class ImageDoorDisplay(EMFDisplayItem):
         values = item.diValues(self)
         drawPos = EMFNodeHelper.pointOnLine(item, values["Position"]/100)
 
-        pm = self.sharedAttributes["Image"].getValue()
-        pm = QPixmap("error_image.png") if pm is None else pm
+        handle = self.sharedAttributes["Image"].getValue()
+        pm = QPixmap("error_image.png") if handle is None else handle.pixmap()
         num = values["Number"]
         print("NUMBER: {}".format(num))
         w = pm.width()
@@ -320,6 +344,10 @@ class LineShadowRadiusDisplay(EMFDisplayItem):
     def classStr(self):
         return "LineShadowRadiusDisplay"
 
+    def itemBounds(self, item):
+        return self.pointBounds([node.point() for node in item.nodes()],
+                                item.diValues(self)["Size"] + 1)
+
     def drawSimple(self, painter, item):
         points = item.nodes()
         comparison = EMFNodeHelper.nodeComparison(points[0], points[1], True)
@@ -434,6 +462,10 @@ class LineShadowLengthDisplay(EMFDisplayItem):
     def classStr(self):
         return "LineShadowLengthDisplay"
 
+    def itemBounds(self, item):
+        return self.pointBounds([node.point() for node in item.nodes()],
+                                item.diValues(self)["Width"] + 1)
+
     def drawSimple(self, painter, item):
         points = item.nodes()
         comparison = EMFNodeHelper.nodeComparison(points[0], points[1], True)
@@ -19,19 +19,24 @@ along with Encounter Mapper Freeform.
 If not, see <https://www.gnu.org/licenses/>.
 """
 
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QEvent, QStandardPaths
 from PyQt5.QtWidgets import (QApplication, QWidget, QDialog,
                              QSplitter, QFileDialog,
-                             QVBoxLayout, QScrollArea)
+                             QVBoxLayout, QScrollArea, QProgressDialog,
+                             QMessageBox)
 from PyQt5.QtGui import QPalette
 
 from EMFDisplayItemsSidebar import DisplayItemSidebar
 from EMFNodeEditor import NodeEditor
 from EMFMap import EMFMap
+from EMFMapIO import EMFMapIO
 from EMFMapResizeDialog import MapResizeDialog
 from EMFExportDialog import ExportDialog
+from EMFAutoSave import AutoSave, AutoSaveJournal
+from EMFAssets import EMFAssets
+
+import os
 
-import json
 
 """
 EMFMain is the parent widget of Encounter Mapper Freeform. It handles
@@ -42,7 +47,12 @@ functionality for creating, saving, loading, and exporting encounter maps
 class EMFMain(QWidget):
     def __init__(self):
         super(EMFMain, self).__init__()
-        self.map = EMFMap(10, 10)
+        autoSaveDir = os.path.join(QStandardPaths.writableLocation(
+            QStandardPaths.AppLocalDataLocation), "autosave")
+        self.map = self.recoverAutoSave(autoSaveDir)
+        if self.map is None:
+            self.map = EMFMap(10, 10)
+        self.autoSave = AutoSave(self.map, autoSaveDir)
         self.splitter = QSplitter(Qt.Horizontal)
         self.editor = NodeEditor(self.map)
         self.sideBar = DisplayItemSidebar(self.map)
@@ -71,8 +81,49 @@ class EMFMain(QWidget):
             # Qt.Key_N | Qt.ControlModifier: (self.newEncounterOpenDialog,),
             Qt.Key_O | Qt.ControlModifier: (self.openEncounter,),
             Qt.Key_R | Qt.ControlModifier: (self.resizeEncounter,),
+            Qt.Key_Z | Qt.ControlModifier: (self.editor.undo,),
+            Qt.Key_Z | int(Qt.ControlModifier | Qt.ShiftModifier):
+            (self.editor.redo,),
         }
 
+    # Offer to open the map autosaved by the latest session that didn't close
+    # normally. Sessions still running in other windows are left alone, and
+    # any other crashed sessions are offered again next time
+    def recoverAutoSave(self, autoSaveDir):
+        map = None
+        journals = AutoSaveJournal.orphanedJournals(autoSaveDir)
+        if len(journals) > 0:
+            journal = journals[0]
+            for other in journals[1:]:
+                other.unlock()
+            answer = QMessageBox.question(
+                self, "Recover Encounter",
+                "Encounter Mapper Freeform did not close properly. "
+                "Recover the autosaved encounter?")
+            if answer == QMessageBox.Yes:
+                try:
+                    jsContents = journal.recover()
+                    if jsContents is not None:
+                        map = EMFMap.createMapFromJSON(jsContents)
+                except Exception:
+                    # using the base exception class for now
+                    pass
+            journal.discard()
+        return map
+
+    # The autosave is only kept around if the window didn't close normally
+    def closeEvent(self, event):
+        self.autoSave.discard()
+        super(EMFMain, self).closeEvent(event)
+
+    # Decoded images are only needed for drawing, so they are dropped while
+    # the window is minimized and decoded again when next drawn
+    def changeEvent(self, event):
+        if (event.type() == QEvent.WindowStateChange and
+                self.isMinimized()):
+            EMFAssets.dropPixmaps()
+        super(EMFMain, self).changeEvent(event)
+
     def keyPressEvent(self, event):
         key = event.key() | int(event.modifiers())
         if key in self.keyBindings:
@@ -115,8 +166,8 @@ class EMFMain(QWidget):
             self.exportEditor = None
 
         def applyExport():
-            self.exportEditor.performExport()
-            endExport()
+            if self.exportEditor.performExport():
+                endExport()
 
         self.exportDialog = QDialog()
         layout = QVBoxLayout()
@@ -129,44 +180,43 @@ class EMFMain(QWidget):
         self.exportDialog.setLayout(layout)
         self.exportDialog.exec_()
 
-    # Save a json representation of the current encounter map.
+    # Save the current encounter map in the format chosen in the dialog
     def saveEncounter(self):
         filePath = QFileDialog.getSaveFileName(
-            self, "Open Encounter", "", "Encounter Mapper Freeform (*.emf)")
-        if filePath is not None:
+            self, "Open Encounter", "", EMFMapIO.fileFilters())
+        if filePath is not None and filePath[0]:
             path = filePath[0]
             if path.endswith(".emf"):
                 path = path[:-4]
-            text = json.dumps(self.map.jsonObj())
-            f = open(path+".emf", "w+")
-            f.write(text)
-            f.close()
+            EMFMapIO.saveMap(self.map, path+".emf",
+                             EMFMapIO.formatForFilter(filePath[1]))
 
-    # Choose an .emf file from the filepicker dialog and load the json map
+    # Choose an .emf file from the filepicker dialog and load the map
     def openEncounter(self):
         contentMap = None
         pathToOpen = QFileDialog.getOpenFileName(
             self, 'Open File', '', "Encounter Mapper Freeform (*.emf)")
         if pathToOpen is not None and pathToOpen[0]:
-            f = open(pathToOpen[0], "r")
-            if f.mode == "r":
-                contents = f.read()
-                jsContents = None
-                try:
-                    jsContents = json.loads(contents)
-                except Exception:
-                    # using the base exception class for now
-                    # Send an alert that the JSON contents cannot be read
-                    pass
-                f.close()
-                if jsContents is not None:
-                    contentMap = EMFMap.createMapFromJSON(jsContents)
+            progressDialog = QProgressDialog(
+                "Opening Encounter...", None, 0, 1000, self)
+            progressDialog.setWindowModality(Qt.WindowModal)
+            progressDialog.setMinimumDuration(500)
+
+            def updateProgress(done, total):
+                if total > 0:
+                    progressDialog.setValue(int(1000 * done / total))
+                QApplication.processEvents()
+
+            contentMap = EMFMapIO.loadMap(
+                pathToOpen[0], updateProgress, lazy=True)
+            progressDialog.close()
         if contentMap is not None:
             self.setMap(contentMap)
 
     # swap the map that is currently in use from the editor.
     def setMap(self, map):
         self.map = map
+        self.autoSave.setMap(map)
         self.editor.setMap(map)
         self.sideBar.setMap(map)
 
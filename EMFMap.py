@@ -21,7 +21,9 @@ If not, see <https://www.gnu.org/licenses/>.
 from PyQt5.QtCore import pyqtSignal, QObject
 
 from DisplayItemPicker import DisplayItemPicker
+from EMFHistory import EditHistory
 from EMFNodes import NodeLayer, EMFNode, EMFLine, EMFShape
+from EMFSelection import EMFSelection
 import copy
 
 """
@@ -58,11 +60,12 @@ class EMFMap(QObject):
         # Node Layers, Nodes, Lines
         self.width = width
         self.height = height
-        self.nodeLayers = ([NodeLayer(width*72, height*72)] if layers is None
-                           else layers)
+        cellSize = NodeLayer.CELL_SIZE
+        self.nodeLayers = ([NodeLayer(width*cellSize, height*cellSize)]
+                           if layers is None else layers)
         self.currentLayer = currentLayer
 
-        self.selectedItems = []
+        self.selectedItems = EMFSelection()
 
         # DIs
         self.displayItems = [] if displayItems is None else displayItems
@@ -70,6 +73,11 @@ class EMFMap(QObject):
             di.setMap(self)
         self.selectedDI = selectedDI
 
+        # undo and redo of edits made to the map
+        self.history = EditHistory(self)
+        # images of the layers saved with the map, see RenderCache
+        self.renderCache = None
+
     # Load map from a json representation.
     @classmethod
     def createMapFromJSON(cls, jsContents):
@@ -77,8 +85,8 @@ class EMFMap(QObject):
         # Do things to populate those items
         for dijs in jsContents["DisplayItems"]:
             displayItems.append(DisplayItemPicker.diFromJSON(dijs))
-        width = jsContents["Width"] * 72
-        height = jsContents["Height"] * 72
+        width = jsContents["Width"] * NodeLayer.CELL_SIZE
+        height = jsContents["Height"] * NodeLayer.CELL_SIZE
         layers = []
         for layerContent in jsContents["Layers"]:
             layers.append(NodeLayer.createFromJSON(
@@ -97,7 +105,9 @@ class EMFMap(QObject):
 
     def setMapDimensions(self, width, height, xOff, yOff):
         for layer in self.nodeLayers:
-            layer.setLayerDimensions(width*72, height*72, xOff * 72, yOff * 72)
+            cellSize = NodeLayer.CELL_SIZE
+            layer.setLayerDimensions(width * cellSize, height * cellSize,
+                                     xOff * cellSize, yOff * cellSize)
         self.width = width
         self.height = height
         self.mapResized.emit()
@@ -115,14 +125,21 @@ class EMFMap(QObject):
     def removeItemFromCurrentLayer(self, type, item):
         self.nodeLayers[self.currentLayer].removeFromLayer(type, item)
 
+    def getHistory(self):
+        return self.history
+
+    def getRenderCache(self):
+        return self.renderCache
+
+    def setRenderCache(self, renderCache):
+        self.renderCache = renderCache
+
     def addItemsToSelection(self, items):
-        for item in items:
-            self.addItemToSelection(item, False)
+        self.selectedItems.addItems(items)
         self.selectionUpdated.emit()
 
     def addItemToSelection(self, item, emitSignal=True):
-        if item not in self.selectedItems:
-            self.selectedItems.append(item)
+        self.selectedItems.add(item)
         if emitSignal:
             self.selectionUpdated.emit()
 
@@ -137,8 +154,7 @@ class EMFMap(QObject):
         self.setSelectedItems(newSelection)
 
     def setSelectedItems(self, items):
-        self.selectedItems.clear()
-        self.selectedItems.extend(items)
+        self.selectedItems.setItems(items)
         self.selectionUpdated.emit()
 
     def clearSelectedItems(self):
@@ -146,13 +162,28 @@ class EMFMap(QObject):
         self.selectionUpdated.emit()
 
     def removeSelectedItem(self, item):
-        if item in self.selectedItems:
-            self.selectedItems.remove(item)
+        if self.selectedItems.remove(item):
             self.selectionUpdated.emit()
 
+    def removeSelectedItems(self, items):
+        self.selectedItems.removeItems(items)
+        self.selectionUpdated.emit()
+
+    # The EMFSelection is shared, so only read from it outside of EMFMap
     def getSelectedItems(self):
         return self.selectedItems
 
+    # Incremented whenever the selection changes. Use to cache selection data
+    def getSelectionVersion(self):
+        return self.selectedItems.version()
+
+    def getLayers(self):
+        return self.nodeLayers
+
+    # Create the items of any layers that haven't been loaded yet
+    def loadAllLayers(self):
+        NodeLayer.loadLayers(self.nodeLayers)
+
     def getNumLayers(self):
         return len(self.nodeLayers)
 
@@ -171,7 +202,8 @@ class EMFMap(QObject):
 
     def addNewLayer(self):
         self.nodeLayers.insert(self.currentLayer+1,
-                               NodeLayer(self.width*72, self.height*72))
+                               NodeLayer(self.width*NodeLayer.CELL_SIZE,
+                                         self.height*NodeLayer.CELL_SIZE))
         self.currentLayer += 1
         self.mapLayerSwitched.emit()
 
@@ -255,8 +287,12 @@ class EMFMap(QObject):
 
     def removeDisplayItem(self, di):
         if di in self.displayItems:
+            # unloaded layers refer to DIs by index, so load them first
+            self.loadAllLayers()
             di.removeAllItems()
             self.displayItems.remove(di)
+            # earlier edits may refer to the DI, so they can't be undone
+            self.history.clear()
             self.selectedDI = -1
             self.displayItemListUpdated.emit()
             self.displayItemValuesUpdated.emit()
@@ -284,9 +320,44 @@ class EMFMap(QObject):
                 self.displayItemListUpdated.emit()
                 self.displayItemValuesUpdated.emit()
 
-    def getLayerImages(self):
+    # Layers not drawn since the map was opened may be in the cache
+    def restoreCachedImages(self, layers):
+        if self.renderCache is not None:
+            self.renderCache.restoreImages(
+                [nl for nl in layers if nl.getLayerImage() is None],
+                self.displayItems)
+
+    # Images of the layers, from the bottom. Only the first layerCount layers
+    # are drawn when it is given
+    def getLayerImages(self, layerCount=None):
+        return self.drawLayerImages(self.nodeLayers[:layerCount])
+
+    # Images of the given layers of the map, drawing any that aren't up to
+    # date. With a scale other than 1 the layers are drawn at scale *
+    # NodeLayer.CELL_SIZE pixels per cell, leaving their cached images alone
+    def drawLayerImages(self, layers, scale=1.0):
         layerImgList = []
-        for nl in self.nodeLayers:
+        if scale != 1:
+            NodeLayer.loadLayers(layers)
+            for di in self.displayItems:
+                di.prefetchImages()
+            for nl in layers:
+                layerImgList.append(nl.drawBand(
+                    self.displayItems, 0, nl.scaledDimensions(scale)[1],
+                    scale))
+            return layerImgList
+        self.restoreCachedImages(layers)
+        if any(nl.getLayerImage() is None or nl.NeedsRedraw()
+               for nl in layers):
+            # load the lazy layers to draw together, so they can be parsed
+            # in parallel
+            NodeLayer.loadLayers(
+                [nl for nl in layers
+                 if nl.getLayerImage() is None or nl.NeedsRedraw()])
+            # decode the images of every DI at once while the layers draw
+            for di in self.displayItems:
+                di.prefetchImages()
+        for nl in layers:
             img = nl.getLayerImage()
             if img is None or nl.NeedsRedraw():
                 img = nl.redrawLayerImage(self.displayItems)
@@ -306,11 +377,13 @@ class EMFMap(QObject):
             diIndexes[self.displayItems[i]] = i
         for l in self.nodeLayers:
             layers.append(l.jsonObj(diIndexes))
+        # DisplayItems come before Layers, so a streaming reader has the DIs
+        # when each layer is read
         return {
             "Width": self.width,
             "Height": self.height,
-            "Layers": layers,
             "CurrentLayer": self.currentLayer,
             "DisplayItems": dis,
-            "SelectedDI": self.selectedDI
+            "SelectedDI": self.selectedDI,
+            "Layers": layers
         }
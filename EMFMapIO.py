@@ -0,0 +1,333 @@
+"""
+Encounter Mapper Freeform is a node-based encounter map creator for tabletop
+RPGs. Copyright 2020 Eric Symmank
+
+This file is part of Encounter Mapper Freeform.
+
+Encounter Mapper Freeform is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper Freeform is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper Freeform.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+import gzip
+import json
+import os
+import struct
+import zipfile
+
+from DisplayItemPicker import DisplayItemPicker
+from EMFAssets import EMFAssets
+from EMFBinaryFormat import EMFBinaryFormat
+from EMFJSONStream import JSONStreamReader
+from EMFLayerParser import LayerParser
+from EMFMap import EMFMap
+from EMFNodes import NodeLayer
+from EMFRenderCache import RenderCache
+
+"""
+EMFMapIO saves and opens .emf files. Maps can be saved as JSON, which is easy
+to read and edit by hand, or in the binary encoding of EMFBinaryFormat, which
+is smaller and faster to load for large maps. When opening a file, the format
+is picked from the first bytes of the file, so both are opened the same way.
+
+JSON files are written one layer at a time, and read with a JSONStreamReader,
+which builds each NodeLayer as soon as its part of the file is read. When
+there are several layers, the LayerParser parses them in worker processes
+while the earlier ones are built, so only the JSON of the few layers being
+parsed is kept in memory. progress is called with the number of bytes read
+and the file size.
+With lazy set, each layer only keeps its JSON text until it is first used,
+and a layer that is never used is saved again from that text.
+
+Bundles are zip files holding the JSON of the map as map.json, along with
+every image the DisplayItems use, stored once under the hash of its contents
+(see EMFAssets). This lets maps be moved between computers without breaking
+their images.
+
+JSON and binary files can also be gzip compressed as they are written, which
+makes maps several times smaller. Compressed files are recognised by their
+first bytes, and decompressed as they are read.
+
+Saving also writes the images of the drawn layers to a RenderCache next to
+the file, which is read back when the map is opened.
+"""
+
+
+class EMFMapIO:
+    FORMAT_JSON = "JSON"
+    FORMAT_BINARY = "Binary"
+    FORMAT_BUNDLE = "Bundle"
+    # JSON, gzip compressed
+    FORMAT_COMPRESSED = "Compressed"
+
+    FILE_FILTERS = {
+        FORMAT_JSON: "Encounter Mapper Freeform (*.emf)",
+        FORMAT_COMPRESSED: "Encounter Mapper Freeform Compressed (*.emf)",
+        FORMAT_BINARY: "Encounter Mapper Freeform Binary (*.emf)",
+        FORMAT_BUNDLE: "Encounter Mapper Freeform Bundle with Images (*.emf)"
+    }
+
+    # enough of the start of a file to tell the formats apart
+    HEADER_SIZE = 8
+    ZIP_MAGIC = b"PK\x03\x04"
+    GZIP_MAGIC = b"\x1f\x8b"
+    BUNDLE_MAP = "map.json"
+    # zlib level used for FORMAT_COMPRESSED, from 1 (fastest) to 9 (smallest)
+    COMPRESS_LEVEL = 6
+
+    # Save map to path. The file is written next to path and only replaces it
+    # once complete, so a failed save leaves the previous file as it was.
+    # With compressLevel set, JSON and binary files are gzip compressed as
+    # they are written, and bundles use it as their zip compression level
+    @classmethod
+    def saveMap(cls, map, path, fileFormat=FORMAT_JSON, compressLevel=None):
+        if fileFormat == cls.FORMAT_COMPRESSED:
+            fileFormat = cls.FORMAT_JSON
+            if compressLevel is None:
+                compressLevel = cls.COMPRESS_LEVEL
+        tempPath = path + ".tmp"
+        try:
+            with open(tempPath, "wb") as f:
+                if fileFormat == cls.FORMAT_BUNDLE:
+                    cls.writeBundle(map, f, compressLevel)
+                elif compressLevel is None:
+                    cls.writeFile(map, f, fileFormat)
+                else:
+                    # the file name would only be that of the temp file
+                    with gzip.GzipFile("", "wb", compressLevel, f,
+                                       mtime=0) as compressed:
+                        cls.writeFile(map, compressed, fileFormat)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tempPath, path)
+        except BaseException:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
+        try:
+            RenderCache.write(map, path)
+        except OSError:
+            # the cache only saves drawing time, so the map is still saved
+            pass
+
+    @classmethod
+    def writeFile(cls, map, f, fileFormat):
+        if fileFormat == cls.FORMAT_BINARY:
+            EMFBinaryFormat.writeMap(map, f)
+        else:
+            cls.writeJSONMap(map, f)
+
+    # Write the JSON of map to the binary file f one layer at a time, so only
+    # a single layer's JSON is in memory at once. diJSONs replaces the JSON of
+    # the DisplayItems when given
+    @classmethod
+    def writeJSONMap(cls, map, f, diJSONs=None):
+        dis = map.getDisplayItems()
+        if diJSONs is None:
+            diJSONs = [di.jsonObj() for di in dis]
+        diIndexes = {}
+        for i in range(len(dis)):
+            diIndexes[dis[i]] = i
+
+        def write(text):
+            f.write(text.encode("utf-8"))
+
+        # the same layout as json.dumps(map.jsonObj())
+        header = (("Width", map.getWidth()),
+                  ("Height", map.getHeight()),
+                  ("CurrentLayer", map.getCurrentLayerIndex()),
+                  ("DisplayItems", diJSONs),
+                  ("SelectedDI", map.getSelectedDIIndex()))
+        write("{")
+        for key, value in header:
+            write("{}: {}, ".format(json.dumps(key), json.dumps(value)))
+        write('"Layers": [')
+        layers = map.getLayers()
+        for i in range(len(layers)):
+            if i > 0:
+                write(", ")
+            write(layers[i].jsonText(diIndexes))
+        write("]}")
+
+    # Load the map saved at path. Returns None if the contents can't be read
+    @classmethod
+    def loadMap(cls, path, progress=None, lazy=False):
+        with open(path, "rb") as f:
+            try:
+                fileFormat = cls.detectFormat(f.read(cls.HEADER_SIZE))
+                if fileFormat == cls.FORMAT_COMPRESSED:
+                    size = cls.uncompressedSize(f)
+                    with gzip.GzipFile(fileobj=f) as uncompressed:
+                        map = cls.readFile(uncompressed, progress, lazy, size)
+                else:
+                    map = cls.readFile(f, progress, lazy)
+            except Exception:
+                # using the base exception class for now
+                # Send an alert that the contents cannot be read
+                return None
+        map.setRenderCache(RenderCache.open(path, map))
+        return map
+
+    # Read a map in any format from f. size is the size of the file, needed
+    # when f is decompressed as it is read
+    @classmethod
+    def readFile(cls, f, progress=None, lazy=False, size=None):
+        f.seek(0)
+        fileFormat = cls.detectFormat(f.read(cls.HEADER_SIZE))
+        f.seek(0)
+        if fileFormat == cls.FORMAT_BINARY:
+            return EMFBinaryFormat.readMap(f, progress, size)
+        if fileFormat == cls.FORMAT_BUNDLE:
+            return cls.readBundle(f, progress, lazy)
+        if fileFormat == cls.FORMAT_COMPRESSED:
+            raise ValueError("File is compressed more than once")
+        return cls.readJSONMap(f, progress, lazy, size)
+
+    # The size of the contents of the gzip file f, as stored at its end
+    @classmethod
+    def uncompressedSize(cls, f):
+        f.seek(-4, os.SEEK_END)
+        size = struct.unpack("<I", f.read(4))[0]
+        f.seek(0)
+        return size
+
+    # Read a JSON map from the binary file f, one layer at a time. assets maps
+    # the names of bundled images to the paths they were extracted to
+    @classmethod
+    def readJSONMap(cls, f, progress=None, lazy=False, size=None,
+                    assets=None):
+        reader = JSONStreamReader(f, progress, size)
+        jsContents = {}
+        displayItems = None
+        layers = None
+        layersStart = None
+        for key in reader.iterObjectKeys():
+            if key == "Layers" and displayItems is None:
+                # Files saved before DisplayItems were written first. Skip
+                # the layers for now and come back once the DIs are loaded
+                layersStart = reader.tell()
+                for text in reader.iterRawArray():
+                    pass
+            elif key == "Layers":
+                layers = cls.readJSONLayers(
+                    reader, displayItems, jsContents, lazy)
+            else:
+                jsContents[key] = reader.decodeValue()
+                if key == "DisplayItems":
+                    if assets is not None:
+                        cls.replaceImagePaths(jsContents[key], assets)
+                    displayItems = [DisplayItemPicker.diFromJSON(dijs)
+                                    for dijs in jsContents[key]]
+        if layers is None and layersStart is not None:
+            reader.seek(layersStart)
+            layers = cls.readJSONLayers(
+                reader, displayItems, jsContents, lazy)
+            if progress is not None:
+                # the rest of the file was read before going back
+                progress(reader.size, reader.size)
+
+        return EMFMap(jsContents["Width"], jsContents["Height"],
+                      layers, displayItems, jsContents["CurrentLayer"],
+                      jsContents["SelectedDI"])
+
+    @classmethod
+    def readJSONLayers(cls, reader, displayItems, jsContents, lazy=False):
+        width = jsContents["Width"] * NodeLayer.CELL_SIZE
+        height = jsContents["Height"] * NodeLayer.CELL_SIZE
+        layers = []
+        if lazy:
+            for text in reader.iterRawArray():
+                layers.append(NodeLayer.createLazy(
+                    text, displayItems, width, height))
+        else:
+            # layers are parsed in worker processes as they are read
+            defaults = [di.individualValues() for di in displayItems]
+            jobs = ((text, defaults, True)
+                    for text in reader.iterRawArray())
+            for parsed in LayerParser.parseLayers(jobs):
+                layer = NodeLayer(width, height)
+                layer.addParsedItems(parsed, displayItems)
+                layers.append(layer)
+        return layers
+
+    # Write the map JSON and every image file used by its DIs to a zip
+    @classmethod
+    def writeBundle(cls, map, f, compressLevel=None):
+        with zipfile.ZipFile(f, "w", compresslevel=compressLevel) as bundle:
+            written = set()
+            diJSONs = []
+            for di in map.getDisplayItems():
+                dijs = di.jsonObj()
+                diJSONs.append(dijs)
+                shared = di.getSharedAttributes()
+                for attrName in shared:
+                    attr = shared[attrName]
+                    if not attr.isImagePath():
+                        continue
+                    path = attr.getJSONValue()
+                    name = EMFAssets.assetName(path)
+                    if name is None:
+                        # the image is missing, so keep the path as it is
+                        continue
+                    if name not in written:
+                        # images are already compressed
+                        bundle.write(path, name, zipfile.ZIP_STORED)
+                        written.add(name)
+                    dijs["sharedAttributes"][attrName] = name
+            info = zipfile.ZipInfo(cls.BUNDLE_MAP)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with bundle.open(info, "w") as mapFile:
+                cls.writeJSONMap(map, mapFile, diJSONs)
+
+    @classmethod
+    def readBundle(cls, f, progress=None, lazy=False):
+        with zipfile.ZipFile(f) as bundle:
+            assets = {}
+            for name in bundle.namelist():
+                if name.startswith(EMFAssets.ASSET_FOLDER + "/"):
+                    assets[name] = EMFAssets.extractAsset(bundle, name)
+            size = bundle.getinfo(cls.BUNDLE_MAP).file_size
+            with bundle.open(cls.BUNDLE_MAP) as mapFile:
+                return cls.readJSONMap(mapFile, progress, lazy, size, assets)
+
+    # Point the shared attributes naming bundled images at the extracted files
+    @classmethod
+    def replaceImagePaths(cls, diJSONs, assets):
+        for dijs in diJSONs:
+            shared = dijs["sharedAttributes"]
+            for attrName in shared:
+                value = shared[attrName]
+                if isinstance(value, str) and value in assets:
+                    shared[attrName] = assets[value]
+
+    @classmethod
+    def detectFormat(cls, header):
+        if EMFBinaryFormat.isBinary(header):
+            return cls.FORMAT_BINARY
+        if header[:len(cls.ZIP_MAGIC)] == cls.ZIP_MAGIC:
+            return cls.FORMAT_BUNDLE
+        if header[:len(cls.GZIP_MAGIC)] == cls.GZIP_MAGIC:
+            return cls.FORMAT_COMPRESSED
+        return cls.FORMAT_JSON
+
+    # The file dialog filter string for every format
+    @classmethod
+    def fileFilters(cls):
+        return ";;".join(cls.FILE_FILTERS.values())
+
+    # The format matching a filter chosen in the file dialog
+    @classmethod
+    def formatForFilter(cls, fileFilter):
+        for fileFormat in cls.FILE_FILTERS:
+            if cls.FILE_FILTERS[fileFormat] == fileFilter:
+                return fileFormat
+        return cls.FORMAT_JSON
@@ -22,6 +22,7 @@ If not, see <https://www.gnu.org/licenses/>.
 from PyQt5.QtWidgets import (QLabel, QSpinBox,
                              QGridLayout)
 from EMFEditAction import EditAction
+from EMFNodes import NodeLayer
 
 """
 The MapResizeDialog gives the current size of the map in 72px (1 in.) Squares,
@@ -33,19 +34,20 @@ class MapResizeDialog(EditAction):
 
     def __init__(self, map):
         super(MapResizeDialog, self).__init__()
+        cellSize = NodeLayer.CELL_SIZE
         width = map.getWidth()
         height = map.getHeight()
         self.widthEdit = QSpinBox()
         self.widthEdit.setMinimum(0)
         self.widthEdit.setMaximum(100)
         self.widthEdit.setValue(width)
-        widthConvLabel = QLabel("{} px".format(width*72))
+        widthConvLabel = QLabel("{} px".format(width*cellSize))
         self.heightEdit = QSpinBox()
         self.heightEdit.setMinimum(0)
         self.heightEdit.setMaximum(100)
         self.heightEdit.setValue(height)
 
-        heightConvLabel = QLabel("{} px".format(height*72))
+        heightConvLabel = QLabel("{} px".format(height*cellSize))
         self.xOffset = QSpinBox()
         self.xOffset.setMinimum(-width)
         self.xOffset.setMaximum(width)
@@ -59,13 +61,13 @@ class MapResizeDialog(EditAction):
         yOffConvLabel = QLabel("0 px")
 
         self.widthEdit.valueChanged.connect(
-            lambda v: widthConvLabel.setText("{} px".format(v*72)))
+            lambda v: widthConvLabel.setText("{} px".format(v*cellSize)))
         self.heightEdit.valueChanged.connect(
-            lambda v: heightConvLabel.setText("{} px".format(v*72)))
+            lambda v: heightConvLabel.setText("{} px".format(v*cellSize)))
         self.xOffset.valueChanged.connect(
-            lambda v: xOffConvLabel.setText("{} px".format(v*72)))
+            lambda v: xOffConvLabel.setText("{} px".format(v*cellSize)))
         self.yOffset.valueChanged.connect(
-            lambda v: yOffConvLabel.setText("{} px".format(v*72)))
+            lambda v: yOffConvLabel.setText("{} px".format(v*cellSize)))
 
         layout = QGridLayout()
         layout.addWidget(self.widthEdit, 0, 0)
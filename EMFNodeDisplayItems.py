@@ -23,6 +23,7 @@ from EMFNodes import EMFNode
 from EMFAttribute import (EMFAttribute, ScrollbarAttributeWidget,
                           ColorAttributeWidget, SpinboxAttributeWidget,
                           FilePickerAttributeWidget)
+from EMFAssets import EMFAssets
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import (QPen, QBrush, QColor, QPixmap, QTransform,
                          QRadialGradient)
@@ -65,6 +66,10 @@ class ColorCircleDisplay(EMFDisplayItem):
     def classStr(self):
         return "ColorCircleDisplay"
 
+    def itemBounds(self, item):
+        return self.pointBounds([item.point()],
+                                item.diValues(self)["Size"] + 1)
+
     def drawSimple(self, painter, item):
         # draw a circle node with the given size
         point = item.point()
@@ -86,7 +91,8 @@ class ImageDisplay(EMFDisplayItem):
         if shared is None:
             shared = {"Image": (None, "Choose a file...")}
         else:
-            shared["Image"] = (QPixmap(shared["Image"]), shared["Image"])
+            shared["Image"] = (EMFAssets.imageHandle(shared["Image"]),
+                               shared["Image"])
         if indiv is None:
             indiv = {"SizeRatio": 100,
                      "Rotation": 0,
@@ -115,13 +121,23 @@ class ImageDisplay(EMFDisplayItem):
     def classStr(self):
         return "ImageDisplay"
 
+    def itemBounds(self, item):
+        handle = self.sharedAttributes["Image"].getValue()
+        if handle is None:
+            return None
+        pm = handle.pixmap()
+        scale = item.diValues(self)["SizeRatio"] / 100
+        # half the diagonal of the image, however it is rotated
+        return self.pointBounds(
+            [item.point()], (pm.width() + pm.height()) * scale / 2 + 1)
+
     def drawSimple(self, painter, item):
         # draw the shape's polygon
         point = item.point()
         values = item.diValues(self)
 
-        pm = self.sharedAttributes["Image"].getValue()
-        pm = QPixmap("error_image.png") if pm is None else pm
+        handle = self.sharedAttributes["Image"].getValue()
+        pm = QPixmap("error_image.png") if handle is None else handle.pixmap()
 
         # opacity values
         opacity = values["Opacity"]
@@ -179,6 +195,10 @@ class CircleShadowDisplay(EMFDisplayItem):
     def classStr(self):
         return "CircleShadowDisplay"
 
+    def itemBounds(self, item):
+        return self.pointBounds([item.point()],
+                                item.diValues(self)["Size"] + 1)
+
     def drawSimple(self, painter, item):
         # draw a circle node with the given gradient size
         point = item.point()
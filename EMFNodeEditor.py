@@ -27,6 +27,8 @@ import math
 
 from EMFNodes import NodeLayer, EMFNode, EMFShape, EMFLine, EMFNodeHelper
 from EMFMap import EMFMap
+from EMFHistory import LayerItemsCommand, MoveNodesCommand
+from EMFTransform import NodeTransform
 
 """
 The NodeEditor is a piece of work that allows the user to interact with the
@@ -54,12 +56,14 @@ class NodeEditor(QWidget):
         self.map.displayItemValuesUpdated.connect(self.repaint)
         self.map.mapResized.connect(self.updateMapDimensions)
         self.map.mapLayerSwitched.connect(self.mapLayerSwitched)
-        self.layerWidth = map.getWidth()*72
-        self.layerHeight = map.getHeight()*72
+        self.layerWidth = map.getWidth()*NodeLayer.CELL_SIZE
+        self.layerHeight = map.getHeight()*NodeLayer.CELL_SIZE
         # self.currentNodeLayer = NodeLayer(width, height)
         self.selectedType = NodeLayer.TYPE_NODE
-        self.selectedItems = []
-        self.selectedNodes = None
+        self.selectedItems = self.map.getSelectedItems()
+        self.selectionNodes = []
+        self.selectionNodesVersion = -1
+        self.nodeTransform = None
         self.medianNode = None
         self.formerMedian = None
         self.interactMode = NodeEditor.INTERACT_SELECT
@@ -108,12 +112,13 @@ class NodeEditor(QWidget):
         self.map.displayItemValuesUpdated.connect(self.repaint)
         self.map.mapResized.connect(self.updateMapDimensions)
         self.map.mapLayerSwitched.connect(self.repaint)
+        self.selectionNodesVersion = -1
         self.mapSelectionUpdated()
         self.updateMapDimensions()
 
     def updateMapDimensions(self):
-        self.layerWidth = self.map.getWidth() * 72
-        self.layerHeight = self.map.getHeight() * 72
+        self.layerWidth = self.map.getWidth() * NodeLayer.CELL_SIZE
+        self.layerHeight = self.map.getHeight() * NodeLayer.CELL_SIZE
         self.setFixedWidth(self.layerWidth)
         self.setFixedHeight(self.layerHeight)
         self.repaint()
@@ -152,14 +157,21 @@ class NodeEditor(QWidget):
     # //////////// #
 
     def mapLayerSwitched(self):
-        self.selectedItems = []
-        self.updateMedianPoint()
+        self.map.clearSelectedItems()
         self.repaint()
 
     def mapSelectionUpdated(self):
         self.selectedItems = self.map.getSelectedItems()
         self.updateMedianPoint()
 
+    # Nodes touched by the selected items. Cached against the selection version
+    def getSelectionNodes(self):
+        version = self.map.getSelectionVersion()
+        if version != self.selectionNodesVersion:
+            self.selectionNodes = EMFNodeHelper.listOfNodes(self.selectedItems)
+            self.selectionNodesVersion = version
+        return self.selectionNodes
+
     # Select a singular item to add to existing items.
     def selectItem(self, inclusiveSelect=False):
         itemTypeList = self.map.getCurrentLayerItems(self.selectedType)
@@ -203,21 +215,22 @@ class NodeEditor(QWidget):
             # print("Forming Item")
             # shape is too complex; save logic for later
             if self.selectedType != NodeLayer.TYPE_SHAPE:
-                nodes = EMFNodeHelper.listOfNodes(self.selectedItems)
-                print(len(nodes))
+                nodes = list(self.getSelectionNodes())
                 if (len(nodes) == 2 and
                         len(EMFNodeHelper.existingLine(
                         nodes[0], nodes[1])) == 0):
-                    self.map.addItemToCurrentLayer(
-                        NodeLayer.TYPE_LINE, EMFLine(nodes[0], nodes[1]))
+                    self.recordAddedItems(
+                        lambda: self.map.addItemToCurrentLayer(
+                            NodeLayer.TYPE_LINE, EMFLine(nodes[0], nodes[1])))
                 elif EMFNodeHelper.existingShape(nodes) is None:
-                    shape = EMFShape(nodes)
-                    self.map.addItemToCurrentLayer(NodeLayer.TYPE_SHAPE, shape)
+                    self.recordAddedItems(
+                        lambda: self.map.addItemToCurrentLayer(
+                            NodeLayer.TYPE_SHAPE, EMFShape(nodes)))
 
     def deleteItems(self, deleteTouchingNodes=False):
         if self.interactMode == NodeEditor.INTERACT_SELECT:
             if deleteTouchingNodes:
-                self.deleteNodes(EMFNodeHelper.listOfNodes(self.selectedItems))
+                self.deleteNodes(list(self.getSelectionNodes()))
             else:
                 delMethods = {NodeLayer.TYPE_NODE:
                               self.deleteNodes,
@@ -225,7 +238,7 @@ class NodeEditor(QWidget):
                               self.deleteLines,
                               NodeLayer.TYPE_SHAPE:
                               self.deleteShapes}
-                delMethods[self.selectedType](self.selectedItems)
+                delMethods[self.selectedType](self.selectedItems.items())
             self.map.clearSelectedItems()
 
     # Delete all selected nodes. also removes all touching lines and shapes
@@ -238,18 +251,7 @@ class NodeEditor(QWidget):
                 linesTBD.add(line)
             for shape in node.getShapes():
                 shapesTBD.add(shape)
-        # remove shapes
-        for shape in shapesTBD:
-            shape.shapeDeleted()
-            self.map.removeItemFromCurrentLayer(NodeLayer.TYPE_SHAPE, shape)
-        for line in linesTBD:
-            # delete lines
-            line.lineDeleted()
-            self.map.removeItemFromCurrentLayer(NodeLayer.TYPE_LINE, line)
-        for node in nodes:
-            node.nodeDeleted()
-            self.map.removeItemFromCurrentLayer(NodeLayer.TYPE_NODE, node)
-        pass
+        self.removeItems(nodes, linesTBD, shapesTBD)
 
     # Delete all selected lines. also removes all touching shapes
     def deleteLines(self, lines):
@@ -259,29 +261,54 @@ class NodeEditor(QWidget):
         for line in lines:
             for shape in line.shapes():
                 shapesTBD.add(shape)
-        # remove shapes
-        for shape in shapesTBD:
-            shape.shapeDeleted()
-            # self.shapes.remove(shape)
-            self.map.removeItemFromCurrentLayer(NodeLayer.TYPE_SHAPE, shape)
-        for line in lines:
-            # delete lines
-            line.lineDeleted()
-            # self.lines.remove(line)
-            self.map.removeItemFromCurrentLayer(NodeLayer.TYPE_LINE, line)
+        self.removeItems((), lines, shapesTBD)
 
     # delete all selected shapes. Does not affect nodes or lines.
     def deleteShapes(self, shapes):
-        for shape in shapes:
-            shape.shapeDeleted()
-            self.map.removeItemFromCurrentLayer(NodeLayer.TYPE_SHAPE, shape)
+        self.removeItems((), (), shapes)
+
+    # Remove the items from the current layer as one edit that can be undone
+    def removeItems(self, nodes, lines, shapes):
+        if len(nodes) + len(lines) + len(shapes) > 0:
+            self.map.getHistory().push(LayerItemsCommand.removeItems(
+                self.map.getCurrentLayer(), nodes, lines, shapes))
+
+    # Run edit, recording the items it adds to the current layer as one edit
+    # that can be undone. Items are always added to the end of the lists
+    def recordAddedItems(self, edit):
+        layer = self.map.getCurrentLayer()
+        types = (NodeLayer.TYPE_NODE, NodeLayer.TYPE_LINE,
+                 NodeLayer.TYPE_SHAPE)
+        counts = [len(layer.getList(type)) for type in types]
+        version = layer.version()
+        edit()
+        added = [layer.getList(types[i])[counts[i]:]
+                 for i in range(len(types))]
+        if any(len(items) > 0 for items in added):
+            command = LayerItemsCommand(
+                layer, added[0], added[1], added[2], True)
+            command.layerVersions = {layer: version}
+            self.map.getHistory().push(command)
+
+    # Undo the last edit, unless an interaction is underway
+    def undo(self):
+        if self.interactMode == NodeEditor.INTERACT_SELECT:
+            self.map.getHistory().undo()
+            self.repaint()
+
+    def redo(self):
+        if self.interactMode == NodeEditor.INTERACT_SELECT:
+            self.map.getHistory().redo()
+            self.repaint()
 
     def extrudeItems(self):
         if self.interactMode == NodeEditor.INTERACT_SELECT:
             extMethods = {NodeLayer.TYPE_NODE: self.extrudeNodes,
                           NodeLayer.TYPE_LINE: self.extrudeLines,
                           NodeLayer.TYPE_SHAPE: self.extrudeShapes}
-            extMethods[self.selectedType](self.selectedItems)
+            selected = self.selectedItems.items()
+            self.recordAddedItems(
+                lambda: extMethods[self.selectedType](selected))
             self.selectedItemsUpdated.emit()
             self.updateMedianPoint()
             self.beginInteraction(NodeEditor.INTERACT_GRAB)
@@ -291,7 +318,7 @@ class NodeEditor(QWidget):
         addedNode = EMFNode(
             self.currentMousePos.x(), self.currentMousePos.y())
         self.map.addItemToCurrentLayer(NodeLayer.TYPE_NODE, addedNode)
-        self.selectedItems.append(addedNode)
+        self.map.addItemToSelection(addedNode, False)
 
     # Form a line out of each Node
     def extrudeNodes(self, nodes):
@@ -349,7 +376,9 @@ class NodeEditor(QWidget):
                            self.duplicateLines,
                            NodeLayer.TYPE_SHAPE:
                            self.duplicateShapes}
-            dupeMethods[self.selectedType](self.selectedItems)
+            selected = self.selectedItems.items()
+            self.recordAddedItems(
+                lambda: dupeMethods[self.selectedType](selected))
             self.beginInteraction(NodeEditor.INTERACT_GRAB)
 
     # duplicate a selected series of nodes. doesn't duplicate the connected
@@ -423,7 +452,8 @@ class NodeEditor(QWidget):
     # chaning the number of selected items
     def updateMedianPoint(self):
         if len(self.selectedItems) > 0:
-            self.medianNode = EMFNodeHelper.medianNode(self.selectedItems)
+            self.medianNode = EMFNodeHelper.medianNode(
+                self.getSelectionNodes())
         else:
             self.medianNode = None
 
@@ -441,8 +471,7 @@ class NodeEditor(QWidget):
                   self.currentMousePos.y() - self.interactNode.y())
         if incremental:
             offset = (offset[0] - offset[0] % 9, offset[1] - offset[1] % 9)
-        for node in self.selectedNodes:
-            node.grab(offset)
+        self.nodeTransform.grab(offset)
         self.updateMedianPoint()
 
     # Rotate the selected nodes around the median using a delta of the initial
@@ -455,8 +484,7 @@ class NodeEditor(QWidget):
         delta = newDelta - oldDelta
         if(incremental):
             delta = delta - (delta % 15)
-        for node in self.selectedNodes:
-            node.rotate(delta - 90)
+        self.nodeTransform.rotate(delta - 90)
 
     # Scale the selected nodes based off a ratio of the initial mouse pos and
     # current pos
@@ -470,8 +498,7 @@ class NodeEditor(QWidget):
         if(incremental):
             newDist = newDist - newDist % 36
         ratio = newDist / oldDist
-        for node in self.selectedNodes:
-            node.scale(ratio)
+        self.nodeTransform.scale(ratio)
 
     # helper method to navigate to the correct interaction
     def updateInteraction(self):
@@ -493,16 +520,14 @@ class NodeEditor(QWidget):
             self.formerMedian = self.medianNode
             # Produce a node based off my last mouse position
             self.interactNode = self.currentMousePos
-            self.selectedNodes = EMFNodeHelper.listOfNodes(self.selectedItems)
-            for node in self.selectedNodes:
-                node.beginTransform(self.medianNode)
+            self.nodeTransform = NodeTransform(
+                self.getSelectionNodes(), self.medianNode)
 
     # Reset node info to state before interaction began
     def cancelInteraction(self):
         self.interactMode = NodeEditor.INTERACT_SELECT
-        for node in self.selectedNodes:
-            node.cancelTransform()
-        self.selectedNodes = None
+        self.nodeTransform.cancel()
+        self.nodeTransform = None
         self.interactNode = None
         self.formerMedian = None
         self.updateMedianPoint()
@@ -510,9 +535,11 @@ class NodeEditor(QWidget):
     # Apply interaction changes
     def applyInteraction(self):
         self.interactMode = NodeEditor.INTERACT_SELECT
-        for node in self.selectedNodes:
-            node.applyTransform()
-        self.selectedNodes = None
+        self.nodeTransform.apply()
+        command = MoveNodesCommand.createFromTransform(self.nodeTransform)
+        if command is not None:
+            self.map.getHistory().push(command)
+        self.nodeTransform = None
         self.interactNode = None
         self.formerMedian = None
         self.updateMedianPoint()
@@ -570,9 +597,10 @@ class NodeEditor(QWidget):
         painter.setPen(Qt.white)
         painter.drawRect(0, 0, self.layerWidth, self.layerHeight)
         # draw the list
-        layerImages = self.map.getLayerImages()
         layersToDraw = (self.map.getNumLayers() if self.showFullMap else
                         self.map.getCurrentLayerIndex()+1)
+        # layers above the current one are not loaded until they are shown
+        layerImages = self.map.getLayerImages(layersToDraw)
         for i in range(layersToDraw):
             painter.drawImage(0, 0, layerImages[i])
         if self.showDebug:
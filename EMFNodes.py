@@ -19,13 +19,17 @@ along with Encounter Mapper Freeform.
 If not, see <https://www.gnu.org/licenses/>.
 """
 
-from PyQt5.QtCore import QPoint
+from PyQt5.QtCore import QPoint, QPointF
 from PyQt5.QtGui import QPolygon, QImage, QPainter, QColor
 from PyQt5.QtCore import Qt
 import operator
 import math
+import json
 
 from EMFDIPropertyHolder import DIPropertyHolder
+from EMFJSONStream import JSONStreamReader
+from EMFLayerParser import LayerParser
+from EMFTransform import NodeTransform
 
 
 """
@@ -38,6 +42,10 @@ altered for elements on its level, or node positions have changed. Use
 NeedsRedraw() to check if the layer needs to be redrawn, or setNeedRedraw()
 to force the redraw of the image. Otherwise, the image is cached until no
 longer viable.
+
+Layers made with createLazy() keep the JSON text of their items and only
+create them the first time they are used, so opening a map with many layers
+only has to load the layers being edited or drawn.
 """
 
 
@@ -45,37 +53,80 @@ class NodeLayer(DIPropertyHolder):
     TYPE_NODE = "NODE"
     TYPE_LINE = "LINE"
     TYPE_SHAPE = "SHAPE"
+    # pixels per map cell (1 in.) at the editor's size
+    CELL_SIZE = 72
 
     def __init__(self, width, height, nodes=None, lines=None, shapes=None):
         super(NodeLayer, self).__init__()
-        nodes = [] if nodes is None else nodes
-        lines = [] if lines is None else lines
-        shapes = [] if shapes is None else shapes
-
-        # Add existing elements to the parent layer for setNeedsRedraw()
-        def setPL(items):
-            for item in items:
-                item.setParentLayer(self)
-        setPL(nodes)
-        setPL(lines)
-        setPL(shapes)
-
+        # type -> the index of each item in its list. See itemIndexes()
+        self.indexCache = {}
         self.layerItems = {
-            NodeLayer.TYPE_NODE: nodes,
-            NodeLayer.TYPE_LINE: lines,
-            NodeLayer.TYPE_SHAPE: shapes
+            NodeLayer.TYPE_NODE: [],
+            NodeLayer.TYPE_LINE: [],
+            NodeLayer.TYPE_SHAPE: []
         }
+        self.setLayerItems(nodes, lines, shapes)
 
         self.layerWidth = width
         self.layerHeight = height
         self.layerImage = None
+        # memory holding a layer image read from a RenderCache
+        self.layerImageBuffer = None
         self.needsRedraw = True
+        # Incremented on every change to the layer, unlike needsRedraw which
+        # is reset once the layer is drawn. Used by the autosave
+        self.layerVersion = 0
         self.parentLayer = self
+        # JSON text of a layer that hasn't been loaded yet, and the DIs its
+        # indexes refer to. See createLazy()
+        self.pendingJSON = None
+        self.pendingDIs = None
+        self.pendingDIProperties = None
+        # where the text of the DIProperties starts and ends in pendingJSON
+        self.pendingDISpan = None
+        # the individual values of each DI when the text was read. Values
+        # left out of the text are these, even if the DIs change later
+        self.pendingDefaults = None
 
     # Used when loading a saved map. Creates the nodes, shapes, and lines, then
     # adds them to the Layer,
     @classmethod
     def createFromJSON(cls, jsContents, displayItems, width, height):
+        layer = cls(width, height)
+        layer.addItemsFromJSON(jsContents, displayItems)
+        layer.addDIPropertiesFromJSON(
+            jsContents["DIProperties"], displayItems)
+        return layer
+
+    # Create a layer that is only loaded from jsText, the JSON text of the
+    # layer, when its items are first used. Only the DIs of the layer itself
+    # are decoded and added right away. They are saved first in each layer,
+    # so they are found without going through the items
+    @classmethod
+    def createLazy(cls, jsText, displayItems, width, height):
+        layer = cls(width, height)
+        jsDIProperties, start, end = JSONStreamReader.findKey(
+            jsText, "DIProperties")
+        layer.pendingJSON = jsText
+        layer.pendingDIs = list(displayItems)
+        layer.pendingDIProperties = jsDIProperties
+        layer.pendingDISpan = (start, end)
+        layer.pendingDefaults = [di.individualValues() for di in displayItems]
+        layer.addDIPropertiesFromJSON(jsDIProperties, displayItems)
+        return layer
+
+    # Add existing elements to the layer lists and set them to this layer
+    def setLayerItems(self, nodes=None, lines=None, shapes=None):
+        for type, items in ((NodeLayer.TYPE_NODE, nodes),
+                            (NodeLayer.TYPE_LINE, lines),
+                            (NodeLayer.TYPE_SHAPE, shapes)):
+            if items is not None:
+                for item in items:
+                    item.setParentLayer(self)
+                self.layerItems[type].extend(items)
+                self.indexCache.pop(type, None)
+
+    def addItemsFromJSON(self, jsContents, displayItems):
         nodes = []
         lines = []
         shapes = []
@@ -87,31 +138,87 @@ class NodeLayer(DIPropertyHolder):
         for shapeJS in jsContents["Shapes"]:
             shapes.append(EMFShape.createFromJSON(
                 shapeJS, nodes, displayItems))
-        layer = cls(width, height, nodes, lines, shapes)
-        for dIndex in jsContents["DIProperties"]:
-            displayItems[int(dIndex)].addItem(
-                layer, jsContents["DIProperties"][dIndex])
-        return layer
+        self.setLayerItems(nodes, lines, shapes)
+
+    def addDIPropertiesFromJSON(self, jsDIProperties, displayItems):
+        for dIndex in jsDIProperties:
+            displayItems[int(dIndex)].addItem(self, jsDIProperties[dIndex])
 
-    # Check if a nodeLayer element exists in this layer
+    def isLoaded(self):
+        return self.pendingJSON is None
+
+    # Create the items of a lazy layer, if they haven't been already
+    def ensureLoaded(self):
+        if self.pendingJSON is not None:
+            self.addParsedItems(LayerParser.parseLayer(
+                self.pendingJSON, self.pendingDefaults, False))
+
+    # Load every lazy layer in layers, parsing them in worker processes
+    @classmethod
+    def loadLayers(cls, layers):
+        pending = [layer for layer in layers if not layer.isLoaded()]
+        jobs = [(layer.pendingJSON, layer.pendingDefaults, False)
+                for layer in pending]
+        for layer, parsed in zip(pending, LayerParser.parseLayers(jobs)):
+            layer.addParsedItems(parsed)
+
+    # Add the items of a layer parsed by LayerParser. Values left out of the
+    # text were filled in with the DIs' values when the layer was read, even
+    # if they changed since
+    def addParsedItems(self, parsed, displayItems=None):
+        if self.pendingJSON is not None:
+            displayItems = self.pendingDIs
+            self.pendingJSON = None
+            self.pendingDIs = None
+            self.pendingDIProperties = None
+            self.pendingDISpan = None
+            self.pendingDefaults = None
+        coords, lineIndexes, shapeSizes, shapeIndexes, bindings = parsed
+        self.addItemsFromArrays(coords, lineIndexes, shapeSizes, shapeIndexes)
+        self.bindColumns(displayItems, bindings)
+        self.needsRedraw = True
+
+    # Create the items from the arrays of EMFBinaryFormat: x, y pairs of the
+    # nodes, node index pairs of the lines, and the node indexes of each shape
+    def addItemsFromArrays(self, coords, lineIndexes, shapeSizes,
+                           shapeIndexes):
+        nodes = [EMFNode(coords[i], coords[i + 1])
+                 for i in range(0, len(coords), 2)]
+        lines = [EMFLine(nodes[lineIndexes[i]], nodes[lineIndexes[i + 1]])
+                 for i in range(0, len(lineIndexes), 2)]
+        shapes = []
+        start = 0
+        for size in shapeSizes:
+            shapes.append(EMFShape(
+                [nodes[i] for i in shapeIndexes[start:start + size]], False))
+            start += size
+        self.setLayerItems(nodes, lines, shapes)
+
+    # Join items of the layer to DIs. Each binding is (diIndex, typeCode,
+    # indexes, columns), where typeCode picks the nodes, lines, shapes, or
+    # the layer itself, and columns holds the values of the items at indexes
+    def bindColumns(self, displayItems, bindings):
+        layerItems = (self.layerItems[NodeLayer.TYPE_NODE],
+                      self.layerItems[NodeLayer.TYPE_LINE],
+                      self.layerItems[NodeLayer.TYPE_SHAPE], [self])
+        for diIndex, typeCode, indexes, columns in bindings:
+            items = [layerItems[typeCode][i] for i in indexes]
+            displayItems[diIndex].addItemsFromColumns(items, columns)
+
+    # Check if a nodeLayer element exists in this layer. Elements point to the
+    # layer they were added to, so there is no need to search the lists
     def containsItem(self, item):
-        itemType = None
-        if isinstance(item, EMFNode):
-            itemType = NodeLayer.TYPE_NODE
-        elif isinstance(item, EMFLine):
-            itemType = NodeLayer.TYPE_LINE
-        elif isinstance(item, EMFShape):
-            itemType = NodeLayer.TYPE_SHAPE
-        elif isinstance(item, NodeLayer):
-            return item is self
-        return item in self.layerItems[itemType]
+        return item is self or item.ParentLayer() is self
 
     # Adds a layer element to this layer if the element isn't already inside.
     def addItemToLayer(self, type, item):
+        self.ensureLoaded()
         typeList = self.layerItems[type]
         if item not in typeList:
             typeList.append(item)
+            self.indexCache.pop(type, None)
             item.setParentLayer(self)
+            self.setNeedRedraw()
             if type == NodeLayer.TYPE_SHAPE:
                 self.addItemsToLayer(NodeLayer.TYPE_LINE, item.lines())
 
@@ -122,26 +229,42 @@ class NodeLayer(DIPropertyHolder):
 
     # Removes item from layer if it is in this layer
     def removeFromLayer(self, type, item):
+        self.ensureLoaded()
         if item in self.layerItems[type]:
             self.layerItems[type].remove(item)
+            self.indexCache.pop(type, None)
             item.setParentLayer(None)
+            self.setNeedRedraw()
 
     # get the layer elements of a specific type
     def getList(self, type):
+        self.ensureLoaded()
         return self.layerItems[type]
 
-    # Get the pixel dimensions of this layer. Equivalent to map dimensions * 72
+    # The index of each item of type in its list. Kept until an item of the
+    # type is added or removed, so it isn't rebuilt for every edit
+    def itemIndexes(self, type):
+        indexes = self.indexCache.get(type)
+        if indexes is None:
+            items = self.getList(type)
+            indexes = {items[i]: i for i in range(len(items))}
+            self.indexCache[type] = indexes
+        return indexes
+
+    # Get the pixel dimensions of this layer. Equivalent to map dimensions
+    # * CELL_SIZE
     def getDimensions(self):
         return (self.layerWidth, self.layerHeight)
 
     # Sets the pixel dimensions of the layers. xOff and yOff  will offset
     # all nodes.
     def setLayerDimensions(self, width, height, xOff, yOff):
+        self.ensureLoaded()
         self.layerWidth = width
         self.layerHeight = height
         for node in self.layerItems[NodeLayer.TYPE_NODE]:
             node.offset(xOff, yOff)
-        self.needsRedraw = True
+        self.setNeedRedraw()
 
     def setLayerImage(self, image):
         self.layerImage = image
@@ -149,48 +272,145 @@ class NodeLayer(DIPropertyHolder):
     def getLayerImage(self):
         return self.layerImage
 
+    # Use an image of the layer rendered in an earlier session. buffer holds
+    # the pixels of the image, and is kept for as long as the image is used
+    def setCachedImage(self, image, buffer):
+        self.layerImage = image
+        self.layerImageBuffer = buffer
+        self.needsRedraw = False
+
     def setNeedRedraw(self):
         self.needsRedraw = True
+        self.layerVersion += 1
+
+    def version(self):
+        return self.layerVersion
 
     def NeedsRedraw(self):
         return self.needsRedraw
 
     def redrawLayerImage(self, dis):
+        self.ensureLoaded()
         self.layerImage = QImage(self.layerWidth, self.layerHeight,
-                                 QImage.Format_ARGB32)
+                                 QImage.Format_ARGB32_Premultiplied)
+        self.layerImageBuffer = None
         self.layerImage.fill(QColor(0, 0, 0, 0))
         imgPainter = QPainter(self.layerImage)
-        # draw in reverse order to keep the order correct
-        for di in reversed(dis):
-            di.drawDisplay(imgPainter, self)
-        imgPainter.end()
+        try:
+            # draw in reverse order to keep the order correct
+            for di in reversed(dis):
+                di.drawDisplay(imgPainter, self)
+        finally:
+            # an image still being painted can't be freed
+            imgPainter.end()
         self.needsRedraw = False
         return self.layerImage
 
+    # The pixel dimensions of the layer drawn at scale
+    def scaledDimensions(self, scale=1.0):
+        return (max(1, round(self.layerWidth * scale)),
+                max(1, round(self.layerHeight * scale)))
+
+    # An image of rows top to top + height of the layer, drawn on its own
+    # without touching the layer image. Copied from the layer image when it
+    # is up to date. With a scale other than 1 the layer is drawn at
+    # scale * CELL_SIZE pixels per cell, and top and height are rows of the
+    # scaled image. left and width pick out columns the same way, by
+    # default all of them. itemLists, if given, maps DIs to the items of the
+    # layer to draw for them, the rest being outside the band
+    def drawBand(self, dis, top, height, scale=1.0, left=0, width=None,
+                 itemLists=None):
+        if width is None:
+            width = self.scaledDimensions(scale)[0] - left
+        if (scale == 1 and self.layerImage is not None and
+                not self.NeedsRedraw()):
+            return self.layerImage.copy(left, top, width, height)
+        self.ensureLoaded()
+        band = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+        band.fill(QColor(0, 0, 0, 0))
+        bandPainter = QPainter(band)
+        try:
+            bandPainter.translate(-left, -top)
+            if scale != 1:
+                # the items are drawn in layer pixels, and their images are
+                # resampled rather than scaled by the nearest pixel
+                bandPainter.scale(scale, scale)
+                bandPainter.setRenderHint(QPainter.SmoothPixmapTransform)
+            for di in reversed(dis):
+                if itemLists is not None and di in itemLists:
+                    di.drawItems(bandPainter, itemLists[di])
+                else:
+                    di.drawDisplay(bandPainter, self)
+        finally:
+            bandPainter.end()
+        return band
+
+    # True if the layer was never loaded and its text still means the same:
+    # the DIs it refers to have the same indexes and individual values
+    def pendingJSONMatches(self, diIndexes):
+        return (self.pendingJSON is not None and
+                all(diIndexes.get(self.pendingDIs[i]) == i and
+                    self.pendingDIs[i].individualValues() ==
+                    self.pendingDefaults[i]
+                    for i in range(len(self.pendingDIs))))
+
+    # The JSON text of the layer. A layer that was never loaded gives the
+    # text it was read from, as long as it would still be saved the same way.
+    # Only the DIs of the layer itself are replaced if they changed
+    def jsonText(self, diIndexes):
+        if self.pendingJSONMatches(diIndexes):
+            indiv = self.indivAttributesJSON(diIndexes)
+            jsDIProperties = {str(dIndex): indiv[dIndex] for dIndex in indiv}
+            if jsDIProperties == self.pendingDIProperties:
+                return self.pendingJSON
+            start, end = self.pendingDISpan
+            return (self.pendingJSON[:start] + json.dumps(indiv) +
+                    self.pendingJSON[end:])
+        return json.dumps(self.jsonObj(diIndexes))
+
     def jsonObj(self, diIndexes):
+        if self.pendingJSON is not None:
+            if self.pendingJSONMatches(diIndexes):
+                # never loaded and the DIs still match, so the saved
+                # JSON can be used as is
+                jsContents = json.loads(self.pendingJSON)
+                jsContents["DIProperties"] = self.indivAttributesJSON(
+                    diIndexes)
+                return jsContents
+            self.ensureLoaded()
+        return next(self.jsonSteps(diIndexes))
+
+    # Build the JSON of a loaded layer a few items at a time. With stepItems
+    # set, None is yielded after every stepItems items so the work can be
+    # spread out, as long as the layer doesn't change in between. The JSON
+    # itself is yielded last
+    def jsonSteps(self, diIndexes, stepItems=None):
         indiv = self.indivAttributesJSON(diIndexes)
+        count = 0
         nodeJSON = []
         nodeIDS = {}
-        i = 0
         for node in self.layerItems[NodeLayer.TYPE_NODE]:
-            nodeIDS[node] = i
-            i += 1
+            nodeIDS[node] = len(nodeJSON)
             nodeJSON.append(node.jsonObj(diIndexes))
-
-        def lineShapeJSON(list, nodes, diIndexes):
+            count += 1
+            if stepItems is not None and count % stepItems == 0:
+                yield None
+        lineShapeJSON = {}
+        for type in (NodeLayer.TYPE_LINE, NodeLayer.TYPE_SHAPE):
             items = []
-            for item in list:
-                items.append(item.jsonObj(nodes, diIndexes))
-            return items
-        lineJSON = lineShapeJSON(
-            self.layerItems[NodeLayer.TYPE_LINE], nodeIDS, diIndexes)
-        shapeJSON = lineShapeJSON(
-            self.layerItems[NodeLayer.TYPE_SHAPE], nodeIDS, diIndexes)
-        return {
+            for item in self.layerItems[type]:
+                items.append(item.jsonObj(nodeIDS, diIndexes))
+                count += 1
+                if stepItems is not None and count % stepItems == 0:
+                    yield None
+            lineShapeJSON[type] = items
+        # the DIs come first, so a lazy layer can read them without going
+        # through the items. See createLazy()
+        yield {
+            "DIProperties": indiv,
             "Nodes": nodeJSON,
-            "Lines": lineJSON,
-            "Shapes": shapeJSON,
-            "DIProperties": indiv
+            "Lines": lineShapeJSON[NodeLayer.TYPE_LINE],
+            "Shapes": lineShapeJSON[NodeLayer.TYPE_SHAPE]
         }
 
 
@@ -207,12 +427,17 @@ class EMFNode(DIPropertyHolder):
         self.nPoint = QPoint(x, y)
         self.lines = []
         self.shapes = []
-
-        self.tempX = self.nPoint.x()
-        self.tempY = self.nPoint.y()
-
-        self.transforming = False
-        self.offsetNode = None
+        # Topology index: the line to each connected node, and each shape
+        # keyed by the frozenset of its nodes. Kept up to date by EMFLine and
+        # EMFShape as they are created and deleted.
+        self.neighborLines = {}
+        self.shapeIndex = {}
+
+        # the NodeTransform of this node alone, between beginTransform() and
+        # applyTransform() or cancelTransform()
+        self.nodeTransform = None
+        # Incremented whenever the node moves. Used by shapes to cache geometry
+        self.nodeVersion = 0
 
     @classmethod
     def createFromJSON(cls, jsContents, dis):
@@ -227,64 +452,48 @@ class EMFNode(DIPropertyHolder):
         return EMFNode(node.x(), node.y())
 
     # Use when beginning to perform a transform operation on the node (grab,
-    # rotate, scale). Sets up temporary points for calculating the operations
+    # rotate, scale) around median. The node is transformed by a NodeTransform
+    # of its own, so it moves the same as it would with the rest of a
+    # selection
     def beginTransform(self, median):
-        if not self.transforming:
-            self.transforming = True
-
-            self.offsetNode = EMFNode(self.nPoint.x() - median.x(),
-                                      self.nPoint.y() - median.y())
-            self.transformComparison = EMFNodeHelper.nodeComparison(
-                median, self, True)
-            self.tempX = self.nPoint.x()
-            self.tempY = self.nPoint.y()
+        if self.nodeTransform is None:
+            self.nodeTransform = NodeTransform([self], median)
 
     # Cancel transform, setting node positions back to their original positions
     def cancelTransform(self):
-        self.transforming = False
-        self.nPoint.setX(self.tempX)
-        self.nPoint.setY(self.tempY)
-        if self.parentLayer is not None:
-            self.parentLayer.setNeedRedraw()
+        if self.nodeTransform is not None:
+            self.nodeTransform.cancel()
+            self.nodeTransform = None
 
     # Apply the selected transform
     def applyTransform(self):
-        self.transforming = False
+        if self.nodeTransform is not None:
+            self.nodeTransform.apply()
+            self.nodeTransform = None
 
     # Transform method. Move the point from the offset.
     def grab(self, offset):
-        self.nPoint.setX(self.tempX + offset[0])
-        self.nPoint.setY(self.tempY + offset[1])
-        if self.parentLayer is not None:
-            self.parentLayer.setNeedRedraw()
+        self.nodeTransform.grab(offset)
+
+    # Set the position of the node. Does not update the parent layer, so use
+    # when moving many nodes at once and redrawing their layers afterwards
+    def moveTo(self, x, y):
+        self.nPoint.setX(x)
+        self.nPoint.setY(y)
+        self.nodeVersion += 1
 
     # Perform an offset shift. Does not happen as part of a transform
     def offset(self, xOff, yOff):
-        self.nPoint.setX(int(round(self.nPoint.x() + xOff)))
-        self.nPoint.setY(int(round(self.nPoint.y() + yOff)))
+        self.moveTo(int(round(self.nPoint.x() + xOff)),
+                    int(round(self.nPoint.y() + yOff)))
 
     # Transform method. Rotate by deltaAngle (degrees) around the median angle.
     def rotate(self, deltaAngle):
-        angle = math.radians(self.transformComparison[2] + deltaAngle)
-        self.nPoint.setX(
-            int(round(self.transformComparison[0].x() +
-                      self.transformComparison[3] * math.cos(angle))))
-        self.nPoint.setY(
-            int(round(self.transformComparison[0].y() +
-                      self.transformComparison[3] * math.sin(angle))))
-        if self.parentLayer is not None:
-            self.parentLayer.setNeedRedraw()
-    # Transform method. scale according to distance from the median point.
+        self.nodeTransform.rotate(deltaAngle)
 
+    # Transform method. scale according to distance from the median point.
     def scale(self, size):
-        self.nPoint.setX(
-            int(round(self.transformComparison[0].x() +
-                      self.offsetNode.x()*size)))
-        self.nPoint.setY(
-            int(round(self.transformComparison[0].y() +
-                      self.offsetNode.y()*size)))
-        if self.parentLayer is not None:
-            self.parentLayer.setNeedRedraw()
+        self.nodeTransform.scale(size)
 
     def x(self):
         return self.nPoint.x()
@@ -295,9 +504,13 @@ class EMFNode(DIPropertyHolder):
     def point(self):
         return self.nPoint
 
+    def version(self):
+        return self.nodeVersion
+
     # Add a line to the Node
     def addLine(self, line):
         self.lines.append(line)
+        self.neighborLines[line.otherNode(self)] = line
 
     def getLines(self):
         return self.lines
@@ -305,26 +518,43 @@ class EMFNode(DIPropertyHolder):
     def getShapes(self):
         return self.shapes
 
-    # grab a set of nodes connected to this nodes via lines
+    # grab a set-like view of the nodes connected to this node via lines
     def connectedNodes(self):
-        nodeSet = set()
-        for line in self.lines:
-            nodeSet.update(line.nodes())
-        if self in nodeSet:
-            nodeSet.remove(self)
-        return nodeSet
+        return self.neighborLines.keys()
+
+    # The line between this node and node, or None if they aren't connected
+    def lineTo(self, node):
+        return self.neighborLines.get(node)
 
     # Add a shape to the Node
     def addShape(self, shape):
         self.shapes.append(shape)
+        self.shapeIndex[shape.nodeKey()] = shape
+
+    # The shape made from exactly the nodes in nodeKey, or None
+    def shapeWithNodes(self, nodeKey):
+        return self.shapeIndex.get(nodeKey)
 
     def removeLineRef(self, line):
         if line in self.lines:
             self.lines.remove(line)
+            other = line.otherNode(self)
+            if self.neighborLines.get(other) is line:
+                del self.neighborLines[other]
+                # fall back to any duplicate line between the same nodes
+                for remaining in self.lines:
+                    if remaining.otherNode(self) is other:
+                        self.neighborLines[other] = remaining
 
     def removeShapeRef(self, shape):
         if shape in self.shapes:
             self.shapes.remove(shape)
+            key = shape.nodeKey()
+            if self.shapeIndex.get(key) is shape:
+                del self.shapeIndex[key]
+                for remaining in self.shapes:
+                    if remaining.nodeKey() == key:
+                        self.shapeIndex[key] = remaining
 
     # Check if this node is in range of the selected point
     def inSelectRange(self, point, threshold=100):
@@ -375,6 +605,11 @@ class EMFLine(DIPropertyHolder):
     def nodes(self):
         return self.lineNodes
 
+    # Given one of the line's nodes, return the node on the other end
+    def otherNode(self, node):
+        return (self.lineNodes[1] if self.lineNodes[0] is node
+                else self.lineNodes[0])
+
     def shapes(self):
         return self.lineShapes
 
@@ -425,23 +660,26 @@ class EMFShape(DIPropertyHolder):
                 nodes.append(sNode[1])
         nodes = EMFNodeHelper.sortByLine(nodes)
         self.shapeNodes = nodes
+        self.shapeKey = frozenset(nodes)
         self.shapeLines = []
-        self.shapeUpdating = True
         lastNode = self.shapeNodes[-1]
         for node in self.shapeNodes:
             node.addShape(self)
-            line = EMFNodeHelper.existingLine(lastNode, node)
-            # print(line)
-            if len(line) == 0:
+            line = lastNode.lineTo(node)
+            if line is None:
                 self.shapeLines.append(EMFLine(lastNode, node, self))
             else:
-                self.shapeLines.append(line.pop())
-                self.shapeLines[-1].addShape(self)
+                self.shapeLines.append(line)
+                line.addShape(self)
             lastNode = node
-        nps = []
-        for node in self.shapeNodes:
-            nps.append(node.point())
-        self.nodePoly = QPolygon(nps)
+        # Geometry cached against the sum of the node versions. Nodes only
+        # ever increase their versions, so the sum changes whenever one moves
+        self.geometryVersion = -1
+        self.nodePoly = None
+        self.shapeBounds = None
+        self.shapeArea = None
+        self.shapeCentroid = None
+        self.updateGeometry()
 
     @classmethod
     def createFromJSON(cls, jsContents, nodeList, dis):
@@ -457,28 +695,93 @@ class EMFShape(DIPropertyHolder):
     def createFromLines(cls, lines):
         return EMFShape(EMFNodeHelper.listOfNodes(lines))
 
-    def poly(self):
-        if self.shapeUpdating:
+    def nodeVersionSum(self):
+        version = 0
+        for node in self.shapeNodes:
+            version += node.version()
+        return version
+
+    # Rebuild the cached polygon if any of the nodes have moved
+    def updateGeometry(self):
+        version = self.nodeVersionSum()
+        if version != self.geometryVersion:
             nps = []
             for node in self.shapeNodes:
                 nps.append(node.point())
             self.nodePoly = QPolygon(nps)
+            self.shapeBounds = self.nodePoly.boundingRect()
+            # area and centroid are calculated when first asked for
+            self.shapeArea = None
+            self.shapeCentroid = None
+            self.geometryVersion = version
+
+    def poly(self):
+        self.updateGeometry()
         return self.nodePoly
 
+    # The bounding QRect of the shape
+    def bounds(self):
+        self.updateGeometry()
+        return self.shapeBounds
+
+    # The area of the shape in square pixels
+    def area(self):
+        self.updateGeometry()
+        if self.shapeArea is None:
+            self.calculateAreaCentroid()
+        return self.shapeArea
+
+    # The center of mass of the shape as a QPointF
+    def centroid(self):
+        self.updateGeometry()
+        if self.shapeCentroid is None:
+            self.calculateAreaCentroid()
+        return self.shapeCentroid
+
+    # Shoelace formula for the area and centroid of the polygon
+    def calculateAreaCentroid(self):
+        twiceArea = 0
+        cx = 0
+        cy = 0
+        last = self.shapeNodes[-1]
+        for node in self.shapeNodes:
+            cross = last.x() * node.y() - node.x() * last.y()
+            twiceArea += cross
+            cx += (last.x() + node.x()) * cross
+            cy += (last.y() + node.y()) * cross
+            last = node
+        self.shapeArea = abs(twiceArea) / 2
+        if twiceArea == 0:
+            # degenerate shape, fall back to the average of the nodes
+            count = len(self.shapeNodes)
+            cx = sum(node.x() for node in self.shapeNodes) / count
+            cy = sum(node.y() for node in self.shapeNodes) / count
+            self.shapeCentroid = QPointF(cx, cy)
+        else:
+            self.shapeCentroid = QPointF(cx / (3 * twiceArea),
+                                         cy / (3 * twiceArea))
+
     def nodes(self):
         return self.shapeNodes
 
+    # frozenset of the shape's nodes, used to look up shapes by their nodes
+    def nodeKey(self):
+        return self.shapeKey
+
     def lines(self):
         return self.shapeLines
 
+    # True if the nodes have moved since the geometry was last cached
     def updating(self):
-        return self.shapeUpdating
+        return self.nodeVersionSum() != self.geometryVersion
 
+    # Force the geometry to be rebuilt the next time it is used
     def setUpdating(self, update):
-        self.shapeUpdating = update
+        if update:
+            self.geometryVersion = -1
 
     def inSelectRange(self, point, threshold=100):
-        return self.nodePoly.containsPoint(point.point(), Qt.OddEvenFill)
+        return self.poly().containsPoint(point.point(), Qt.OddEvenFill)
 
     def shapeDeleted(self):
         for line in self.shapeLines:
@@ -501,24 +804,19 @@ class EMFShape(DIPropertyHolder):
 
 class EMFNodeHelper:
 
-    # Determine if a line between two nodes already exists
+    # Determine if a line between two nodes already exists. Returns a set
+    # holding the line, or an empty set
     @classmethod
     def existingLine(cls, n1, n2):
-        return set(n1.getLines()).intersection(n2.getLines())
+        line = n1.lineTo(n2)
+        return set() if line is None else {line}
 
     # return a shape made from the existing nodes if possible, otherwise None
     @classmethod
     def existingShape(cls, nodeList):
         shape = None
-        ns = set(nodeList)
         if len(nodeList) > 2:
-            # check the shapes in here.
-            possibleShapes = nodeList[0].getShapes()
-            for ps in possibleShapes:
-                # Check if the shape has the exact same nodes inside
-                if len(ns.symmetric_difference(ps.nodes())) == 0:
-                    shape = ps
-                    break
+            shape = nodeList[0].shapeWithNodes(frozenset(nodeList))
         return shape
 
     # calculate the angle between straight up and the line generated by the
@@ -584,22 +882,16 @@ class EMFNodeHelper:
 
     @classmethod
     def listOfNodes(cls, itemList):
-
-        nodeList = []
+        # dict keys keep the order nodes were found in without duplicates
+        nodes = {}
         for item in itemList:
             if isinstance(item, EMFNode):
-                if item not in nodeList:
-                    nodeList.append(item)
-            elif isinstance(item, EMFLine):
+                nodes[item] = None
+            elif isinstance(item, (EMFLine, EMFShape)):
                 for node in item.nodes():
-                    if node not in nodeList:
-                        nodeList.append(node)
-            elif isinstance(item, EMFShape):
-                for node in item.nodes():
-                    if node not in nodeList:
-                        nodeList.append(node)
+                    nodes[node] = None
 
-        return nodeList
+        return list(nodes)
 
     # Sort a group of nodes primarily by the angles centered around median,
     # secondarily by the magnitude distance
@@ -624,14 +916,11 @@ class EMFNodeHelper:
             sorted.append(node)
             connections = node.connectedNodes()
 
-            for node in list(connections.intersection(nodes)):
-                # find the closest connection
-                i = nodes.index(node)
-                # print("index: {}".format(i))
-                if cIndex == -1:
-                    cIndex = i
-                elif i > cIndex:
+            # find the closest connection, the last connected node in nodes
+            for i in range(len(nodes) - 1, -1, -1):
+                if nodes[i] in connections:
                     cIndex = i
+                    break
 
         return sorted
 
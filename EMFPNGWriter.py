@@ -0,0 +1,116 @@
+"""
+Encounter Mapper Freeform is a node-based encounter map creator for tabletop
+RPGs. Copyright 2020 Eric Symmank
+
+This file is part of Encounter Mapper Freeform.
+
+Encounter Mapper Freeform is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper Freeform is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper Freeform.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+import struct
+import zlib
+
+import numpy
+
+"""
+PNGWriter writes an RGBA PNG file a few rows at a time, so an image can be
+saved without ever being in memory as a whole. Rows are given as a numpy
+uint8 array with width * 4 bytes (red, green, blue, alpha, not premultiplied)
+per row, from the top of the image down.
+
+Each row is Paeth filtered, using the last row written before it, and
+compressed into IDAT chunks of about CHUNK_BYTES as the rows come in.
+"""
+
+
+class PNGWriter:
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+    CHUNK_BYTES = 1 << 20
+    # rows filtered at once, keeping the temporary arrays small
+    FILTER_ROWS = 64
+    PAETH = 4
+
+    def __init__(self, f, width, height, level=6):
+        self.f = f
+        self.width = width
+        self.height = height
+        self.rowsWritten = 0
+        self.previousRow = numpy.zeros(width * 4, numpy.uint8)
+        self.compressor = zlib.compressobj(level)
+        self.compressed = []
+        self.compressedSize = 0
+        f.write(PNGWriter.SIGNATURE)
+        # 8 bit RGBA, deflate, adaptive filtering, not interlaced
+        self.writeChunk(b"IHDR", struct.pack(
+            ">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+
+    def writeRows(self, rows):
+        if self.rowsWritten + len(rows) > self.height:
+            raise ValueError("More rows than the height of the image")
+        for start in range(0, len(rows), PNGWriter.FILTER_ROWS):
+            block = rows[start:start + PNGWriter.FILTER_ROWS]
+            self.addCompressed(self.compressor.compress(
+                self.paethFilter(block).tobytes()))
+            self.previousRow = block[-1].copy()
+        self.rowsWritten += len(rows)
+
+    # Write the rest of the image data and end the file
+    def finish(self):
+        if self.rowsWritten != self.height:
+            raise ValueError("Wrote {} of {} rows".format(
+                self.rowsWritten, self.height))
+        self.addCompressed(self.compressor.flush())
+        self.flushCompressed()
+        self.writeChunk(b"IEND", b"")
+
+    # The rows, each starting with its filter type
+    def paethFilter(self, rows):
+        raw = rows.astype(numpy.int16)
+        up = numpy.empty_like(raw)
+        up[0] = self.previousRow
+        up[1:] = raw[:-1]
+        # the byte of the same channel in the pixel to the left
+        left = numpy.zeros_like(raw)
+        left[:, 4:] = raw[:, :-4]
+        upLeft = numpy.zeros_like(raw)
+        upLeft[:, 4:] = up[:, :-4]
+        pa = numpy.abs(up - upLeft)
+        pb = numpy.abs(left - upLeft)
+        pc = numpy.abs(left + up - 2 * upLeft)
+        predicted = numpy.where((pa <= pb) & (pa <= pc), left,
+                                numpy.where(pb <= pc, up, upLeft))
+        filtered = numpy.empty((len(rows), rows.shape[1] + 1), numpy.uint8)
+        filtered[:, 0] = PNGWriter.PAETH
+        filtered[:, 1:] = (raw - predicted) & 0xFF
+        return filtered
+
+    def addCompressed(self, data):
+        if len(data) > 0:
+            self.compressed.append(data)
+            self.compressedSize += len(data)
+            if self.compressedSize >= PNGWriter.CHUNK_BYTES:
+                self.flushCompressed()
+
+    def flushCompressed(self):
+        if self.compressedSize > 0:
+            self.writeChunk(b"IDAT", b"".join(self.compressed))
+            self.compressed = []
+            self.compressedSize = 0
+
+    def writeChunk(self, chunkType, data):
+        self.f.write(struct.pack(">I", len(data)))
+        self.f.write(chunkType)
+        self.f.write(data)
+        crc = zlib.crc32(data, zlib.crc32(chunkType))
+        self.f.write(struct.pack(">I", crc))
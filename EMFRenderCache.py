@@ -0,0 +1,243 @@
+"""
+Encounter Mapper Freeform is a node-based encounter map creator for tabletop
+RPGs. Copyright 2020 Eric Symmank
+
+This file is part of Encounter Mapper Freeform.
+
+Encounter Mapper Freeform is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper Freeform is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper Freeform.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from PyQt5.QtGui import QImage
+
+from EMFAssets import EMFAssets
+
+"""
+RenderCache keeps the rendered images of a map's layers in a file next to
+the map, so layers that haven't changed since the map was saved don't need
+to be drawn again when it is opened. The file records the size and
+modification time of the map it was written with, and a digest of the
+DisplayItems and the contents of the images they use. A map edited outside
+the app, or drawn with changed DIs, simply doesn't match and is drawn as
+usual.
+
+    magic "EMFR", uint16 version, uint64 map size, uint64 map mtime in ns,
+        32 byte DI digest, uint32 entryCount
+    per entry: uint32 layer index, width, height, bytesPerLine,
+        uint64 offset, uint64 size
+    the zlib compressed premultiplied ARGB32 pixels of each image, at its
+        offset
+
+Once opened, each entry belongs to its layer for as long as the layer's
+version is unchanged, so nothing needs to be serialized or hashed to tell
+whether a layer still matches its image. Writing happens on a background
+thread, and only compresses the images of layers drawn since their entry
+was made. The other entries are copied over as they are.
+"""
+
+
+class RenderCache:
+    MAGIC = b"EMFR"
+    VERSION = 2
+    SUFFIX = ".cache"
+    FORMAT = QImage.Format_ARGB32_Premultiplied
+    # zlib level of the images. Layer images are mostly transparent, so the
+    # fastest level already makes them many times smaller
+    COMPRESS_LEVEL = 1
+
+    HEADER = struct.Struct("<4sHQQ32sI")
+    ENTRY = struct.Struct("<IIIIQQ")
+
+    # the thread writing the last cache, see write()
+    writer = None
+
+    def __init__(self, diDigest=None, mapped=None, entries=None):
+        self.diDigest = diDigest
+        self.mapped = mapped
+        # layer -> (version, width, height, bytesPerLine, compressed pixels)
+        self.entries = {} if entries is None else entries
+
+    @classmethod
+    def cachePath(cls, mapPath):
+        return mapPath + cls.SUFFIX
+
+    # The size and modification time of the file at path, as recorded in the
+    # cache
+    @classmethod
+    def fileStamp(cls, path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    # The cache saved with map, just read from mapPath. Empty if there isn't
+    # one, it can't be read, or the map file was changed since it was written
+    @classmethod
+    def open(cls, mapPath, map):
+        try:
+            stamp = cls.fileStamp(mapPath)
+            with open(cls.cachePath(mapPath), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return cls()
+        if len(mapped) < cls.HEADER.size:
+            return cls()
+        magic, version, size, mtime, diDigest, count = cls.HEADER.unpack_from(
+            mapped, 0)
+        if (magic != cls.MAGIC or version != cls.VERSION or
+                (size, mtime) != stamp):
+            return cls()
+        layers = map.getLayers()
+        entries = {}
+        position = cls.HEADER.size
+        for i in range(count):
+            (index, width, height, bytesPerLine, offset,
+             size) = cls.ENTRY.unpack_from(mapped, position)
+            position += cls.ENTRY.size
+            if index < len(layers) and offset + size <= len(mapped):
+                layer = layers[index]
+                entries[layer] = (layer.version(), width, height, bytesPerLine,
+                                  memoryview(mapped)[offset:offset + size])
+        return cls(diDigest, mapped, entries)
+
+    # Write the images of every layer of map that is drawn and up to date to
+    # the cache of mapPath, which the map was just saved to. Layers whose
+    # entry in the map's current cache still matches keep it. The file is
+    # written on a background thread, and the map is given the new cache
+    # straight away
+    @classmethod
+    def write(cls, map, mapPath):
+        cls.waitForWrites()
+        stamp = cls.fileStamp(mapPath)
+        previous = map.getRenderCache()
+        diDigest = hashlib.sha256(
+            cls.displayItemState(map.getDisplayItems())).digest()
+        cache = cls(diDigest)
+        if previous is not None and previous.diDigest == diDigest:
+            kept = previous.entries
+        else:
+            kept = {}
+        layers = map.getLayers()
+        drawn = []
+        for layer in layers:
+            entry = kept.get(layer)
+            image = layer.getLayerImage()
+            if entry is not None and entry[0] == layer.version():
+                cache.entries[layer] = entry
+            elif image is not None and not layer.NeedsRedraw():
+                # a shallow copy, the layer detaches from it if drawn again
+                drawn.append((layer, layer.version(), QImage(image)))
+        map.setRenderCache(cache)
+        cls.writer = threading.Thread(
+            target=cache.writeFile,
+            args=(cls.cachePath(mapPath), stamp, layers, drawn))
+        cls.writer.start()
+
+    # Wait for the cache being written in the background, if any
+    @classmethod
+    def waitForWrites(cls):
+        if cls.writer is not None:
+            cls.writer.join()
+            cls.writer = None
+
+    # Compress the drawn images into entries and write every entry to path.
+    # Runs on the writer thread. The cache only saves drawing time, so a
+    # failed write just leaves no cache
+    def writeFile(self, path, stamp, layers, drawn):
+        for layer, version, image in drawn:
+            if image.format() != RenderCache.FORMAT:
+                image = image.convertToFormat(RenderCache.FORMAT)
+            self.entries[layer] = (
+                version, image.width(), image.height(), image.bytesPerLine(),
+                zlib.compress(image.constBits().asstring(image.sizeInBytes()),
+                              RenderCache.COMPRESS_LEVEL))
+        written = [(i, self.entries[layers[i]]) for i in range(len(layers))
+                   if layers[i] in self.entries]
+        tempPath = path + ".tmp"
+        try:
+            if len(written) == 0:
+                if os.path.exists(path):
+                    os.remove(path)
+                return
+            with open(tempPath, "wb") as f:
+                f.write(RenderCache.HEADER.pack(
+                    RenderCache.MAGIC, RenderCache.VERSION, *stamp,
+                    self.diDigest, len(written)))
+                offset = (RenderCache.HEADER.size +
+                          RenderCache.ENTRY.size * len(written))
+                for index, entry in written:
+                    version, width, height, bytesPerLine, data = entry
+                    f.write(RenderCache.ENTRY.pack(
+                        index, width, height, bytesPerLine, offset,
+                        len(data)))
+                    offset += len(data)
+                for index, entry in written:
+                    f.write(entry[4])
+            os.replace(tempPath, path)
+        except OSError:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+
+    # The image of layer, decompressed from its entry, and the memory it
+    # reads from. The QImage doesn't keep the memory alive by itself, so the
+    # memory has to be kept for as long as the image is used
+    def cachedImage(self, layer):
+        version, width, height, bytesPerLine, data = self.entries[layer]
+        try:
+            pixels = zlib.decompress(data)
+        except zlib.error:
+            return None, None
+        if len(pixels) != bytesPerLine * height:
+            return None, None
+        image = QImage(pixels, width, height, bytesPerLine, RenderCache.FORMAT)
+        return image, pixels
+
+    # Give each layer that hasn't been drawn yet its cached image, if it
+    # hasn't changed since the cache was opened or written
+    def restoreImages(self, layers, dis):
+        if len(self.entries) == 0 or len(layers) == 0:
+            return
+        if not any(self.entries.get(layer, (None,))[0] == layer.version()
+                   for layer in layers):
+            return
+        diDigest = hashlib.sha256(RenderCache.displayItemState(dis)).digest()
+        if diDigest != self.diDigest:
+            return
+        for layer in layers:
+            entry = self.entries.get(layer)
+            if entry is not None and entry[0] == layer.version():
+                image, pixels = self.cachedImage(layer)
+                if image is not None:
+                    layer.setCachedImage(image, pixels)
+
+    # The DisplayItems in draw order, with image paths replaced by the hash
+    # of the image, so moving an image file doesn't change the digest
+    @classmethod
+    def displayItemState(cls, dis):
+        state = []
+        for di in dis:
+            dijs = di.jsonObj()
+            shared = di.getSharedAttributes()
+            for attrName in shared:
+                path = shared[attrName].getJSONValue()
+                if shared[attrName].isImagePath() and isinstance(path, str):
+                    dijs["sharedAttributes"][attrName] = EMFAssets.fileHash(
+                        path)
+            state.append(dijs)
+        return json.dumps(state).encode("utf-8")
@@ -0,0 +1,94 @@
+"""
+Encounter Mapper Freeform is a node-based encounter map creator for tabletop
+RPGs. Copyright 2020 Eric Symmank
+
+This file is part of Encounter Mapper Freeform.
+
+Encounter Mapper Freeform is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper Freeform is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper Freeform.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""
+EMFSelection is the ordered set of items selected in an EMFMap. Items keep the
+order they were selected in, while checking, adding, and removing a single
+item does not depend on the size of the selection. Every change increments
+the selection version, so other components can cache values calculated from
+the selection and only recalculate them when version() has changed.
+"""
+
+
+class EMFSelection:
+    def __init__(self, items=None):
+        # dicts keep insertion order, so the keys double as an ordered set
+        self.selectedItems = {}
+        self.selectionVersion = 0
+        if items is not None:
+            self.addItems(items)
+
+    def __contains__(self, item):
+        return item in self.selectedItems
+
+    def __iter__(self):
+        return iter(self.selectedItems)
+
+    def __len__(self):
+        return len(self.selectedItems)
+
+    # Add an item to the end of the selection. Returns True if it was added
+    def add(self, item):
+        if item in self.selectedItems:
+            return False
+        self.selectedItems[item] = None
+        self.selectionVersion += 1
+        return True
+
+    # Add multiple items, skipping any that are already selected
+    def addItems(self, items):
+        startLen = len(self.selectedItems)
+        for item in items:
+            self.selectedItems[item] = None
+        if len(self.selectedItems) != startLen:
+            self.selectionVersion += 1
+
+    # Remove an item from the selection. Returns True if it was removed
+    def remove(self, item):
+        if item not in self.selectedItems:
+            return False
+        del self.selectedItems[item]
+        self.selectionVersion += 1
+        return True
+
+    # Remove multiple items, ignoring any that are not selected
+    def removeItems(self, items):
+        startLen = len(self.selectedItems)
+        for item in items:
+            self.selectedItems.pop(item, None)
+        if len(self.selectedItems) != startLen:
+            self.selectionVersion += 1
+
+    # Replace the selection. items may be this selection or a view of it.
+    def setItems(self, items):
+        self.selectedItems = dict.fromkeys(items)
+        self.selectionVersion += 1
+
+    def clear(self):
+        if len(self.selectedItems) > 0:
+            self.selectedItems = {}
+            self.selectionVersion += 1
+
+    def items(self):
+        return list(self.selectedItems)
+
+    def version(self):
+        return self.selectionVersion
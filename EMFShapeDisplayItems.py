@@ -18,7 +18,7 @@ You should have received a copy of the GNU General Public License
 along with Encounter Mapper Freeform.
 If not, see <https://www.gnu.org/licenses/>.
 """
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QRectF
 from PyQt5.QtGui import QPen, QBrush, QColor, QPixmap
 
 
@@ -27,6 +27,7 @@ from EMFNodes import EMFShape
 from EMFAttribute import (EMFAttribute, ScrollbarAttributeWidget,
                           ColorAttributeWidget,
                           FilePickerAttributeWidget)
+from EMFAssets import EMFAssets
 
 
 class ColorShapeDisplay(EMFDisplayItem):
@@ -60,6 +61,9 @@ class ColorShapeDisplay(EMFDisplayItem):
     def classStr(self):
         return "ColorShapeDisplay"
 
+    def itemBounds(self, item):
+        return QRectF(item.bounds()).adjusted(-1, -1, 1, 1)
+
     def drawSimple(self, painter, item):
         # draw the shape's polygon
         poly = item.poly()
@@ -79,7 +83,8 @@ class ImageShapeDisplay(EMFDisplayItem):
         if shared is None:
             shared = {"Image": (None, "Choose a file...")}
         else:
-            shared["Image"] = (QPixmap(shared["Image"]), shared["Image"])
+            shared["Image"] = (EMFAssets.imageHandle(shared["Image"]),
+                               shared["Image"])
         if indiv is None:
             indiv = {"Opacity": 100}
         self.sharedAttributes = {
@@ -98,14 +103,18 @@ class ImageShapeDisplay(EMFDisplayItem):
     def classStr(self):
         return "ImageShapeDisplay"
 
+    def itemBounds(self, item):
+        return QRectF(item.bounds()).adjusted(-1, -1, 1, 1)
+
     def drawSimple(self, painter, item):
         # draw the shape's polygon
         poly = item.poly()
         values = item.diValues(self)
         opacity = values["Opacity"]
         painter.setOpacity(opacity / 100)
-        img = self.sharedAttributes["Image"].getValue()
-        img = QPixmap("error_image.png") if img is None else img
+        handle = self.sharedAttributes["Image"].getValue()
+        img = (QPixmap("error_image.png") if handle is None
+               else handle.pixmap())
         painter.setPen(Qt.NoPen)
         painter.setBrush(QBrush(img))
         painter.drawPolygon(poly)
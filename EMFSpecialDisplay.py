@@ -26,6 +26,7 @@ from EMFAttribute import (EMFAttribute, ScrollbarAttributeWidget,
                           ColorAttributeWidget,
                           FilePickerAttributeWidget)
 from EMFNodes import NodeLayer
+from EMFAssets import EMFAssets
 
 
 class GridDisplay(EMFDisplayItem):
@@ -59,7 +60,7 @@ class GridDisplay(EMFDisplayItem):
         opacity = self.sharedAttributes["Opacity"].getValue()
         painter.setOpacity(opacity / 100)
         painter.setPen(pc)
-        tileSize = 72
+        tileSize = NodeLayer.CELL_SIZE
         xr = dimensions[0]//tileSize + 1
         yr = dimensions[1]//tileSize + 1
         # print(pattern)
@@ -117,7 +118,8 @@ class ImageBGDisplay(EMFDisplayItem):
         if shared is None:
             shared = {"Image": (None, "Choose a file...")}
         else:
-            shared["Image"] = (QPixmap(shared["Image"]), shared["Image"])
+            shared["Image"] = (EMFAssets.imageHandle(shared["Image"]),
+                               shared["Image"])
         if indiv is None:
             indiv = {"Opacity": 100}
         self.sharedAttributes = {
@@ -142,8 +144,9 @@ class ImageBGDisplay(EMFDisplayItem):
         values = item.diValues(self)
         opacity = values["Opacity"]
         painter.setOpacity(opacity / 100)
-        img = self.sharedAttributes["Image"].getValue()
-        img = QPixmap("error_image.png") if img is None else img
+        handle = self.sharedAttributes["Image"].getValue()
+        img = (QPixmap("error_image.png") if handle is None
+               else handle.pixmap())
         painter.setPen(Qt.NoPen)
         painter.setBrush(QBrush(img))
         painter.drawRect(0, 0, dimensions[0], dimensions[1])
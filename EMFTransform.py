@@ -0,0 +1,109 @@
+"""
+Encounter Mapper Freeform is a node-based encounter map creator for tabletop
+RPGs. Copyright 2020 Eric Symmank
+
+This file is part of Encounter Mapper Freeform.
+
+Encounter Mapper Freeform is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper Freeform is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper Freeform.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+import math
+
+import numpy
+
+"""
+NodeTransform performs a grab, rotate, or scale on a group of nodes at once.
+The starting coordinates of every node are kept in a single array, and each
+transform is calculated for all nodes in one step before the changed positions
+are written back to the nodes. Layers holding the nodes are only told to
+redraw once per update.
+
+grab(), rotate(), and scale() take the same values as the EMFNode methods of
+the same name. cancel() moves every node back to its starting position, while
+apply() keeps the current positions. The versions of the layers from before
+the transform are kept for the MoveNodesCommand of an applied transform.
+"""
+
+
+class NodeTransform:
+    def __init__(self, nodes, median):
+        self.nodes = list(nodes)
+        self.median = numpy.array((median.x(), median.y()), dtype=numpy.int64)
+        self.startCoords = numpy.array(
+            [(node.x(), node.y()) for node in self.nodes],
+            dtype=numpy.int64).reshape(-1, 2)
+        self.currentCoords = self.startCoords
+        self.offsets = self.startCoords - self.median
+        self.layers = set()
+        for node in self.nodes:
+            if node.ParentLayer() is not None:
+                self.layers.add(node.ParentLayer())
+        self.layerVersions = {layer: layer.version() for layer in self.layers}
+        self.transforming = True
+
+    # Move every node by offset, an (x, y) tuple
+    def grab(self, offset):
+        self.setCoordinates(
+            self.startCoords + numpy.array(offset, dtype=numpy.int64))
+
+    # Rotate by deltaAngle (degrees) around the median
+    def rotate(self, deltaAngle):
+        # EMFNode angles start from straight up, so the rotation is 90 more
+        angle = math.radians(deltaAngle + 90)
+        cos = math.cos(angle)
+        sin = math.sin(angle)
+        xs = self.offsets[:, 0]
+        ys = self.offsets[:, 1]
+        rotated = numpy.empty(self.offsets.shape, dtype=numpy.float64)
+        rotated[:, 0] = xs * cos - ys * sin
+        rotated[:, 1] = xs * sin + ys * cos
+        self.setCoordinates(numpy.rint(rotated) + self.median)
+
+    # Scale the distance of every node from the median by size
+    def scale(self, size):
+        self.setCoordinates(numpy.rint(self.offsets * size) + self.median)
+
+    # Put every node back in its starting position
+    def cancel(self):
+        self.setCoordinates(self.startCoords)
+        self.transforming = False
+
+    # Keep the current positions
+    def apply(self):
+        self.transforming = False
+
+    def getNodes(self):
+        return self.nodes
+
+    def getStartCoordinates(self):
+        return self.startCoords
+
+    def getCurrentCoordinates(self):
+        return self.currentCoords
+
+    def getLayerVersions(self):
+        return self.layerVersions
+
+    # Write the coordinates of nodes that moved since the last update
+    def setCoordinates(self, coords):
+        coords = coords.astype(numpy.int64)
+        moved = numpy.flatnonzero(
+            numpy.any(coords != self.currentCoords, axis=1))
+        nodes = self.nodes
+        for index, (x, y) in zip(moved.tolist(), coords[moved].tolist()):
+            nodes[index].moveTo(x, y)
+        self.currentCoords = coords
+        if len(moved) > 0:
+            for layer in self.layers:
+                layer.setNeedRedraw()